@@ -0,0 +1,295 @@
+"""
+archive.py
+
+Bulk export and import of a world or campaign with everything under it
+(NPCs, campaigns, maps and their tile chunks, segments, players,
+sessions, logs, summaries, player actions and story events).
+
+An archive is NDJSON: a header line followed by one line per row,
+
+    {"type": "archive", "version": 1, "scope": "world", "exported_at": "..."}
+    {"type": "world", "data": {"world_id": 1, "name": "...", ...}}
+    {"type": "campaign", "data": {"campaign_id": 4, "world_id": 1, ...}}
+
+with parents always written before their children. Export streams rows
+straight from keyset-ordered queries, so memory stays flat. Import reads
+the lines in order, inserts them in batches of IMPORT_BATCH_SIZE rows in a
+single transaction and maps every id in the archive to a newly assigned
+one, so an archive can be imported next to the data it was exported from
+(cloning) or into another server.
+"""
+
+import json
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import insert, inspect, or_, select
+
+from aidm_server.database import db
+from aidm_server.jsonfields import json_fields, JSONSchemaError
+from aidm_server.models import (
+    World, Npc, Campaign, Map, MapChunk, CampaignSegment, Player, Session,
+    SessionLogEntry, SessionSummary, PlayerAction, StoryEvent
+)
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_VERSION = 1
+EXPORT_BATCH_SIZE = 500
+IMPORT_BATCH_SIZE = int(os.getenv("AIDM_IMPORT_BATCH_SIZE", "1000"))
+
+
+class ArchiveError(ValueError):
+    """Raised for malformed archives or references that can't be resolved."""
+
+
+class _Entity:
+    def __init__(self, name, model, foreign_keys=None):
+        self.name = name
+        self.model = model
+        mapper = inspect(model)
+        self.order_by = list(mapper.primary_key)
+        # Surrogate id, re-assigned on import (None for composite keys such
+        # as map chunks, which are fully made of foreign keys).
+        self.primary_key = mapper.primary_key[0].key if len(mapper.primary_key) == 1 else None
+        # JSON columns are exported as their JSON text, under their public name.
+        self.json_fields = json_fields(model)
+        public = {field.key: name for name, field in self.json_fields.items()}
+        # archive name -> mapped attribute, e.g. "stats" -> "_stats"
+        self.attributes = {public.get(attr.key, attr.key): attr.key for attr in mapper.column_attrs}
+        # archive name -> column, e.g. "class_" for Player.class_
+        self.columns = {
+            public.get(attr.key, attr.key): attr.columns[0] for attr in mapper.column_attrs
+        }
+        self.datetime_fields = {
+            key for key, column in self.columns.items() if isinstance(column.type, db.DateTime)
+        }
+        # attribute -> entity name whose ids it holds
+        self.foreign_keys = foreign_keys or {}
+
+
+# Parents before children: export writes and import expects this order.
+ENTITIES = [
+    _Entity("world", World),
+    _Entity("npc", Npc, {"world_id": "world"}),
+    _Entity("campaign", Campaign, {"world_id": "world"}),
+    _Entity("map", Map, {"world_id": "world", "campaign_id": "campaign"}),
+    _Entity("map_chunk", MapChunk, {"map_id": "map"}),
+    _Entity("segment", CampaignSegment, {"campaign_id": "campaign"}),
+    _Entity("player", Player, {"campaign_id": "campaign"}),
+    _Entity("session", Session, {"campaign_id": "campaign"}),
+    _Entity("log_entry", SessionLogEntry, {"session_id": "session"}),
+    _Entity("summary", SessionSummary, {
+        "session_id": "session", "first_entry_id": "log_entry", "last_entry_id": "log_entry"
+    }),
+    _Entity("player_action", PlayerAction, {"player_id": "player", "session_id": "session"}),
+    _Entity("story_event", StoryEvent, {"campaign_id": "campaign"}),
+]
+ENTITIES_BY_NAME = {entity.name: entity for entity in ENTITIES}
+# Entities other rows point at; their new ids are read back after insert.
+_REFERENCED = {target for entity in ENTITIES for target in entity.foreign_keys.values()}
+
+
+# ----------------------------------------------------------------------
+# Export
+# ----------------------------------------------------------------------
+def _scope_filters(world_id=None, campaign_id=None):
+    """
+    Return {entity name: where clause} for the rows of one world or campaign.
+    Entities without a clause are not exported.
+    """
+    if campaign_id is not None:
+        campaign_ids = [campaign_id]
+        world_filter = World.world_id == select(Campaign.world_id)\
+            .where(Campaign.campaign_id == campaign_id).scalar_subquery()
+        filters = {"world": world_filter, "map": Map.campaign_id == campaign_id}
+        map_ids = select(Map.map_id).where(Map.campaign_id == campaign_id)
+    else:
+        campaign_ids = select(Campaign.campaign_id).where(Campaign.world_id == world_id)
+        filters = {
+            "world": World.world_id == world_id,
+            "npc": Npc.world_id == world_id,
+            "map": or_(Map.world_id == world_id, Map.campaign_id.in_(campaign_ids)),
+        }
+        map_ids = select(Map.map_id).where(filters["map"])
+    session_ids = select(Session.session_id).where(Session.campaign_id.in_(campaign_ids))
+    filters.update({
+        "campaign": Campaign.campaign_id.in_(campaign_ids),
+        "map_chunk": MapChunk.map_id.in_(map_ids),
+        "segment": CampaignSegment.campaign_id.in_(campaign_ids),
+        "player": Player.campaign_id.in_(campaign_ids),
+        "session": Session.campaign_id.in_(campaign_ids),
+        "log_entry": SessionLogEntry.session_id.in_(session_ids),
+        "summary": SessionSummary.session_id.in_(session_ids),
+        "player_action": PlayerAction.session_id.in_(session_ids),
+        "story_event": StoryEvent.campaign_id.in_(campaign_ids),
+    })
+    return filters
+
+
+def _encode_row(entity, row):
+    data = dict(row._mapping)
+    for key in entity.datetime_fields:
+        if data[key] is not None:
+            data[key] = data[key].isoformat()
+    return data
+
+
+def export_archive(world_id=None, campaign_id=None):
+    """
+    Yield the NDJSON lines of a world or campaign archive.
+
+    A campaign archive also carries its world row, so it can be imported
+    on its own; NPCs and world-level maps are only in world archives.
+
+    Args:
+        world_id (int): Export this world and all its campaigns.
+        campaign_id (int): Export only this campaign.
+    """
+    if (world_id is None) == (campaign_id is None):
+        raise ValueError("Pass exactly one of world_id or campaign_id")
+    yield json.dumps({
+        "type": "archive",
+        "version": ARCHIVE_VERSION,
+        "scope": "campaign" if campaign_id is not None else "world",
+        "exported_at": datetime.utcnow().isoformat()
+    }) + "\n"
+
+    filters = _scope_filters(world_id, campaign_id)
+    for entity in ENTITIES:
+        where = filters.get(entity.name)
+        if where is None:
+            continue
+        columns = [column.label(key) for key, column in entity.columns.items()]
+        statement = select(*columns).where(where).order_by(*entity.order_by)
+        result = db.session.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        for row in result:
+            yield json.dumps({"type": entity.name, "data": _encode_row(entity, row)}) + "\n"
+
+
+# ----------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------
+class _Importer:
+    def __init__(self, world_id=None):
+        self.target_world_id = world_id
+        self.id_map = {name: {} for name in _REFERENCED}
+        self.counts = {}
+        self.pending_entity = None
+        self.pending = []  # (old id, row) of pending_entity
+
+    def add(self, record):
+        if not isinstance(record, dict):
+            raise ArchiveError("Every archive line must be a JSON object")
+        kind = record.get("type")
+        if kind == "archive":
+            if record.get("version") != ARCHIVE_VERSION:
+                raise ArchiveError(f"Unsupported archive version: {record.get('version')}")
+            return
+        entity = ENTITIES_BY_NAME.get(kind)
+        if entity is None:
+            raise ArchiveError(f"Unknown record type: {kind}")
+        data = record.get("data")
+        if not isinstance(data, dict):
+            raise ArchiveError(f"Record of type {kind} has no data")
+
+        if entity.name == "world" and self.target_world_id is not None:
+            # Importing into an existing world: its row stands in for the archive's.
+            self.id_map["world"][data.get("world_id")] = self.target_world_id
+            return
+
+        if entity is not self.pending_entity or len(self.pending) >= IMPORT_BATCH_SIZE:
+            self.flush()
+            self.pending_entity = entity
+        old_id = data.get(entity.primary_key) if entity.primary_key else None
+        self.pending.append((old_id, self._row(entity, data)))
+
+    def _row(self, entity, data):
+        row = {}
+        for key, value in data.items():
+            if key == entity.primary_key or key not in entity.columns:
+                continue
+            if value is not None and key in entity.foreign_keys:
+                target = entity.foreign_keys[key]
+                try:
+                    value = self.id_map[target][value]
+                except KeyError:
+                    raise ArchiveError(
+                        f"{entity.name} refers to {target} {value}, which is not in the archive "
+                        "(or comes after it)"
+                    )
+            elif value is not None and key in entity.datetime_fields:
+                try:
+                    value = datetime.fromisoformat(value)
+                except (TypeError, ValueError):
+                    raise ArchiveError(f"Invalid {key} on {entity.name}: {value!r}")
+            elif key in entity.json_fields:
+                # Checked against the column's schema (and plain text from
+                # older archives converted), so JSON filters can rely on it.
+                try:
+                    value = entity.json_fields[key].normalize_text(value)
+                except JSONSchemaError as e:
+                    raise ArchiveError(f"Invalid {key} on {entity.name}: {str(e)}")
+            row[entity.attributes[key]] = value
+        return row
+
+    def flush(self):
+        entity, pending = self.pending_entity, self.pending
+        if not pending:
+            return
+        self.pending = []
+        rows = [row for _, row in pending]
+        if entity.name in _REFERENCED:
+            statement = insert(entity.model).returning(
+                entity.columns[entity.primary_key], sort_by_parameter_order=True
+            )
+            new_ids = db.session.scalars(statement, rows).all()
+            mapping = self.id_map[entity.name]
+            for (old_id, _), new_id in zip(pending, new_ids):
+                if old_id is not None:
+                    mapping[old_id] = new_id
+        else:
+            db.session.execute(insert(entity.model), rows)
+        self.counts[entity.name] = self.counts.get(entity.name, 0) + len(rows)
+
+
+def import_archive(lines, world_id=None):
+    """
+    Import an archive in one transaction.
+
+    Args:
+        lines (iterable): NDJSON lines (str or bytes), e.g. a file or a
+            request stream.
+        world_id (int): Import into this existing world instead of creating
+            the archive's world.
+
+    Returns:
+        dict: {"world_ids": [...], "campaign_ids": [...], "counts": {type: rows}},
+        with the ids assigned to the imported worlds and campaigns.
+
+    Raises:
+        ArchiveError: If the archive is malformed. Nothing is written then.
+    """
+    if world_id is not None and not db.session.get(World, world_id):
+        raise ArchiveError(f"World not found: ID {world_id}")
+    importer = _Importer(world_id)
+    try:
+        for number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ArchiveError(f"Line {number} is not valid JSON: {str(e)}")
+            importer.add(record)
+        importer.flush()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    world_ids = sorted(set(importer.id_map["world"].values()))
+    campaign_ids = sorted(importer.id_map["campaign"].values())
+    logger.info(f"Imported archive: {importer.counts}")
+    return {"world_ids": world_ids, "campaign_ids": campaign_ids, "counts": importer.counts}
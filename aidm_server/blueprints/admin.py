@@ -5,35 +5,146 @@ from aidm_server.models import (
 )
 from flask_admin import Admin
 from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import inspect
+from wtforms.validators import ValidationError
+from aidm_server.database import db
+from aidm_server.jsonfields import json_fields, JSONSchemaError
+from aidm_server.context_cache import dm_context_cache
+from aidm_server.response_cache import response_cache
+from aidm_server.triggers import trigger_engine
+from aidm_server import mapdata
+from aidm_server.mapdata import MapDataError
 
-class CampaignModelView(ModelView):
+# Rows whose GET responses are cached; admin edits must drop them too.
+CACHED_KINDS = {
+    World: "world",
+    Campaign: "campaign",
+    Map: "map",
+    CampaignSegment: "segment",
+    Player: "player",
+}
+
+def _invalidate_actions(player_id):
+    # Recent actions are part of the roster of the player's campaign.
+    player = db.session.get(Player, player_id)
+    if player:
+        dm_context_cache.invalidate_roster(player.campaign_id)
+
+# DM context sections (and compiled segment triggers) built from each model:
+# the attribute holding their key, and what to drop for each of its values.
+CONTEXT_SECTIONS = {
+    World: ("world_id", (dm_context_cache.invalidate_world,)),
+    Campaign: ("campaign_id", (dm_context_cache.invalidate_campaign,)),
+    Player: ("campaign_id", (dm_context_cache.invalidate_roster,)),
+    PlayerAction: ("player_id", (_invalidate_actions,)),
+    CampaignSegment: ("campaign_id", (dm_context_cache.invalidate_segments, trigger_engine.invalidate)),
+    Session: ("session_id", (dm_context_cache.invalidate_session,)),
+    SessionLogEntry: ("session_id", (dm_context_cache.invalidate_session,)),
+}
+
+# Instance __dict__ key of the invalidations to run once the admin's change is committed.
+_PENDING_KEY = "_admin_invalidations"
+
+def _broadcast_reload(map_obj):
+    mapdata.broadcast_map_delta(map_obj.map_id, map_obj.data_version)
+
+class AIDMModelView(ModelView):
+    def __init__(self, model, session, **kwargs):
+        # JSON columns are edited as their JSON text (e.g. the _stats attribute).
+        self._json_fields = json_fields(model)
+        self.column_labels = dict(
+            {field.key: name.replace('_', ' ').title() for name, field in self._json_fields.items()},
+            **(self.column_labels or {})
+        )
+        super().__init__(model, session, **kwargs)
+
+    def on_model_change(self, form, model, is_created):
+        # Hold the text to the same schema as the API does.
+        for name, field in self._json_fields.items():
+            try:
+                text = field.normalize_text(getattr(model, field.key), allow_plain_text=False)
+            except JSONSchemaError as e:
+                raise ValidationError(f"{name}: {str(e)}")
+            setattr(model, field.key, text)
+        self._collect_invalidations(model)
+
+    def on_model_delete(self, model):
+        self._collect_invalidations(model)
+
+    def after_model_change(self, form, model, is_created):
+        self._invalidate_cached(model)
+
+    def after_model_delete(self, model):
+        self._invalidate_cached(model)
+
+    def _collect_invalidations(self, model):
+        # Before the commit the attribute history still has the old values,
+        # e.g. the campaign a segment was moved away from.
+        section = CONTEXT_SECTIONS.get(type(model))
+        if not section:
+            return
+        attribute, invalidators = section
+        history = inspect(model).attrs[attribute].history
+        values = set(history.added or ()) | set(history.unchanged or ()) | set(history.deleted or ())
+        model.__dict__[_PENDING_KEY] = [
+            (invalidate, value) for value in values if value is not None for invalidate in invalidators
+        ]
+
+    def _invalidate_cached(self, model):
+        kind = CACHED_KINDS.get(type(model))
+        if kind:
+            response_cache.invalidate(kind, inspect(model).identity[0])
+        for invalidate, value in model.__dict__.pop(_PENDING_KEY, ()):
+            invalidate(value)
+
+class CampaignModelView(AIDMModelView):
     pass
 
-class PlayerModelView(ModelView):
+class MapModelView(AIDMModelView):
+    def on_model_change(self, form, model, is_created):
+        super().on_model_change(form, model, is_created)
+        if not is_created and not inspect(model).attrs._map_data.history.has_changes():
+            return
+        # Saved like an API update: tiles go to chunks and data_version is
+        # bumped. The form shows the map without its tiles, so they are
+        # kept unless the saved data has a "tiles" member.
+        if is_created:
+            self.session.flush()
+        data = dict(model.map_data or {})
+        if mapdata.TILES_KEY not in data:
+            data[mapdata.TILES_KEY] = mapdata.load_tiles(model.map_id)
+        try:
+            mapdata.replace_map_data(model, data)
+        except MapDataError as e:
+            raise ValidationError(f"map_data: {str(e)}")
+        # Once committed, have watching clients reload the map.
+        model.__dict__.setdefault(_PENDING_KEY, []).append((_broadcast_reload, model))
+
+class PlayerModelView(AIDMModelView):
     pass
 
-class NpcModelView(ModelView):
+class NpcModelView(AIDMModelView):
     pass
 
-class SessionLogEntryModelView(ModelView):
+class SessionLogEntryModelView(AIDMModelView):
     pass
 
-class StoryEventModelView(ModelView):
+class StoryEventModelView(AIDMModelView):
     pass
 
 def configure_admin(app, db):
     admin = Admin(app, name="AI-DM Admin", template_mode="bootstrap3")
-    admin.add_view(ModelView(World, db.session))
+    admin.add_view(AIDMModelView(World, db.session))
     admin.add_view(CampaignModelView(Campaign, db.session))
     admin.add_view(PlayerModelView(Player, db.session))
-    admin.add_view(ModelView(Session, db.session))
+    admin.add_view(AIDMModelView(Session, db.session))
     admin.add_view(NpcModelView(Npc, db.session))
-    admin.add_view(ModelView(PlayerAction, db.session))
-    admin.add_view(ModelView(Map, db.session))
+    admin.add_view(AIDMModelView(PlayerAction, db.session))
+    admin.add_view(MapModelView(Map, db.session))
     admin.add_view(SessionLogEntryModelView(SessionLogEntry, db.session))
 
     # NEW:
-    admin.add_view(ModelView(CampaignSegment, db.session))
+    admin.add_view(AIDMModelView(CampaignSegment, db.session))
     admin.add_view(StoryEventModelView(StoryEvent, db.session))
 
     return admin
@@ -1,17 +1,32 @@
 # campaigns.py
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from aidm_server.database import db
 from aidm_server.models import Campaign
+from aidm_server.context_cache import dm_context_cache
+from aidm_server.archive import export_archive
+from aidm_server.response_cache import response_cache
+from aidm_server.pagination import Projection, PaginationError, paginated_list, list_response
 from datetime import datetime
 import json
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 campaigns_bp = Blueprint("campaigns", __name__)
 
+CAMPAIGN_FIELDS = Projection(Campaign, "campaign_id", {
+    "campaign_id": ("campaign_id", None),
+    "title": ("title", None),
+    "description": ("description", None),
+    "world_id": ("world_id", None),
+    "created_at": ("created_at", "datetime"),
+    "current_quest": ("current_quest", None),
+    "location": ("location", None),
+    "plot_points": ("plot_points", None),
+    "active_npcs": ("active_npcs", None),
+}, optional=("current_quest", "location", "plot_points", "active_npcs"))
+
 @campaigns_bp.route('', methods=['POST'])
 def create_campaign():
     """
@@ -30,11 +45,13 @@ def create_campaign():
         )
         db.session.add(new_campaign)
         db.session.commit()
-        logging.info(f"Campaign created with ID: {new_campaign.campaign_id}")
+        dm_context_cache.invalidate_campaign(new_campaign.campaign_id)
+        response_cache.invalidate("campaign", new_campaign.campaign_id)
+        logger.info(f"Campaign created with ID: {new_campaign.campaign_id}")
         return jsonify({"campaign_id": new_campaign.campaign_id}), 201
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Failed to create campaign: {str(e)}")
+        logger.error(f"Failed to create campaign: {str(e)}")
         return jsonify({"error": "Failed to create campaign"}), 400
 
 @campaigns_bp.route('', methods=['GET'])
@@ -42,52 +59,73 @@ def list_campaigns():
     """
     List all campaigns.
 
+    Supports ?fields=, ?limit= and ?cursor= (see pagination.py); the next
+    page's cursor is returned in the X-Next-Cursor header.
+
     Returns:
         JSON response with a list of campaigns.
     """
     try:
-        campaigns = Campaign.query.all()
-        results = []
-        for c in campaigns:
-            results.append({
-                "campaign_id": c.campaign_id,
-                "title": c.title,
-                "description": c.description,
-                "world_id": c.world_id,
-                "created_at": c.created_at.isoformat() if c.created_at else None
-            })
-        logging.info("Campaigns listed successfully")
-        return jsonify(results)
+        results, next_cursor = paginated_list(Campaign.query, CAMPAIGN_FIELDS, request.args)
+        logger.debug("Campaigns listed successfully")
+        return list_response(results, next_cursor)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logging.error(f"Failed to list campaigns: {str(e)}")
+        logger.error(f"Failed to list campaigns: {str(e)}")
         return jsonify({"error": "Failed to list campaigns"}), 400
 
+def _load_campaign(campaign_id):
+    campaign = db.session.get(Campaign, campaign_id)
+    if not campaign:
+        return None
+    return {
+        "campaign_id": campaign.campaign_id,
+        "title": campaign.title,
+        "description": campaign.description,
+        "world_id": campaign.world_id,
+        "created_at": campaign.created_at.isoformat() if campaign.created_at else None
+    }
+
 @campaigns_bp.route('/<int:campaign_id>', methods=['GET'])
 def get_campaign(campaign_id):
     """
-    Get details of a specific campaign.
+    Get details of a specific campaign (cached, with ETag support).
 
     Args:
         campaign_id (int): The ID of the campaign to retrieve.
 
     Returns:
-        JSON response with the campaign details, or an error message if not found.
+        JSON response with the campaign details, 304 if unchanged since the
+        client's If-None-Match, or an error message if not found.
     """
     try:
-        campaign = db.session.get(Campaign, campaign_id)
-        if not campaign:
-            logging.warning(f"Campaign not found: ID {campaign_id}")
+        response = response_cache.respond("campaign", campaign_id, _load_campaign)
+        if response is None:
+            logger.warning(f"Campaign not found: ID {campaign_id}")
             return jsonify({"error": "Campaign not found"}), 404
-
-        data = {
-            "campaign_id": campaign.campaign_id,
-            "title": campaign.title,
-            "description": campaign.description,
-            "world_id": campaign.world_id,
-            "created_at": campaign.created_at.isoformat() if campaign.created_at else None
-        }
-        logging.info(f"Campaign details retrieved: ID {campaign_id}")
-        return jsonify(data)
+        logger.debug(f"Campaign details retrieved: ID {campaign_id}")
+        return response
     except Exception as e:
-        logging.error(f"Failed to get campaign: {str(e)}")
+        logger.error(f"Failed to get campaign: {str(e)}")
         return jsonify({"error": "Failed to get campaign"}), 400
+
+@campaigns_bp.route('/<int:campaign_id>/export', methods=['GET'])
+def export_campaign(campaign_id):
+    """
+    Stream a campaign with its maps, segments, players, sessions and logs
+    (plus its world row) as an NDJSON archive.
+
+    Args:
+        campaign_id (int): The ID of the campaign to export.
+
+    Returns:
+        An application/x-ndjson stream, or an error message if not found.
+    """
+    if not db.session.get(Campaign, campaign_id):
+        return jsonify({"error": "Campaign not found"}), 404
+    return Response(
+        stream_with_context(export_archive(campaign_id=campaign_id)),
+        mimetype='application/x-ndjson',
+        headers={"Content-Disposition": f"attachment; filename=campaign-{campaign_id}.jsonl"}
+    )
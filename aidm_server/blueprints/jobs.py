@@ -0,0 +1,25 @@
+# jobs.py
+
+from flask import Blueprint, jsonify
+from aidm_server.database import db
+from aidm_server.models import Job
+from aidm_server.jobs import serialize_job
+
+jobs_bp = Blueprint("jobs", __name__)
+
+@jobs_bp.route('/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Get the status of a background job, and its result once it has finished.
+
+    Args:
+        job_id (int): The ID of the job.
+
+    Returns:
+        JSON response with the job's kind, status ("queued", "running",
+        "succeeded" or "failed"), result and error, or 404.
+    """
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(serialize_job(job))
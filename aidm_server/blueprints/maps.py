@@ -2,11 +2,44 @@ from flask import Blueprint, request, jsonify
 from aidm_server.database import db
 from aidm_server.models import Map, World, Campaign
 from datetime import datetime
-import json
 import logging
+from aidm_server.pagination import Projection, PaginationError, paginated_list, list_response
+from aidm_server.response_cache import response_cache
+from aidm_server import mapdata
+from aidm_server.mapdata import MapDataError, MapVersionConflict
+
+logger = logging.getLogger(__name__)
 
 maps_bp = Blueprint("maps", __name__)
 
+class MapProjection(Projection):
+    """
+    Adds the chunked tiles to map_data, for the whole page in one query.
+    """
+
+    def prepare(self, rows, selected):
+        if "map_data" not in selected:
+            return None
+        return mapdata.load_tiles_for_maps([m.map_id for m in rows])
+
+    def serialize(self, obj, selected, context=None):
+        result = super().serialize(obj, selected, context)
+        if "map_data" in result:
+            tiles = context.get(obj.map_id) if context else None
+            result["map_data"] = mapdata.merge_map_data(result["map_data"] or {}, tiles)
+        return result
+
+MAP_FIELDS = MapProjection(Map, "map_id", {
+    "map_id": ("map_id", None),
+    "world_id": ("world_id", None),
+    "campaign_id": ("campaign_id", None),
+    "title": ("title", None),
+    "description": ("description", None),
+    "map_data": ("map_data", None),
+    "data_version": ("data_version", None),
+    "created_at": ("created_at", "datetime"),
+}, optional=("map_data", "data_version"))
+
 @maps_bp.route('', methods=['POST'])
 def create_map():
     """
@@ -18,21 +51,29 @@ def create_map():
             world_id=data.get('world_id'),
             campaign_id=data.get('campaign_id'),
             title=data['title'],
-            description=data.get('description', ''),
-            map_data=json.dumps(data.get('map_data', {}))
+            description=data.get('description', '')
         )
         db.session.add(new_map)
+        db.session.flush()
+        mapdata.replace_map_data(new_map, data.get('map_data', {}))
         db.session.commit()
+        response_cache.invalidate("map", new_map.map_id)
         return jsonify({"map_id": new_map.map_id}), 201
+    except MapDataError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Failed to create map: {str(e)}")
+        logger.error(f"Failed to create map: {str(e)}")
         return jsonify({"error": "Failed to create map"}), 400
 
 @maps_bp.route('', methods=['GET'])
 def list_maps():
     """
     List all maps or optionally filter by world/campaign.
+
+    map_data is only included (and parsed) when asked for with
+    ?fields=...,map_data. Supports ?limit= and ?cursor= paging.
     """
     world_id = request.args.get('world_id')
     campaign_id = request.args.get('campaign_id')
@@ -43,40 +84,42 @@ def list_maps():
     if campaign_id:
         query = query.filter_by(campaign_id=campaign_id)
 
-    maps = query.all()
-    results = []
-    for m in maps:
-        results.append({
-            "map_id": m.map_id,
-            "world_id": m.world_id,
-            "campaign_id": m.campaign_id,
-            "title": m.title,
-            "description": m.description,
-            "map_data": json.loads(m.map_data) if m.map_data else {},
-            "created_at": m.created_at.isoformat() if m.created_at else None
-        })
-    return jsonify(results)
+    try:
+        results, next_cursor = paginated_list(query, MAP_FIELDS, request.args)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
+    return list_response(results, next_cursor)
+
+def _load_map(map_id):
+    m = db.session.get(Map, map_id)
+    if not m:
+        return None
+    return {
+        "map_id": m.map_id,
+        "world_id": m.world_id,
+        "campaign_id": m.campaign_id,
+        "title": m.title,
+        "description": m.description,
+        "map_data": mapdata.load_map_data(m),
+        "data_version": m.data_version,
+        "created_at": m.created_at.isoformat() if m.created_at else None
+    }
 
 @maps_bp.route('/<int:map_id>', methods=['GET'])
 def get_map(map_id):
     """
     Get details of a specific map.
+
+    The serialized map (map_data included) is cached until the map changes;
+    send If-None-Match with the last ETag to get a 304 instead of the body.
     """
     try:
-        m = db.session.get(Map, map_id)
-        if not m:
+        response = response_cache.respond("map", map_id, _load_map)
+        if response is None:
             return jsonify({"error": "Map not found"}), 404
-        return jsonify({
-            "map_id": m.map_id,
-            "world_id": m.world_id,
-            "campaign_id": m.campaign_id,
-            "title": m.title,
-            "description": m.description,
-            "map_data": json.loads(m.map_data) if m.map_data else {},
-            "created_at": m.created_at.isoformat() if m.created_at else None
-        })
+        return response
     except Exception as e:
-        logging.error(f"Failed to get map: {str(e)}")
+        logger.error(f"Failed to get map: {str(e)}")
         return jsonify({"error": "Failed to get map"}), 400
 
 @maps_bp.route('/<int:map_id>', methods=['PUT', 'PATCH'])
@@ -92,10 +135,93 @@ def update_map(map_id):
         m.title = data.get('title', m.title)
         m.description = data.get('description', m.description)
         if 'map_data' in data:
-            m.map_data = json.dumps(data['map_data'])
+            mapdata.replace_map_data(m, data['map_data'])
         db.session.commit()
+        response_cache.invalidate("map", map_id)
+        if 'map_data' in data:
+            mapdata.broadcast_map_delta(map_id, m.data_version)
         return jsonify({"message": "Map updated successfully"}), 200
+    except MapDataError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Failed to update map: {str(e)}")
+        return jsonify({"error": "Failed to update map"}), 400
+
+@maps_bp.route('/<int:map_id>/data', methods=['GET'])
+def get_map_data(map_id):
+    """
+    Read a map's data without the tiles, plus the tiles of one region.
+
+    Query parameters:
+        region (str): "x0,y0,x1,y1", inclusive. Only the tiles inside it are
+            returned, and only the chunks overlapping it are read.
+            Without it no tiles are returned.
+
+    Returns:
+        JSON response with map_id, version, chunk_size, data (map_data
+        without tiles) and tiles ({"x,y": tile}) for the region.
+    """
+    m = db.session.get(Map, map_id)
+    if not m:
+        return jsonify({"error": "Map not found"}), 404
+    try:
+        region = mapdata.parse_region(request.args['region']) if request.args.get('region') else None
+        meta, tiles = mapdata.read_region(m, region)
+        result = {
+            "map_id": map_id,
+            "version": m.data_version,
+            "chunk_size": mapdata.CHUNK_SIZE,
+            "data": meta
+        }
+        if tiles is not None:
+            result["tiles"] = tiles
+        return jsonify(result)
+    except MapDataError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Failed to read map data: {str(e)}")
+        return jsonify({"error": "Failed to read map data"}), 400
+
+@maps_bp.route('/<int:map_id>/data', methods=['PATCH'])
+def patch_map_data(map_id):
+    """
+    Apply a JSON Patch (RFC 6902 add, remove, replace and test operations)
+    to a map's data, e.g.
+
+        [{"op": "replace", "path": "/tiles/10,4", "value": {"terrain": "water"}},
+         {"op": "replace", "path": "/tokens/0/x", "value": 12}]
+
+    The body is the list of operations, or {"ops": [...], "version": N} to
+    apply it only if the map is still at version N (409 otherwise). The
+    patch is applied atomically, and the applied operations are sent to
+    clients watching the map as a map_delta event.
+
+    Returns:
+        JSON response with the map's new version.
+    """
+    if not db.session.get(Map, map_id):
+        return jsonify({"error": "Map not found"}), 404
+    body = request.get_json(force=True, silent=True)
+    base_version = None
+    if isinstance(body, dict):
+        base_version = body.get('version')
+        body = body.get('ops')
+    try:
+        version, applied = mapdata.apply_patch(map_id, body, base_version=base_version)
+        db.session.commit()
+    except MapVersionConflict as e:
+        db.session.rollback()
+        return jsonify({"error": str(e), "version": e.current_version}), 409
+    except MapDataError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Failed to update map: {str(e)}")
-        return jsonify({"error": "Failed to update map"}), 400
\ No newline at end of file
+        logger.error(f"Failed to patch map data: {str(e)}")
+        return jsonify({"error": "Failed to patch map data"}), 400
+    response_cache.invalidate("map", map_id)
+    if applied:
+        mapdata.broadcast_map_delta(map_id, version, applied)
+    return jsonify({"map_id": map_id, "version": version})
@@ -0,0 +1,13 @@
+# metrics.py
+
+from flask import Blueprint, Response
+from aidm_server.metrics import registry
+
+metrics_bp = Blueprint("metrics", __name__)
+
+@metrics_bp.route('', methods=['GET'])
+def scrape_metrics():
+    """
+    Expose process metrics in the Prometheus text format.
+    """
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
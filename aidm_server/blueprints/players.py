@@ -3,10 +3,30 @@
 from flask import Blueprint, request, jsonify
 import logging
 from aidm_server.database import db
+from aidm_server.jsonfields import json_contains
 from aidm_server.models import Player, Campaign
+from aidm_server.context_cache import dm_context_cache
+from aidm_server.pagination import Projection, PaginationError, paginated_list, list_response
+from aidm_server.response_cache import response_cache
+
+logger = logging.getLogger(__name__)
 
 players_bp = Blueprint("players", __name__)
 
+PLAYER_FIELDS = Projection(Player, "player_id", {
+    "player_id": ("player_id", None),
+    "campaign_id": ("campaign_id", None),
+    "name": ("name", None),
+    "character_name": ("character_name", None),
+    "race": ("race", None),
+    "class_": ("class_", None),
+    "level": ("level", None),
+    "stats": ("stats", None),
+    "inventory": ("inventory", None),
+    "character_sheet": ("character_sheet", None),
+    "created_at": ("created_at", "datetime"),
+}, optional=("stats", "inventory", "character_sheet", "created_at"))
+
 @players_bp.route('/campaigns/<int:campaign_id>/players', methods=['GET', 'POST'])
 def handle_players(campaign_id):
     """
@@ -50,19 +70,26 @@ def add_player(campaign_id):
         )
         db.session.add(new_player)
         db.session.commit()
+        dm_context_cache.invalidate_roster(campaign_id)
+        response_cache.invalidate("player", new_player.player_id)
         return jsonify({
             "player_id": new_player.player_id,
             "message": "Player successfully created"
         }), 201
     except Exception as e:
         db.session.rollback()
-        logging.error("Failed to create player: %s", str(e))
+        logger.error("Failed to create player: %s", str(e))
         return jsonify({"error": "Failed to create player"}), 400
 
 def get_players(campaign_id):
     """
     Get all players in a specific campaign.
 
+    stats, inventory and character_sheet are only returned when asked for
+    with ?fields=. ?class=wizard keeps the players of a class and
+    ?item=rope those carrying an item (by name). Supports ?limit= and
+    ?cursor= paging.
+
     Args:
         campaign_id (int): The ID of the campaign.
 
@@ -70,33 +97,24 @@ def get_players(campaign_id):
         JSON response with a list of players.
     """
     try:
-        players = Player.query.filter_by(campaign_id=campaign_id).all()
-        results = []
-        for p in players:
-            results.append({
-                "player_id": p.player_id,
-                "campaign_id": p.campaign_id,
-                "name": p.name,
-                "character_name": p.character_name,
-                "race": p.race,
-                "class_": p.class_,
-                "level": p.level
-            })
-        return jsonify(results)
+        query = Player.query.filter_by(campaign_id=campaign_id)
+        if request.args.get('class'):
+            query = query.filter(db.func.lower(Player.class_) == request.args['class'].lower())
+        for item in request.args.getlist('item'):
+            query = query.filter(json_contains(Player.inventory, item, member="name"))
+        results, next_cursor = paginated_list(query, PLAYER_FIELDS, request.args)
+        return list_response(results, next_cursor)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logging.error("Failed to get players: %s", str(e))
+        logger.error("Failed to get players: %s", str(e))
         return jsonify({"error": "Failed to get players"}), 400
 
-@players_bp.route('/<int:player_id>', methods=['GET'])
-def get_player_by_id(player_id):
-    """
-    Retrieve a single player by player_id.
-    """
+def _load_player(player_id):
     player = db.session.get(Player, player_id)
     if not player:
-        return jsonify({"error": "Player not found"}), 404
-    
-    return jsonify({
+        return None
+    return {
         "player_id": player.player_id,
         "campaign_id": player.campaign_id,
         "name": player.name,
@@ -107,5 +125,14 @@ def get_player_by_id(player_id):
         "stats": player.stats,
         "inventory": player.inventory,
         "character_sheet": player.character_sheet,
-    })
-    
+    }
+
+@players_bp.route('/<int:player_id>', methods=['GET'])
+def get_player_by_id(player_id):
+    """
+    Retrieve a single player by player_id (cached, with ETag support).
+    """
+    response = response_cache.respond("player", player_id, _load_player)
+    if response is None:
+        return jsonify({"error": "Player not found"}), 404
+    return response
@@ -0,0 +1,73 @@
+# search.py
+
+from flask import Blueprint, request, jsonify
+import logging
+from aidm_server.database import db
+from aidm_server.models import Campaign
+from aidm_server.pagination import PaginationError, decode_cursor, encode_cursor, list_response, parse_limit
+from aidm_server import search
+
+logger = logging.getLogger(__name__)
+
+search_bp = Blueprint("search", __name__)
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+@search_bp.route('', methods=['GET'])
+def search_campaign():
+    """
+    Full-text search of a campaign: its session logs, segments and lore,
+    and the NPCs of its world.
+
+    Query parameters:
+        campaign_id (int): Required.
+        q (str): Required. Words to find (all of them); "smith*" matches prefixes.
+        kind (str): Comma separated kinds to return: log, npc, segment, campaign.
+        session_id (int): Only this session's log entries.
+        limit, cursor: Paging, as on the list endpoints.
+
+    Returns:
+        JSON list of hits, best first, each with kind, id, campaign_id,
+        session_id, title, snippet (matches in [brackets]), text, timestamp
+        and score; the next page's cursor is in the X-Next-Cursor header.
+        400 for bad parameters, 404 for an unknown campaign, 501 if the
+        database has no search index, 500 if the search itself fails.
+    """
+    campaign_id = request.args.get('campaign_id', type=int)
+    session_id = request.args.get('session_id', type=int)
+    query = request.args.get('q', '')
+    if campaign_id is None or not query.strip():
+        return jsonify({"error": "campaign_id and q are required"}), 400
+    kinds = [kind.strip() for kind in request.args.get('kind', '').split(',') if kind.strip()]
+    unknown = [kind for kind in kinds if kind not in search.KINDS]
+    if unknown:
+        return jsonify({"error": f"Unknown kind: {', '.join(unknown)}"}), 400
+    if session_id is not None:
+        kinds = ["log"]
+
+    try:
+        limit = parse_limit(request.args.get('limit'), DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT)
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor, 2) if cursor else None
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
+
+    campaign = db.session.get(Campaign, campaign_id)
+    if not campaign:
+        return jsonify({"error": "Campaign not found"}), 404
+    match = search.match_expression(
+        query, search.campaign_scope(campaign_id, campaign.world_id, session_id)
+    )
+    if match is None:
+        return list_response([], None)
+
+    try:
+        hits, next_key = search.search(match, kinds=kinds, limit=limit, after=after)
+        return list_response(hits, encode_cursor(*next_key) if next_key else None)
+    except search.SearchUnavailable as e:
+        return jsonify({"error": str(e)}), 501
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Search failed for campaign {campaign_id}: {str(e)}")
+        return jsonify({"error": "Search failed"}), 500
@@ -3,68 +3,97 @@ from flask import Blueprint, request, jsonify
 import logging
 from aidm_server.database import db
 from aidm_server.models import CampaignSegment
+from aidm_server.context_cache import dm_context_cache
+from aidm_server.pagination import Projection, PaginationError, paginated_list, list_response
+from aidm_server.response_cache import response_cache
+from aidm_server.triggers import compile_condition, split_tags, TriggerSyntaxError, trigger_engine
+from aidm_server.jsonfields import json_contains, JSONSchemaError
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 segments_bp = Blueprint("segments", __name__)
 
+SEGMENT_FIELDS = Projection(CampaignSegment, "segment_id", {
+    "segment_id": ("segment_id", None),
+    "campaign_id": ("campaign_id", None),
+    "title": ("title", None),
+    "description": ("description", None),
+    "trigger_condition": ("trigger_condition", None),
+    "tags": ("tags", None),
+    "is_triggered": ("is_triggered", None),
+    "created_at": ("created_at", "datetime"),
+}, optional=("created_at",))
+
+def _parse_tags(tags):
+    """
+    Tags as a list; older clients send them as comma separated text.
+    """
+    if isinstance(tags, str):
+        return split_tags(tags)
+    return tags
+
 @segments_bp.route('', methods=['POST'])
 def create_segment():
     """
     Create a new campaign segment for a given campaign.
+
+    tags is a list of keywords (comma separated text is accepted too).
     """
     data = request.json
+    tags = _parse_tags(data.get('tags'))
+    try:
+        compile_condition(data.get('trigger_condition'), tags)
+    except TriggerSyntaxError as e:
+        return jsonify({"error": f"Invalid trigger_condition: {str(e)}"}), 400
+
     try:
         new_segment = CampaignSegment(
             campaign_id=data['campaign_id'],
             title=data['title'],
             description=data.get('description', ''),
             trigger_condition=data.get('trigger_condition', ''),
-            tags=data.get('tags', '')
+            tags=tags
         )
         db.session.add(new_segment)
         db.session.commit()
-        logging.info(f"Campaign Segment created with ID: {new_segment.segment_id}")
+        response_cache.invalidate("segment", new_segment.segment_id)
+        dm_context_cache.invalidate_segments(new_segment.campaign_id)
+        trigger_engine.invalidate(new_segment.campaign_id)
+        logger.info(f"Campaign Segment created with ID: {new_segment.segment_id}")
         return jsonify({"segment_id": new_segment.segment_id}), 201
+    except JSONSchemaError as e:
+        db.session.rollback()
+        return jsonify({"error": f"Invalid tags: {str(e)}"}), 400
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Failed to create segment: {str(e)}")
+        logger.error(f"Failed to create segment: {str(e)}")
         return jsonify({"error": "Failed to create segment"}), 400
 
 @segments_bp.route('', methods=['GET'])
 def list_segments():
     """
-    List all segments or optionally filter by campaign_id.
+    List all segments or optionally filter by campaign_id and by tag
+    (?tag=dragon; repeat it for segments with all of the tags).
+    Supports ?fields=, ?limit= and ?cursor=.
     """
     campaign_id = request.args.get('campaign_id')
     query = CampaignSegment.query
     if campaign_id:
         query = query.filter_by(campaign_id=campaign_id)
+    for tag in request.args.getlist('tag'):
+        query = query.filter(json_contains(CampaignSegment.tags, tag))
 
-    segments = query.all()
-    results = []
-    for seg in segments:
-        results.append({
-            "segment_id": seg.segment_id,
-            "campaign_id": seg.campaign_id,
-            "title": seg.title,
-            "description": seg.description,
-            "trigger_condition": seg.trigger_condition,
-            "tags": seg.tags,
-            "is_triggered": seg.is_triggered
-        })
-    return jsonify(results), 200
+    try:
+        results, next_cursor = paginated_list(query, SEGMENT_FIELDS, request.args)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
+    return list_response(results, next_cursor), 200
 
-@segments_bp.route('/<int:segment_id>', methods=['GET'])
-def get_segment(segment_id):
-    """
-    Retrieve details of a specific segment by ID.
-    """
+def _load_segment(segment_id):
     seg = db.session.get(CampaignSegment, segment_id)
     if not seg:
-        return jsonify({"error": "Segment not found"}), 404
-
-    return jsonify({
+        return None
+    return {
         "segment_id": seg.segment_id,
         "campaign_id": seg.campaign_id,
         "title": seg.title,
@@ -72,7 +101,17 @@ def get_segment(segment_id):
         "trigger_condition": seg.trigger_condition,
         "tags": seg.tags,
         "is_triggered": seg.is_triggered
-    }), 200
+    }
+
+@segments_bp.route('/<int:segment_id>', methods=['GET'])
+def get_segment(segment_id):
+    """
+    Retrieve details of a specific segment by ID (cached, with ETag support).
+    """
+    response = response_cache.respond("segment", segment_id, _load_segment)
+    if response is None:
+        return jsonify({"error": "Segment not found"}), 404
+    return response
 
 @segments_bp.route('/<int:segment_id>', methods=['PUT', 'PATCH'])
 def update_segment(segment_id):
@@ -84,19 +123,34 @@ def update_segment(segment_id):
         return jsonify({"error": "Segment not found"}), 404
 
     data = request.json
+    tags = _parse_tags(data['tags']) if 'tags' in data else seg.tags
+    if 'trigger_condition' in data:
+        try:
+            compile_condition(data['trigger_condition'], tags)
+        except TriggerSyntaxError as e:
+            return jsonify({"error": f"Invalid trigger_condition: {str(e)}"}), 400
+
     try:
         seg.title = data.get('title', seg.title)
         seg.description = data.get('description', seg.description)
         seg.trigger_condition = data.get('trigger_condition', seg.trigger_condition)
-        seg.tags = data.get('tags', seg.tags)
+        if 'tags' in data:
+            seg.tags = tags
         if 'is_triggered' in data:
             seg.is_triggered = data['is_triggered']
 
         db.session.commit()
+        campaign_id = seg.campaign_id
+        response_cache.invalidate("segment", segment_id)
+        dm_context_cache.invalidate_segments(campaign_id)
+        trigger_engine.invalidate(campaign_id)
         return jsonify({"message": "Segment updated successfully"}), 200
+    except JSONSchemaError as e:
+        db.session.rollback()
+        return jsonify({"error": f"Invalid tags: {str(e)}"}), 400
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Failed to update segment: {str(e)}")
+        logger.error(f"Failed to update segment: {str(e)}")
         return jsonify({"error": "Failed to update segment"}), 400
 
 @segments_bp.route('/<int:segment_id>', methods=['DELETE'])
@@ -109,10 +163,14 @@ def delete_segment(segment_id):
         return jsonify({"error": "Segment not found"}), 404
 
     try:
+        campaign_id = seg.campaign_id
         db.session.delete(seg)
         db.session.commit()
+        response_cache.invalidate("segment", segment_id)
+        dm_context_cache.invalidate_segments(campaign_id)
+        trigger_engine.invalidate(campaign_id)
         return jsonify({"message": "Segment deleted"}), 200
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Failed to delete segment: {str(e)}")
+        logger.error(f"Failed to delete segment: {str(e)}")
         return jsonify({"error": "Failed to delete segment"}), 400
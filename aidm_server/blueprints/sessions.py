@@ -1,21 +1,64 @@
 # sessions.py
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from aidm_server.database import db
-from aidm_server.models import Session, get_full_session_log
-from datetime import datetime
+from aidm_server.models import Session, session_log_query, iter_session_log
+from aidm_server.pagination import (
+    Projection, PaginationError, parse_limit, encode_cursor, decode_cursor,
+    paginated_list, list_response
+)
+from aidm_server import jobs
+from aidm_server.rounds import TURN_MODES, MAX_ROUND_WINDOW
+from aidm_server.prompts import prefix_registry
+import json
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 sessions_bp = Blueprint("sessions", __name__)
 
+SESSION_FIELDS = Projection(Session, "session_id", {
+    "session_id": ("session_id", None),
+    "campaign_id": ("campaign_id", None),
+    "created_at": ("created_at", "datetime"),
+    "state_snapshot": ("state_snapshot", None),
+    "turn_mode": ("turn_mode", None),
+    "round_window_seconds": ("round_window_seconds", None),
+}, optional=("state_snapshot",))
+
+def _turn_settings(data):
+    """
+    Validate the turn_mode and round_window_seconds fields of a request.
+
+    Returns:
+        dict: The fields present in data, ready to set on a Session.
+
+    Raises:
+        ValueError: If a value is invalid.
+    """
+    settings = {}
+    if 'turn_mode' in data:
+        if data['turn_mode'] not in TURN_MODES:
+            raise ValueError(f"turn_mode must be one of: {', '.join(TURN_MODES)}")
+        settings['turn_mode'] = data['turn_mode']
+    if 'round_window_seconds' in data:
+        window = data['round_window_seconds']
+        if window is not None:
+            if isinstance(window, bool) or not isinstance(window, (int, float)) \
+                    or not 0 < window <= MAX_ROUND_WINDOW:
+                raise ValueError(f"round_window_seconds must be between 0 and {MAX_ROUND_WINDOW:g}")
+            window = float(window)
+        settings['round_window_seconds'] = window
+    return settings
+
 @sessions_bp.route('/start', methods=['POST'])
 def start_new_session():
     """
     Start a new session for a given campaign.
 
+    Optional turn_mode ("message" or "round") and round_window_seconds
+    choose how the DM answers; see update_session.
+
     Returns:
         JSON response with the new session ID and status code 201 on success,
         or an error message and status code 400 on failure.
@@ -23,58 +66,114 @@ def start_new_session():
     data = request.json
     campaign_id = data['campaign_id']
     try:
-        new_session = Session(campaign_id=campaign_id)
+        settings = _turn_settings(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        new_session = Session(campaign_id=campaign_id, **settings)
         db.session.add(new_session)
         db.session.commit()
-        logging.info(f"Session started with ID: {new_session.session_id}")
+        logger.info(f"Session started with ID: {new_session.session_id}")
         return jsonify({"session_id": new_session.session_id}), 201
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Failed to start session: {str(e)}")
+        logger.error(f"Failed to start session: {str(e)}")
         return jsonify({"error": "Failed to start session"}), 400
 
-@sessions_bp.route('/<int:session_id>/end', methods=['POST'])
-def end_game_session(session_id):
+@sessions_bp.route('/<int:session_id>', methods=['PATCH'])
+def update_session(session_id):
     """
-    End a game session and provide a recap.
+    Change how the DM answers in a session.
 
-    Args:
-        session_id (int): The ID of the session to end.
+    In "message" mode (the default) every chat message gets its own DM
+    response. In "round" mode actions are collected until every active
+    player has acted or round_window_seconds have passed (null for the
+    server default), then answered together in one response.
 
     Returns:
-        JSON response with the session recap, or an error message if not found.
+        JSON response with the session's turn settings.
     """
     session_obj = db.session.get(Session, session_id)
     if not session_obj:
-        logging.warning(f"Session not found: ID {session_id}")
+        logger.warning(f"Session not found: ID {session_id}")
         return jsonify({"error": "Session not found"}), 404
+    try:
+        settings = _turn_settings(request.get_json(force=True, silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        for key, value in settings.items():
+            setattr(session_obj, key, value)
+        db.session.commit()
+        logger.info(f"Session {session_id} turn settings updated: {settings}")
+        return jsonify({
+            "session_id": session_id,
+            "turn_mode": session_obj.turn_mode,
+            "round_window_seconds": session_obj.round_window_seconds
+        })
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Failed to update session: {str(e)}")
+        return jsonify({"error": "Failed to update session"}), 400
 
-    full_log = get_full_session_log(session_id)
-    
-    from aidm_server.llm import query_gpt
+def _accepted(job):
+    return jsonify({
+        "job_id": job.job_id,
+        "status": job.status,
+        "status_url": f"/api/jobs/{job.job_id}"
+    }), 202, {"Location": f"/api/jobs/{job.job_id}"}
 
-    recap_prompt = (
-        "Please provide a concise summary of this D&D session, highlighting key events, "
-        "important decisions, and any significant character developments:\n\n" + full_log
-    )
+def _enqueue_session_job(session_id, kind, action):
+    if not db.session.get(Session, session_id):
+        logger.warning(f"Session not found: ID {session_id}")
+        return jsonify({"error": "Session not found"}), 404
     try:
-        recap = query_gpt(prompt=recap_prompt, system_message="You are a D&D session summarizer.")
-        session_obj.state_snapshot = jsonify({
-            "recap": recap,
-            "ended_at": datetime.utcnow().isoformat()
-        }).data.decode("utf-8")
-        db.session.commit()
-        logging.info(f"Session ended with ID: {session_id}")
-        return jsonify({"recap": recap})
+        job = jobs.enqueue(
+            kind, {"session_id": session_id},
+            key=f"session:{session_id}", room=str(session_id)
+        )
     except Exception as e:
-        logging.error(f"Failed to end session: {str(e)}")
-        return jsonify({"error": "Failed to end session"}), 400
+        db.session.rollback()
+        logger.error(f"Failed to {action}: {str(e)}")
+        return jsonify({"error": f"Failed to {action}"}), 400
+    return _accepted(job)
+
+@sessions_bp.route('/<int:session_id>/end', methods=['POST'])
+def end_game_session(session_id):
+    """
+    End a game session. The recap is generated in the background.
+
+    Args:
+        session_id (int): The ID of the session to end.
+
+    Returns:
+        202 with the job ID of the recap job, or an error message if not found.
+        The finished job's result holds the recap, which is also stored in
+        the session's state_snapshot and announced with job_finished.
+    """
+    return _enqueue_session_job(session_id, "session_recap", "end session")
+
+@sessions_bp.route('/<int:session_id>/summarize', methods=['POST'])
+def summarize_session(session_id):
+    """
+    Fold the session log into rolling summaries in the background.
+
+    Args:
+        session_id (int): The ID of the session.
+
+    Returns:
+        202 with the job ID, or an error message if not found.
+    """
+    return _enqueue_session_job(session_id, "session_summaries", "summarize session")
 
 @sessions_bp.route('/campaigns/<int:campaign_id>/sessions', methods=['GET'])
 def list_campaign_sessions(campaign_id):
     """
     List all sessions for a specific campaign.
 
+    state_snapshot is only returned when asked for with ?fields=.
+    Supports ?limit= and ?cursor= paging.
+
     Args:
         campaign_id (int): The ID of the campaign.
 
@@ -82,17 +181,98 @@ def list_campaign_sessions(campaign_id):
         JSON response with a list of sessions.
     """
     try:
-        sessions = Session.query.filter_by(campaign_id=campaign_id).all()
-        results = []
-        for s in sessions:
-            results.append({
-                "session_id": s.session_id,
-                "campaign_id": s.campaign_id,
-                "created_at": s.created_at.isoformat() if s.created_at else None,
-                "state_snapshot": s.state_snapshot
-            })
-        logging.info(f"Sessions listed for campaign ID: {campaign_id}")
-        return jsonify(results)
+        query = Session.query.filter_by(campaign_id=campaign_id)
+        results, next_cursor = paginated_list(query, SESSION_FIELDS, request.args)
+        logger.debug(f"Sessions listed for campaign ID: {campaign_id}")
+        return list_response(results, next_cursor)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logging.error(f"Failed to list sessions: {str(e)}")
+        logger.error(f"Failed to list sessions: {str(e)}")
         return jsonify({"error": "Failed to list sessions"}), 400
+
+@sessions_bp.route('/<int:session_id>/prompt-stats', methods=['GET'])
+def get_prompt_stats(session_id):
+    """
+    Report how often this session's DM prompts reused a known prompt
+    prefix (counted by this server process since it started).
+
+    Returns:
+        JSON response with prompts, reused, reuse_rate, prefix_changes,
+        the current prefix_hash and prefix_chars, and whether that prefix
+        is cached by the LLM provider.
+    """
+    if not db.session.get(Session, session_id):
+        logger.warning(f"Session not found: ID {session_id}")
+        return jsonify({"error": "Session not found"}), 404
+    stats = prefix_registry.session_stats(session_id) or {
+        "prompts": 0, "reused": 0, "reuse_rate": 0.0, "prefix_changes": 0,
+        "prefix_hash": None, "prefix_chars": None, "provider_cached": False
+    }
+    return jsonify(dict(stats, session_id=session_id))
+
+def _serialize_log_entry(entry):
+    return {
+        "id": entry.id,
+        "session_id": entry.session_id,
+        "entry_type": entry.entry_type,
+        "message": entry.message,
+        "timestamp": entry.timestamp.isoformat() if entry.timestamp else None,
+        "cursor": encode_cursor(entry.timestamp, entry.id)
+    }
+
+@sessions_bp.route('/<int:session_id>/log', methods=['GET'])
+def get_session_log(session_id):
+    """
+    Read a session's log with keyset pagination on (timestamp, id).
+
+    Query parameters:
+        limit (int): Page size (default 100, max 500).
+        cursor / since (str): Return only entries after this cursor. Every entry
+            and every page carries a cursor; clients poll with since=<next_cursor>
+            to fetch only new entries.
+        order (str): "asc" (default) or "desc" for newest-first pages.
+        format (str): "ndjson" streams every matching entry, one JSON object per
+            line, for exports. limit and order are ignored in this mode.
+
+    Returns:
+        JSON response with the entries and the cursor for the next request,
+        or an NDJSON stream.
+    """
+    if not db.session.get(Session, session_id):
+        return jsonify({"error": "Session not found"}), 404
+
+    try:
+        raw_cursor = request.args.get('cursor') or request.args.get('since')
+        after = decode_cursor(raw_cursor, 2) if raw_cursor else None
+        limit = parse_limit(request.args.get('limit'))
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            for entry in iter_session_log(session_id, after=after):
+                yield json.dumps(_serialize_log_entry(entry)) + "\n"
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    descending = request.args.get('order', 'asc') == 'desc'
+    try:
+        rows = session_log_query(session_id, after, descending=descending).limit(limit + 1).all()
+    except Exception as e:
+        logger.error(f"Failed to read session log: {str(e)}")
+        return jsonify({"error": "Failed to read session log"}), 400
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    entries = [_serialize_log_entry(entry) for entry in rows]
+    if entries:
+        next_cursor = entries[-1]["cursor"]
+    else:
+        # Nothing new: hand the same position back so polling can continue.
+        next_cursor = raw_cursor
+    return jsonify({
+        "session_id": session_id,
+        "entries": entries,
+        "next_cursor": next_cursor,
+        "has_more": has_more
+    })
@@ -1,9 +1,12 @@
 # socketio_events.py
 
 import json
+import logging
+import time
 from datetime import datetime
 from flask import request
 from flask_socketio import join_room, leave_room, emit
+from sqlalchemy import update
 from aidm_server.database import db
 from aidm_server.models import (
     Player, Session, PlayerAction, SessionLogEntry,
@@ -12,13 +15,26 @@ from aidm_server.models import (
 from aidm_server.llm import (
     query_dm_function,
     query_dm_function_stream,
+    query_gpt,
     build_dm_context
 )
+from aidm_server import memory
+from aidm_server.context_cache import dm_context_cache
+from aidm_server.presence import get_presence_store
+from aidm_server.response_cache import response_cache
+from aidm_server.rounds import round_collector, round_window
+from aidm_server.streaming import ChunkRelay
+from aidm_server.triggers import TriggerContext, trigger_engine
+from aidm_server.logging_config import log_payload
+from aidm_server.metrics import (
+    DM_ROUND_ACTIONS, DM_ROUNDS, SEND_MESSAGES, observe_stage, stage_timer
+)
+from aidm_server.workers import KeyedWorkerPool, QueueFullError
+
+logger = logging.getLogger(__name__)
 
-# Track active players across sessions: { session_id: { player_id: {...player_data...} } }
-active_players = {}
-# Track which session/player each socket connection belongs to: { request.sid: {'session_id': x, 'player_id': y} }
-socketio_connections = {}
+# DM generations run here, one at a time per session, bounded overall.
+generation_pool = KeyedWorkerPool("dm-generation", max_workers=4, max_pending_per_key=8)
 
 def get_player_data(player_id):
     """
@@ -34,6 +50,166 @@ def get_player_data(player_id):
         'name': player.name,
     }
 
+def _claim_segments(segment_ids):
+    """
+    Mark segments as triggered and return the ids this transaction
+    flipped: another server process may have fired some of them already.
+    """
+    untriggered = CampaignSegment.is_triggered.is_(False)
+    if db.engine.dialect.update_returning:
+        rows = db.session.execute(
+            update(CampaignSegment)
+            .where(CampaignSegment.segment_id.in_(segment_ids), untriggered)
+            .values(is_triggered=True)
+            .returning(CampaignSegment.segment_id),
+            execution_options={"synchronize_session": False}
+        )
+        return {segment_id for segment_id, in rows}
+    claimed = set()
+    for segment_id in segment_ids:
+        if CampaignSegment.query.filter(CampaignSegment.segment_id == segment_id, untriggered)\
+                .update({CampaignSegment.is_triggered: True}, synchronize_session=False):
+            claimed.add(segment_id)
+    return claimed
+
+def generate_dm_response(socketio, session_id, world_id, campaign_id, user_input, speaking_player,
+                         pre_llm_db_time=0.0, acting_players=None):
+    """
+    Stream a DM response to the session room and store it in the log.
+    Runs on the generation pool, inside an app context.
+
+    pre_llm_db_time is the time the handler spent in its own transaction;
+    it is added to this job's DB time for the per-message log line.
+    For a round, speaking_player is None and acting_players lists the
+    players whose actions are in user_input.
+    """
+    room = str(session_id)
+    context_started = time.perf_counter()
+    context = build_dm_context(world_id, campaign_id, session_id, query=user_input)
+    # Don't keep a read transaction open while the LLM streams.
+    db.session.close()
+    context_db_time = time.perf_counter() - context_started
+    observe_stage("build_dm_context", context_db_time)
+
+    log_payload("dm_context", context, session_id=session_id, campaign_id=campaign_id)
+
+    socketio.emit('dm_response_start', {'session_id': session_id}, room=room)
+
+    relay = ChunkRelay(socketio, room, session_id)
+
+    try:
+        stream = query_dm_function_stream(
+            user_input, context, speaking_player=speaking_player, acting_players=acting_players,
+            session_id=session_id
+        )
+        dm_response_text = relay.relay(generation_pool.iter_blocking(stream))
+
+    except Exception as e:
+        dm_response_text = relay.text
+        socketio.emit('error', {
+            'message': f'Error generating response: {str(e)}'
+        }, room=room)
+    finally:
+        socketio.emit('dm_response_end', {'session_id': session_id}, room=room)
+        if relay.first_chunk_seconds is not None:
+            observe_stage("llm_first_chunk", relay.first_chunk_seconds)
+        if relay.total_seconds is not None:
+            observe_stage("stream_total", relay.total_seconds)
+        observe_stage("emit", relay.emit_seconds)
+
+    post_llm_started = time.perf_counter()
+    if dm_response_text.strip():
+        try:
+            dm_message = f"DM: {dm_response_text.strip()}"
+            final_dm_entry = SessionLogEntry(
+                session_id=session_id,
+                message=dm_message,
+                entry_type="dm"
+            )
+            db.session.add(final_dm_entry)
+            db.session.commit()
+            dm_context_cache.record_log_entry(session_id, dm_message)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Failed to store DM response for session {session_id}: {str(e)}")
+    post_llm_db_time = time.perf_counter() - post_llm_started
+
+    logger.info(
+        f"send_message session {session_id}: db time "
+        f"{(pre_llm_db_time + context_db_time + post_llm_db_time) * 1000:.1f} ms "
+        f"(writes {pre_llm_db_time * 1000:.1f} ms, context {context_db_time * 1000:.1f} ms, "
+        f"response {post_llm_db_time * 1000:.1f} ms)"
+    )
+
+    socketio.emit('session_log_update', {
+        'session_id': session_id
+    }, room=room)
+
+    # Fold older log entries into rolling summaries, off this session's queue
+    # so the next reply isn't held up by it.
+    memory_key = ("memory", session_id)
+    if not generation_pool.pending(memory_key):
+        try:
+            generation_pool.submit(memory_key, update_session_memory, session_id)
+        except QueueFullError:
+            pass
+
+def update_session_memory(session_id):
+    """
+    Summarize any complete chunks of the session log (runs on the pool).
+    """
+    def llm_call(prompt, system_message):
+        return generation_pool.run_blocking(query_gpt, prompt, system_message)
+
+    if memory.summarize_pending(session_id, llm_call=llm_call):
+        dm_context_cache.invalidate_session(session_id)
+
+def _active_player_ids(session_id):
+    return [player['id'] for player in get_presence_store().players(session_id)]
+
+def submit_round(socketio, current, reason):
+    """
+    Send a closed round to the DM: one generation answering all its actions.
+    """
+    room = str(current.session_id)
+    DM_ROUNDS.inc(reason)
+    DM_ROUND_ACTIONS.observe(len(current.actions))
+    socketio.emit('round_closed', {
+        'session_id': current.session_id,
+        'actions': len(current.actions),
+        'player_ids': [player['player_id'] for player in current.players()]
+    }, room=room)
+    try:
+        generation_pool.submit(
+            current.session_id, generate_dm_response, socketio,
+            current.session_id, current.world_id, current.campaign_id,
+            current.user_input(), None,
+            pre_llm_db_time=current.pre_llm_db_time, acting_players=current.players()
+        )
+    except QueueFullError:
+        logger.warning(f"Dropped round of session {current.session_id}: generation queue full")
+        socketio.emit('error', {
+            'message': 'The DM is still answering earlier rounds, please wait.'
+        }, room=room)
+
+def close_round_after(socketio, session_id, token, delay):
+    """
+    Background task: close the round when its window has passed, unless
+    it was completed (and sent) before that.
+    """
+    socketio.sleep(delay)
+    current = round_collector.close(session_id, token)
+    if current is not None:
+        submit_round(socketio, current, "window")
+
+def check_round_complete(socketio, session_id):
+    """
+    Send the session's round if the players still present have all acted.
+    """
+    current = round_collector.complete(session_id, _active_player_ids(session_id))
+    if current is not None:
+        submit_round(socketio, current, "all_acted")
+
 def register_socketio_events(socketio):
     @socketio.on('join_session')
     def handle_join_session(data):
@@ -46,32 +222,23 @@ def register_socketio_events(socketio):
 
         join_room(str(session_id))
 
+        presence = get_presence_store()
         # Record this connection (for disconnect tracking)
-        socketio_connections[request.sid] = {
-            'session_id': session_id,
-            'player_id': player_id
-        }
-
-        # Initialize structure if needed
-        if session_id not in active_players:
-            active_players[session_id] = {}
-
-        # -- Avoid re-broadcast if player is already active --
-        if player_id in active_players[session_id]:
-            print(f"[DEBUG] Player {player_id} re-joined session {session_id}, skipping broadcast.")
-            return
+        presence.bind_connection(request.sid, session_id, player_id)
 
         # Fetch from DB and add to active players
         player_data = get_player_data(player_id)
         if player_data:
-            active_players[session_id][player_id] = player_data
+            # -- Avoid re-broadcast if player is already active --
+            if not presence.join(session_id, player_id, player_data):
+                logger.debug(f"Player {player_id} re-joined session {session_id}, skipping broadcast.")
+                return
 
             # Broadcast that this player joined
             emit('player_joined', player_data, room=str(session_id))
 
             # Emit the updated list
-            all_players = list(active_players[session_id].values())
-            emit('active_players', all_players, room=str(session_id))
+            emit('active_players', presence.players(session_id), room=str(session_id))
 
         # Optionally, also broadcast a general chat message
         emit('new_message', {
@@ -90,16 +257,33 @@ def register_socketio_events(socketio):
         leave_room(str(session_id))
 
         # Remove from active players
-        if session_id in active_players and player_id in active_players[session_id]:
-            del active_players[session_id][player_id]
+        presence = get_presence_store()
+        if presence.leave(session_id, player_id):
             emit('player_left', {'id': player_id}, room=str(session_id))
-
-            updated_players = list(active_players[session_id].values())
-            emit('active_players', updated_players, room=str(session_id))
+            emit('active_players', presence.players(session_id), room=str(session_id))
+            check_round_complete(socketio, session_id)
 
         # Clean up the socket->session mapping
-        if request.sid in socketio_connections:
-            del socketio_connections[request.sid]
+        presence.pop_connection(request.sid)
+
+    @socketio.on('watch_map')
+    def handle_watch_map(data):
+        """
+        Subscribe to map_delta events for a map. Clients should load the
+        map (or the viewport they need) after subscribing and apply deltas
+        with a higher version than the one they loaded.
+        """
+        map_id = data.get('map_id')
+        if not map_id:
+            emit('error', {'message': 'map_id is required'})
+            return
+        join_room(f"map:{map_id}")
+
+    @socketio.on('unwatch_map')
+    def handle_unwatch_map(data):
+        map_id = data.get('map_id')
+        if map_id:
+            leave_room(f"map:{map_id}")
 
     @socketio.on('disconnect')
     def handle_disconnect():
@@ -107,22 +291,22 @@ def register_socketio_events(socketio):
         Called automatically when a client disconnects (closes browser, etc.).
         Remove them from active_players if necessary.
         """
-        connection_info = socketio_connections.pop(request.sid, None)
+        presence = get_presence_store()
+        connection_info = presence.pop_connection(request.sid)
         if connection_info:
             session_id = connection_info['session_id']
             player_id = connection_info['player_id']
 
-            if session_id in active_players and player_id in active_players[session_id]:
-                del active_players[session_id][player_id]
+            if presence.leave(session_id, player_id):
                 emit('player_left', {'id': player_id}, room=str(session_id))
-
-                updated_players = list(active_players[session_id].values())
-                emit('active_players', updated_players, room=str(session_id))
+                emit('active_players', presence.players(session_id), room=str(session_id))
+                check_round_complete(socketio, session_id)
 
     @socketio.on('send_message')
     def handle_send_message(data):
         required_fields = ['session_id', 'campaign_id', 'world_id', 'message', 'player_id']
         if not all(data.get(field) for field in required_fields):
+            SEND_MESSAGES.inc("invalid")
             emit('error', {
                 'message': 'Missing required data',
                 'required_fields': required_fields
@@ -134,117 +318,156 @@ def register_socketio_events(socketio):
         world_id = data['world_id']
         player_id = data['player_id']
 
-        # Validate player
-        player = db.session.get(Player, player_id)
+        db_started = time.perf_counter()
+
+        # Validate player and session
+        with stage_timer("validation"):
+            player = db.session.get(Player, player_id)
+            session_obj = db.session.get(Session, session_id) if player else None
         if not player:
+            SEND_MESSAGES.inc("invalid")
             emit('error', {'message': 'Invalid player ID'})
             return
         if player.campaign_id != campaign_id:
+            SEND_MESSAGES.inc("invalid")
             emit('error', {'message': 'Player not part of this campaign'})
             return
-
-        player_label = player.character_name
-
-        # Save player action
-        new_action = PlayerAction(
-            player_id=player_id,
-            session_id=session_id,
-            action_text=data['message'],
-            timestamp=datetime.utcnow()
-        )
-        db.session.add(new_action)
-        db.session.commit()
-
-        # Validate session
-        session_obj = db.session.get(Session, session_id)
         if not session_obj:
+            SEND_MESSAGES.inc("invalid")
             emit('error', {'message': 'Session not found'})
             return
 
-        # Broadcast player's message
-        emit('new_message', {
-            'message': data['message'],
-            'speaker': player_label
-        }, room=str(session_id), include_self=False)
+        player_label = player.character_name
+        turn_mode = session_obj.turn_mode
+        window = round_window(session_obj)
+        # Refuse before anything is stored: once the message is in the log
+        # it must get an answer.
+        if turn_mode != "round" and not generation_pool.has_capacity(session_id):
+            SEND_MESSAGES.inc("busy")
+            emit('error', {
+                'message': 'The DM is still answering earlier messages, please wait.'
+            })
+            return
+        writes_started = time.perf_counter()
+        segment_check_time = 0.0
 
-        # Store in session log
-        player_msg_entry = SessionLogEntry(
-            session_id=session_id,
-            message=f"{player_label}: {data['message']}",
-            entry_type="player"
-        )
-        db.session.add(player_msg_entry)
-        db.session.commit()
-
-        # Check for newly triggered segments
-        untriggered_segments = CampaignSegment.query.filter_by(
-            campaign_id=campaign_id,
-            is_triggered=False
-        ).all()
-
-        def check_segment_trigger(segment, campaign_id):
-            # Implement your custom trigger logic
-            return False
-
-        for seg in untriggered_segments:
-            if check_segment_trigger(seg, campaign_id):
-                seg.is_triggered = True
-                db.session.commit()
-                emit('segment_triggered', {
-                    'segment_id': seg.segment_id,
-                    'title': seg.title
-                }, room=str(session_id))
+        # All pre-LLM writes go into a single transaction.
+        try:
+            new_action = PlayerAction(
+                player_id=player_id,
+                session_id=session_id,
+                action_text=data['message'],
+                timestamp=datetime.utcnow()
+            )
+            db.session.add(new_action)
 
+            player_message = f"{player_label}: {data['message']}"
+            player_msg_entry = SessionLogEntry(
+                session_id=session_id,
+                message=player_message,
+                entry_type="player"
+            )
+            db.session.add(player_msg_entry)
+
+            # Check for newly triggered segments (only those whose keywords
+            # appear in the message are evaluated)
+            presence = get_presence_store()
+            trigger_ctx = TriggerContext(
+                data['message'],
+                campaign=lambda: dm_context_cache.campaign_details(campaign_id),
+                player_count=lambda: len(presence.players(session_id))
+            )
+            segments_started = time.perf_counter()
+            fired = trigger_engine.match(campaign_id, trigger_ctx)
+            segment_check_time = time.perf_counter() - segments_started
+
+            triggered = []
+            # Fired elsewhere since this process compiled its trigger index.
+            already_triggered = []
+            claimed = _claim_segments([segment_id for segment_id, _ in fired]) if fired else set()
+            for segment_id, title in fired:
+                if segment_id not in claimed:
+                    already_triggered.append(segment_id)
+                    continue
                 log_entry = SessionLogEntry(
                     session_id=session_id,
-                    message=f"**Segment Triggered**: {seg.title}",
+                    message=f"**Segment Triggered**: {title}",
                     entry_type="dm"
                 )
                 db.session.add(log_entry)
-                db.session.commit()
+                # Keep plain values so nothing is reloaded after the commit.
+                triggered.append((segment_id, title, log_entry.message))
 
-        # Generate DM response
-        user_input = data['message']
-        speaking_player = {
-            "character_name": player_label,
-            "player_id": str(player_id)
-        }
-        context = build_dm_context(world_id, campaign_id, session_id)
-
-        print("\n=== DM CONTEXT ===")
-        print(context)
-        print("=== END CONTEXT ===\n")
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Failed to store message for session {session_id}: {str(e)}")
+            SEND_MESSAGES.inc("error")
+            emit('error', {'message': 'Failed to store message'})
+            return
 
-        emit('dm_response_start', {'session_id': session_id}, room=str(session_id))
+        pre_llm_db_time = time.perf_counter() - db_started
+        observe_stage("segment_checks", segment_check_time)
+        observe_stage("db_writes", time.perf_counter() - writes_started - segment_check_time)
 
-        dm_response_text = ""
+        dm_context_cache.record_player_action(campaign_id, player_id, data['message'])
+        dm_context_cache.record_log_entry(session_id, player_message)
 
-        try:
-            for chunk in query_dm_function_stream(user_input, context, speaking_player=speaking_player):
-                if chunk:
-                    emit('dm_chunk', {
-                        'chunk': chunk,
-                        'session_id': session_id
-                    }, room=str(session_id))
-                    socketio.sleep(0)
-                    dm_response_text += chunk
+        # Broadcast player's message
+        emit('new_message', {
+            'message': data['message'],
+            'speaker': player_label
+        }, room=str(session_id), include_self=False)
 
-        except Exception as e:
-            emit('error', {
-                'message': f'Error generating response: {str(e)}'
+        if triggered or already_triggered:
+            trigger_engine.mark_triggered(
+                campaign_id, [segment_id for segment_id, _, _ in triggered] + already_triggered
+            )
+            dm_context_cache.invalidate_segments(campaign_id)
+        for segment_id, title, log_message in triggered:
+            response_cache.invalidate("segment", segment_id)
+            dm_context_cache.record_log_entry(session_id, log_message)
+            emit('segment_triggered', {
+                'segment_id': segment_id,
+                'title': title
             }, room=str(session_id))
-        finally:
-            emit('dm_response_end', {'session_id': session_id}, room=str(session_id))
 
-        if dm_response_text.strip():
-            final_dm_entry = SessionLogEntry(
-                session_id=session_id,
-                message=f"DM: {dm_response_text.strip()}",
-                entry_type="dm"
+        speaking_player = {
+            "character_name": player_label,
+            "player_id": str(player_id)
+        }
+
+        if turn_mode == "round":
+            # Collect the action; the round's single DM call goes out once
+            # everyone present has acted or the window runs out.
+            active_ids = _active_player_ids(session_id)
+            current, opened, closed = round_collector.add(
+                session_id, world_id, campaign_id, speaking_player, data['message'],
+                active_ids, window, pre_llm_db_time=pre_llm_db_time
             )
-            db.session.add(final_dm_entry)
-            db.session.commit()
+            SEND_MESSAGES.inc("accepted")
+            if opened and not closed:
+                socketio.start_background_task(
+                    close_round_after, socketio, session_id, current.token, window
+                )
+            acted = current.player_ids
+            emit('round_update', {
+                'session_id': session_id,
+                'acted': sorted(acted),
+                'waiting_for': sorted(str(pid) for pid in active_ids if str(pid) not in acted),
+                'closes_in': 0 if closed else round(current.remaining(), 1)
+            }, room=str(session_id))
+            if closed:
+                submit_round(socketio, current, "all_acted")
+            return
 
-        emit('session_log_update', {
-            'session_id': session_id
-        }, room=str(session_id))
+        # Generate DM response on the worker pool so this handler returns
+        # right away and other sessions keep being served while it streams.
+        # The message is stored, so it is queued even if the session's queue
+        # filled up since the capacity check.
+        generation_pool.submit_accepted(
+            session_id, generate_dm_response, socketio,
+            session_id, world_id, campaign_id, data['message'], speaking_player,
+            pre_llm_db_time=pre_llm_db_time
+        )
+        SEND_MESSAGES.inc("accepted")
@@ -1,13 +1,15 @@
 # worlds.py
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from aidm_server.database import db
 from aidm_server.models import World
+from aidm_server.context_cache import dm_context_cache
+from aidm_server.response_cache import response_cache
+from aidm_server.archive import ArchiveError, export_archive, import_archive
 from datetime import datetime
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 worlds_bp = Blueprint("worlds", __name__)
 
@@ -28,38 +30,103 @@ def create_world():
         )
         db.session.add(new_world)
         db.session.commit()
-        logging.info(f"World created with ID: {new_world.world_id}")
+        dm_context_cache.invalidate_world(new_world.world_id)
+        response_cache.invalidate("world", new_world.world_id)
+        logger.info(f"World created with ID: {new_world.world_id}")
         return jsonify({"world_id": new_world.world_id}), 201
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Failed to create world: {str(e)}")
+        logger.error(f"Failed to create world: {str(e)}")
         return jsonify({"error": "Failed to create world"}), 400
 
+def _load_world(world_id):
+    world = db.session.get(World, world_id)
+    if not world:
+        return None
+    return {
+        "world_id": world.world_id,
+        "name": world.name,
+        "description": world.description,
+        "created_at": world.created_at.isoformat() if world.created_at else None
+    }
+
 @worlds_bp.route('/<int:world_id>', methods=['GET'])
 def get_world(world_id):
     """
-    Get details of a specific world.
+    Get details of a specific world (cached, with ETag support).
 
     Args:
         world_id (int): The ID of the world to retrieve.
 
     Returns:
-        JSON response with the world details, or an error message if not found.
+        JSON response with the world details, 304 if unchanged since the
+        client's If-None-Match, or an error message if not found.
     """
     try:
-        world = db.session.get(World, world_id)
-        if not world:
-            logging.warning(f"World not found: ID {world_id}")
+        response = response_cache.respond("world", world_id, _load_world)
+        if response is None:
+            logger.warning(f"World not found: ID {world_id}")
             return jsonify({"error": "World not found"}), 404
-
-        data = {
-            "world_id": world.world_id,
-            "name": world.name,
-            "description": world.description,
-            "created_at": world.created_at.isoformat() if world.created_at else None
-        }
-        logging.info(f"World details retrieved: ID {world_id}")
-        return jsonify(data)
+        logger.debug(f"World details retrieved: ID {world_id}")
+        return response
     except Exception as e:
-        logging.error(f"Failed to get world: {str(e)}")
+        logger.error(f"Failed to get world: {str(e)}")
         return jsonify({"error": "Failed to get world"}), 400
+
+@worlds_bp.route('/<int:world_id>/export', methods=['GET'])
+def export_world(world_id):
+    """
+    Stream a world with all its campaigns, maps, segments, NPCs, players,
+    sessions and logs as an NDJSON archive.
+
+    Args:
+        world_id (int): The ID of the world to export.
+
+    Returns:
+        An application/x-ndjson stream, or an error message if not found.
+    """
+    if not db.session.get(World, world_id):
+        return jsonify({"error": "World not found"}), 404
+    return Response(
+        stream_with_context(export_archive(world_id=world_id)),
+        mimetype='application/x-ndjson',
+        headers={"Content-Disposition": f"attachment; filename=world-{world_id}.jsonl"}
+    )
+
+def _import(world_id=None):
+    try:
+        result = import_archive(request.stream, world_id=world_id)
+    except ArchiveError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Failed to import archive: {str(e)}")
+        return jsonify({"error": "Failed to import archive"}), 400
+    return jsonify(result), 201
+
+@worlds_bp.route('/import', methods=['POST'])
+def import_world():
+    """
+    Import an NDJSON archive (from a world or campaign export) as a new world.
+    The request body is the archive itself; nothing is written if any line fails.
+
+    Returns:
+        JSON response with the new world and campaign IDs and the number of
+        rows imported per type, with status code 201.
+    """
+    return _import()
+
+@worlds_bp.route('/<int:world_id>/import', methods=['POST'])
+def import_into_world(world_id):
+    """
+    Import the campaigns (and NPCs) of an NDJSON archive into an existing world.
+
+    Args:
+        world_id (int): The ID of the world to import into.
+
+    Returns:
+        JSON response with the new campaign IDs and the number of rows
+        imported per type, with status code 201.
+    """
+    if not db.session.get(World, world_id):
+        return jsonify({"error": "World not found"}), 404
+    return _import(world_id)
@@ -0,0 +1,56 @@
+"""
+cli.py
+
+Flask CLI commands, e.g.
+
+    flask --app aidm_server.main archive export --world 1 -o world-1.jsonl
+    flask --app aidm_server.main archive import world-1.jsonl [--world 2]
+    flask --app aidm_server.main search rebuild
+"""
+
+import click
+from flask.cli import AppGroup
+
+from aidm_server.archive import ArchiveError, export_archive, import_archive
+from aidm_server.search import SearchUnavailable, rebuild_index
+
+archive_cli = AppGroup("archive", help="Export and import worlds and campaigns as NDJSON archives.")
+search_cli = AppGroup("search", help="Manage the full-text search index.")
+
+
+@archive_cli.command("export")
+@click.option("--world", "world_id", type=int, help="Export this world and all its campaigns.")
+@click.option("--campaign", "campaign_id", type=int, help="Export a single campaign.")
+@click.option("-o", "--output", type=click.File("w", encoding="utf-8"), default="-",
+              help="Archive file to write (default: stdout).")
+def export_command(world_id, campaign_id, output):
+    """Write a world or campaign archive."""
+    if (world_id is None) == (campaign_id is None):
+        raise click.UsageError("Pass exactly one of --world or --campaign.")
+    for line in export_archive(world_id=world_id, campaign_id=campaign_id):
+        output.write(line)
+
+
+@archive_cli.command("import")
+@click.argument("archive", type=click.File("r", encoding="utf-8"))
+@click.option("--world", "world_id", type=int,
+              help="Import into this existing world instead of creating a new one.")
+def import_command(archive, world_id):
+    """Import an archive file ("-" for stdin) in one transaction."""
+    try:
+        result = import_archive(archive, world_id=world_id)
+    except ArchiveError as e:
+        raise click.ClickException(str(e))
+    counts = ", ".join(f"{count} {kind}" for kind, count in result["counts"].items())
+    click.echo(f"Imported {counts or 'nothing'}")
+    click.echo(f"World IDs: {result['world_ids']}, campaign IDs: {result['campaign_ids']}")
+
+
+@search_cli.command("rebuild")
+def rebuild_command():
+    """Recreate the search index and its triggers from the current data."""
+    try:
+        count = rebuild_index()
+    except SearchUnavailable as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Indexed {count} rows")
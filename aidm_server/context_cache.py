@@ -0,0 +1,319 @@
+"""
+context_cache.py
+
+Per-session cache for the DM context assembled by llm.build_dm_context.
+
+The static sections (world, campaign, roster, triggered segments) are loaded
+once and kept warm. The volatile parts (session memory, recent player
+actions) are updated incrementally from the chat path instead of being
+re-queried on every message. REST blueprints call the invalidate_* helpers
+after writing to the underlying tables. Invalidations and incremental
+updates are published to the other server processes (see invalidation.py),
+which drop their copy of the section.
+
+build() returns the sections as a prompts.DMContext rather than one string,
+so the static ones can form a stable prompt prefix.
+"""
+
+import threading
+from collections import OrderedDict, deque
+
+from sqlalchemy import func
+
+from aidm_server.database import db
+from aidm_server import memory
+from aidm_server.invalidation import invalidation_bus
+from aidm_server.prompts import DMContext, render_characters, render_recent_actions
+from aidm_server.models import (
+    World, Campaign, Player, PlayerAction, SessionLogEntry, CampaignSegment
+)
+
+# Upper bound on unsummarized raw entries kept per session; the token
+# budget in memory.select_within_budget decides how many reach the prompt.
+RECENT_EVENT_LIMIT = 200
+RECENT_ACTION_LIMIT = 3
+MAX_CACHED_ENTRIES = 256
+
+SECTIONS = ("world", "campaign", "roster", "segments", "events")
+
+
+class DMContextCache:
+    """
+    Keeps the sections of the DM context per world/campaign/session.
+
+    Every section is keyed by its owning id. While a key is being loaded,
+    incremental updates and invalidations of it are counted, so a load that
+    races with one is simply discarded instead of overwriting newer data.
+    """
+
+    def __init__(self, max_entries=MAX_CACHED_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+        self._data = {section: OrderedDict() for section in SECTIONS}
+        # section -> {key: [loads in flight, updates since the first began]}
+        self._loads = {section: {} for section in SECTIONS}
+        self._hits = {section: 0 for section in SECTIONS}
+        self._misses = {section: 0 for section in SECTIONS}
+
+    # ------------------------------------------------------------------
+    # Generic section plumbing
+    # ------------------------------------------------------------------
+    def _get(self, section, key, loader):
+        with self._lock:
+            entries = self._data[section]
+            if key in entries:
+                entries.move_to_end(key)
+                self._hits[section] += 1
+                return entries[key]
+            self._misses[section] += 1
+            load = self._loads[section].setdefault(key, [0, 0])
+            load[0] += 1
+            version = load[1]
+
+        stored = False
+        try:
+            value = loader(key)
+            stored = True
+        finally:
+            with self._lock:
+                # Only store the result if nothing touched this key while loading.
+                if stored and load[1] == version:
+                    entries = self._data[section]
+                    entries[key] = value
+                    entries.move_to_end(key)
+                    while len(entries) > self.max_entries:
+                        entries.popitem(last=False)
+                load[0] -= 1
+                if not load[0]:
+                    del self._loads[section][key]
+        return value
+
+    def _bump(self, section, key):
+        load = self._loads[section].get(key)
+        if load is not None:
+            load[1] += 1
+
+    def _drop(self, section, key):
+        with self._lock:
+            self._data[section].pop(key, None)
+            self._bump(section, key)
+
+    def _invalidate(self, section, key):
+        self._drop(section, key)
+        invalidation_bus.publish("dm_context", section, key)
+
+    # ------------------------------------------------------------------
+    # Loaders
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _load_world(world_id):
+        world = db.session.get(World, world_id)
+        if not world:
+            return "World: Unknown\nDescription: No data."
+        return f"World: {world.name}\nDescription: {world.description}"
+
+    @staticmethod
+    def _load_campaign(campaign_id):
+        campaign = db.session.get(Campaign, campaign_id)
+        if not campaign:
+            return None
+        return {
+            "summary": f"Campaign: {campaign.title}\nDescription: {campaign.description}",
+            "current_quest": campaign.current_quest,
+            "location": campaign.location,
+        }
+
+    @staticmethod
+    def _load_roster(campaign_id):
+        players = Player.query.filter_by(campaign_id=campaign_id)\
+            .order_by(Player.player_id).all()
+        roster = OrderedDict()
+        for player in players:
+            roster[player.player_id] = {
+                "character_name": player.character_name,
+                "race": player.race,
+                "class": player.class_,
+                "level": player.level,
+                "recent_actions": deque(maxlen=RECENT_ACTION_LIMIT),
+            }
+
+        if roster:
+            # One windowed query instead of one query per player.
+            ranked = db.session.query(
+                PlayerAction.player_id.label("player_id"),
+                PlayerAction.action_text.label("action_text"),
+                func.row_number().over(
+                    partition_by=PlayerAction.player_id,
+                    order_by=(PlayerAction.timestamp.desc(), PlayerAction.action_id.desc())
+                ).label("rn")
+            ).filter(PlayerAction.player_id.in_(list(roster.keys()))).subquery()
+
+            rows = db.session.query(ranked.c.player_id, ranked.c.action_text)\
+                .filter(ranked.c.rn <= RECENT_ACTION_LIMIT)\
+                .order_by(ranked.c.player_id, ranked.c.rn).all()
+            for player_id, action_text in rows:
+                roster[player_id]["recent_actions"].append(action_text)
+
+        return {"players": roster, "characters": None, "actions": None}
+
+    @staticmethod
+    def _load_segments(campaign_id):
+        triggered_segments = CampaignSegment.query.filter_by(
+            campaign_id=campaign_id,
+            is_triggered=True
+        ).order_by(CampaignSegment.segment_id).all()
+        segment_text = ""
+        for seg in triggered_segments:
+            segment_text += f"\n[SEGMENT] {seg.title}\n{seg.description}\n"
+        return segment_text
+
+    @staticmethod
+    def _load_events(session_id):
+        summaries = [s.summary for s in memory.load_summaries(session_id)]
+        boundary = memory.summarized_up_to(session_id)
+        entries = SessionLogEntry.query\
+            .filter(SessionLogEntry.session_id == session_id, SessionLogEntry.id > boundary)\
+            .order_by(SessionLogEntry.id.desc())\
+            .limit(RECENT_EVENT_LIMIT).all()
+        entries.reverse()
+        return {
+            "summaries": summaries,
+            "entries": deque((e.message for e in entries), maxlen=RECENT_EVENT_LIMIT),
+        }
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+    def build(self, world_id, campaign_id, session_id=None):
+        """
+        Build the DM context, loading only the sections that are cold.
+
+        Returns:
+            DMContext: str() of it is the whole context as text.
+        """
+        world_summary = self._get("world", world_id, self._load_world)
+        campaign = self._get("campaign", campaign_id, self._load_campaign)
+        roster = self._get("roster", campaign_id, self._load_roster)
+        segment_text = self._get("segments", campaign_id, self._load_segments)
+
+        campaign_summary = (
+            campaign["summary"] if campaign
+            else "Campaign: Unknown\nDescription: No data."
+        )
+
+        with self._lock:
+            # Character sheets only change with the roster; actions every turn.
+            if roster["characters"] is None:
+                roster["characters"] = render_characters(roster["players"])
+            if roster["actions"] is None:
+                roster["actions"] = render_recent_actions(roster["players"])
+            characters_text = roster["characters"]
+            recent_actions_text = roster["actions"]
+
+        recent_events = ""
+        if session_id:
+            events = self._get("events", session_id, self._load_events)
+            with self._lock:
+                summaries, entries = memory.select_within_budget(
+                    events["summaries"], list(events["entries"])
+                )
+            recent_events = memory.render_memory(summaries, entries)
+
+        if campaign:
+            campaign_summary += f"\nCurrent Quest: {campaign['current_quest'] or 'None'}"
+            campaign_summary += f"\nLocation: {campaign['location'] or 'Unknown'}"
+
+        return DMContext(
+            world=world_summary,
+            campaign=campaign_summary,
+            characters=characters_text,
+            segments=segment_text,
+            recent_actions=recent_actions_text,
+            memory=recent_events
+        )
+
+    def campaign_details(self, campaign_id):
+        """
+        Return the cached {'summary', 'current_quest', 'location'} of a
+        campaign, or None if it doesn't exist.
+        """
+        return self._get("campaign", campaign_id, self._load_campaign)
+
+    def record_log_entry(self, session_id, message):
+        """
+        Append a freshly committed SessionLogEntry to a warm session.
+        """
+        with self._lock:
+            events = self._data["events"].get(session_id)
+            if events is not None:
+                events["entries"].append(message)
+            self._bump("events", session_id)
+        invalidation_bus.publish("dm_context", "events", session_id)
+
+    def record_player_action(self, campaign_id, player_id, action_text):
+        """
+        Push a freshly committed PlayerAction onto the cached roster.
+        """
+        with self._lock:
+            roster = self._data["roster"].get(campaign_id)
+            if roster is not None:
+                player = roster["players"].get(player_id)
+                if player is None:
+                    # Unknown player: the roster is stale, reload it next time.
+                    self._data["roster"].pop(campaign_id, None)
+                else:
+                    player["recent_actions"].appendleft(action_text)
+                    roster["actions"] = None
+            self._bump("roster", campaign_id)
+        invalidation_bus.publish("dm_context", "roster", campaign_id)
+
+    def invalidate_world(self, world_id):
+        self._invalidate("world", world_id)
+
+    def invalidate_campaign(self, campaign_id):
+        """
+        Drop everything derived from a campaign (details, roster, segments).
+        """
+        for section in ("campaign", "roster", "segments"):
+            self._invalidate(section, campaign_id)
+
+    def invalidate_roster(self, campaign_id):
+        self._invalidate("roster", campaign_id)
+
+    def invalidate_segments(self, campaign_id):
+        self._invalidate("segments", campaign_id)
+
+    def invalidate_session(self, session_id):
+        self._invalidate("events", session_id)
+
+    def clear(self):
+        with self._lock:
+            for section in SECTIONS:
+                self._data[section].clear()
+                for load in self._loads[section].values():
+                    load[1] += 1
+
+    def stats(self):
+        """
+        Return hit/miss counters, overall and per section.
+        """
+        with self._lock:
+            hits = sum(self._hits.values())
+            misses = sum(self._misses.values())
+            return {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": (hits / (hits + misses)) if (hits + misses) else 0.0,
+                "sections": {
+                    section: {
+                        "hits": self._hits[section],
+                        "misses": self._misses[section],
+                        "entries": len(self._data[section]),
+                    }
+                    for section in SECTIONS
+                },
+            }
+
+
+dm_context_cache = DMContextCache()
+invalidation_bus.register("dm_context", dm_context_cache._drop, dm_context_cache.clear)
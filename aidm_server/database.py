@@ -1,12 +1,11 @@
 import os
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy.pool import NullPool
+from sqlalchemy import create_engine, MetaData, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, QueuePool
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 convention = {
     "ix": 'ix_%(column_0_label)s',
@@ -18,46 +17,165 @@ convention = {
 
 metadata = MetaData(naming_convention=convention)
 db = SQLAlchemy(metadata=metadata)
-migrate = Migrate()
 
-def init_db(app):
+# Engine profiles, selected with AIDM_DB_PROFILE (env) or app.config['AIDM_DB_PROFILE'].
+#   development: one short-lived connection per checkout, default journal (previous behaviour)
+#   production:  bounded connection pool, WAL journal and tuned pragmas
+DEFAULT_DB_PROFILE = "development"
+
+SQLITE_PRODUCTION_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,          # ms to wait on a locked database before failing
+    "cache_size": -64000,          # negative = KiB, i.e. ~64 MB page cache per connection
+    "mmap_size": 268435456,        # 256 MB memory-mapped I/O
+    "temp_store": "MEMORY",
+}
+
+
+def _config_value(app, key, default=None):
+    """
+    Read a setting from app.config first, then the environment.
+    """
+    value = app.config.get(key)
+    if value is None:
+        value = os.getenv(key, default)
+    return value
+
+
+def _default_sqlite_uri():
+    # Create instance directory if it doesn't exist
+    instance_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance')
+    os.makedirs(instance_path, exist_ok=True)
+    database_path = os.path.join(instance_path, 'dnd_ai_dm.db')
+    return f'sqlite:///{database_path}'
+
+
+def _database_uri(app):
+    database_uri = _config_value(app, 'DATABASE_URL')
+    if not database_uri:
+        return _default_sqlite_uri()
+    # Heroku-style URLs use the scheme SQLAlchemy dropped in 1.4.
+    if database_uri.startswith('postgres://'):
+        database_uri = 'postgresql://' + database_uri[len('postgres://'):]
+    return database_uri
+
+
+def build_engine_options(app, database_uri):
+    """
+    Build SQLALCHEMY_ENGINE_OPTIONS for the selected profile.
+
+    Args:
+        app (Flask): The Flask application instance.
+        database_uri (str): The database URI the engine will connect to.
+
+    Returns:
+        tuple: (engine options dict, sqlite pragmas dict or None)
+    """
+    profile = (_config_value(app, 'AIDM_DB_PROFILE') or DEFAULT_DB_PROFILE).lower()
+    is_sqlite = make_url(database_uri).get_backend_name() == 'sqlite'
+
+    if profile == 'development':
+        options = {'poolclass': NullPool}
+        if is_sqlite:
+            options['connect_args'] = {
+                'check_same_thread': False,
+                'timeout': 30
+            }
+        return options, None
+
+    if profile != 'production':
+        raise ValueError(f"Unknown AIDM_DB_PROFILE: {profile}")
+
+    options = {
+        'pool_size': int(_config_value(app, 'AIDM_DB_POOL_SIZE', 5)),
+        'max_overflow': int(_config_value(app, 'AIDM_DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': int(_config_value(app, 'AIDM_DB_POOL_TIMEOUT', 30)),
+        'pool_pre_ping': not is_sqlite,
+        'pool_recycle': 1800,
+    }
+    if not is_sqlite:
+        return options, None
+
+    options['poolclass'] = QueuePool
+    options['connect_args'] = {
+        'check_same_thread': False,
+        'timeout': 30
+    }
+    pragmas = dict(SQLITE_PRODUCTION_PRAGMAS)
+    pragmas['busy_timeout'] = int(_config_value(app, 'AIDM_DB_BUSY_TIMEOUT_MS', pragmas['busy_timeout']))
+    pragmas['cache_size'] = int(_config_value(app, 'AIDM_DB_CACHE_SIZE', pragmas['cache_size']))
+    pragmas['mmap_size'] = int(_config_value(app, 'AIDM_DB_MMAP_SIZE', pragmas['mmap_size']))
+    return options, pragmas
+
+
+def _sqlite_pragma_listener(pragmas):
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+    return apply_pragmas
+
+
+def init_migrate(app):
+    """
+    Set up Flask-Migrate, which adds the `flask db` commands. Alembic is
+    slow to import, so the server only does this under the flask CLI.
+    """
+    from flask_migrate import Migrate
+    Migrate(app, db, render_as_batch=True, include_name=_include_in_migrations)
+
+def _include_in_migrations(name, type_, parent_names):
+    # The full-text search index (a virtual table and its shadow tables) is
+    # managed by its own migration, not by autogenerate.
+    return not (type_ == "table" and name and name.startswith("search_index"))
+
+def init_db(app, migrations=True):
     """
     Initialize the database with specific engine configuration.
 
+    The engine profile comes from AIDM_DB_PROFILE ("development" or
+    "production") and DATABASE_URL overrides the default SQLite file.
+    A SQLite file that doesn't exist yet is created with all tables, unless
+    AIDM_AUTO_CREATE_DB is off.
+
     Args:
         app (Flask): The Flask application instance.
+        migrations (bool): Also set up Flask-Migrate (see init_migrate).
 
     Raises:
         Exception: If there is an error during database initialization.
     """
     try:
-        # Create instance directory if it doesn't exist
-        instance_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance')
-        os.makedirs(instance_path, exist_ok=True)
-        
-        database_path = os.path.join(instance_path, 'dnd_ai_dm.db')
-        database_uri = f'sqlite:///{database_path}'
-        
+        database_uri = _database_uri(app)
+        engine_options, pragmas = build_engine_options(app, database_uri)
+
         app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
-        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-            'poolclass': NullPool,
-            'connect_args': {
-                'check_same_thread': False,
-                'timeout': 30
-            }
-        }
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
         app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-        
+
         db.init_app(app)
-        migrate.init_app(app, db, render_as_batch=True)
-        
-        # Create database file if it doesn't exist
-        if not os.path.exists(database_path):
-            with app.app_context():
-                db.create_all()
-        logging.info("Database initialized successfully.")
+        if migrations:
+            init_migrate(app)
+
+        url = make_url(database_uri)
+        with app.app_context():
+            if pragmas:
+                event.listen(db.engine, "connect", _sqlite_pragma_listener(pragmas))
+
+            # Create database file if it doesn't exist
+            auto_create = str(_config_value(app, 'AIDM_AUTO_CREATE_DB', '1')).lower() \
+                not in ('0', 'false', 'off', 'no')
+            if auto_create and url.get_backend_name() == 'sqlite' and url.database \
+                    and url.database != ':memory:':
+                if not os.path.exists(url.database):
+                    db.create_all()
+        logger.info("Database initialized successfully.")
     except Exception as e:
-        logging.error(f"Error initializing database: {str(e)}")
+        logger.error(f"Error initializing database: {str(e)}")
         raise
 
 def get_engine():
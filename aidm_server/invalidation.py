@@ -0,0 +1,159 @@
+"""
+invalidation.py
+
+Cache invalidations shared between server processes.
+
+dm_context_cache, trigger_engine and response_cache are kept in each server
+process. With several processes behind a message queue (see
+AIDM_SOCKETIO_MESSAGE_QUEUE), a write handled by one of them must also drop
+the copies the others hold. Each cache registers here under a name and
+publishes its invalidations; they are sent on a Redis pub/sub channel and
+every other process applies them to its own copy.
+
+The channel lives on AIDM_INVALIDATION_URL, which defaults to the message
+queue URL when that is a Redis URL. Without one, publishing does nothing
+and the caches are only correct with a single server process. A process
+whose subscription was interrupted clears all its caches once it is back,
+since it may have missed invalidations in between.
+"""
+
+import json
+import logging
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "aidm:invalidate"
+RECONNECT_SECONDS = 1.0
+POLL_SECONDS = float(os.getenv("AIDM_INVALIDATION_POLL_MS", "50")) / 1000.0
+
+
+def _redis_url(url):
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return url
+    return None
+
+
+class InvalidationBus:
+    """
+    Publishes cache invalidations to the other server processes and applies
+    theirs to the caches registered in this one.
+    """
+
+    def __init__(self, channel=CHANNEL):
+        self.channel = channel
+        # Messages this process published come back to it; they are skipped.
+        self.origin = uuid.uuid4().hex
+        self.client = None
+        self._handlers = {}
+        self._stats = dict.fromkeys(("published", "received", "resets", "errors"), 0)
+
+    def register(self, name, apply, clear):
+        """
+        Register a cache.
+
+        Args:
+            name (str): What the cache publishes under.
+            apply (callable): Drops an entry in this process only; called
+                with the arguments another process passed to publish.
+            clear (callable): Empties the cache.
+        """
+        self._handlers[name] = (apply, clear)
+
+    def publish(self, name, *args):
+        """
+        Have the other processes call the apply handler registered under
+        name with args (JSON values). Never raises: a lost invalidation only
+        leaves another process's copy stale.
+        """
+        if self.client is None:
+            return
+        message = json.dumps({"origin": self.origin, "name": name, "args": args})
+        try:
+            self.client.publish(self.channel, message)
+            self._stats["published"] += 1
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.warning(f"Failed to publish cache invalidation {name}{args}: {str(e)}")
+
+    def receive(self, data):
+        """
+        Apply a message published by another process.
+        """
+        message = json.loads(data)
+        if message.get("origin") == self.origin:
+            return
+        handler = self._handlers.get(message.get("name"))
+        if handler is None:
+            return
+        self._stats["received"] += 1
+        handler[0](*message["args"])
+
+    def clear_all(self):
+        self._stats["resets"] += 1
+        for _, clear in self._handlers.values():
+            clear()
+
+    def init_app(self, app, socketio, url=None, client=None):
+        """
+        Connect to Redis and start listening for the other processes'
+        invalidations on a Socket.IO background task. Does nothing when no
+        Redis URL is configured.
+
+        Args:
+            url (str): Redis URL; defaults to AIDM_INVALIDATION_URL, then the
+                message queue URL.
+            client: A redis-py client (or a stand-in such as
+                fakeredis.FakeRedis()) to use instead of connecting to url.
+        """
+        if client is None:
+            url = (url or os.getenv("AIDM_INVALIDATION_URL")
+                   or _redis_url(os.getenv("AIDM_SOCKETIO_MESSAGE_QUEUE")))
+            if not url:
+                return
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError(
+                    "Sharing cache invalidations needs the 'redis' package (pip install redis)"
+                )
+            client = redis.Redis.from_url(url)
+        self.client = client
+        socketio.start_background_task(self._listen, socketio)
+
+    def _listen(self, socketio):
+        # Polled without blocking, so the listener never stalls the
+        # eventlet hub even when nothing is monkey-patched.
+        interrupted = False
+        while self.client is not None:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                if interrupted:
+                    self.clear_all()
+                    logger.info("Cache invalidation channel is back; cleared the local caches.")
+                    interrupted = False
+                while self.client is not None:
+                    message = pubsub.get_message(timeout=0)
+                    if message is None:
+                        socketio.sleep(POLL_SECONDS)
+                        continue
+                    if message["type"] != "message":
+                        continue
+                    try:
+                        self.receive(message["data"])
+                    except Exception as e:
+                        self._stats["errors"] += 1
+                        logger.error(f"Failed to apply a cache invalidation: {str(e)}")
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.warning(f"Cache invalidation channel lost: {str(e)}")
+            interrupted = True
+            socketio.sleep(RECONNECT_SECONDS)
+
+    def stats(self):
+        return dict(self._stats, enabled=self.client is not None)
+
+
+invalidation_bus = InvalidationBus()
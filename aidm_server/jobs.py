@@ -0,0 +1,259 @@
+"""
+jobs.py
+
+Background jobs for long LLM tasks (session recaps, summaries, ...).
+
+A request handler calls enqueue(), which stores a Job row and returns at
+once; the endpoint answers 202 with the job id, and clients poll
+GET /api/jobs/<id> or wait for the job_finished Socket.IO event in the
+job's room. Jobs run on a local KeyedWorkerPool; LLM calls inside a handler
+go through job_pool.run_blocking so they don't stall the event loop.
+
+The jobs table is the source of truth: jobs still queued when the process
+stops are picked up again by init_app on the next start, and a job is
+claimed with a conditional UPDATE, so it runs once even if several server
+processes share the database.
+
+New kinds are registered with the job_handler decorator. A handler receives
+the job's params as keyword arguments, runs inside an app context and
+returns a JSON-serializable result.
+"""
+
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from aidm_server.database import db
+from aidm_server.models import Job, Session
+from aidm_server.workers import KeyedWorkerPool
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+# Running jobs older than this are assumed orphaned by a dead process and requeued on start.
+STALE_SECONDS = float(os.getenv("AIDM_JOB_STALE_SECONDS", "900"))
+
+job_pool = KeyedWorkerPool("jobs", max_workers=2)
+
+_handlers = {}
+_socketio = None
+
+
+class UnknownJobKindError(ValueError):
+    """Raised when enqueueing a job kind that has no handler."""
+
+
+def job_handler(kind):
+    """
+    Register the function that runs jobs of the given kind.
+    """
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+def serialize_job(job):
+    return {
+        "job_id": job.job_id,
+        "kind": job.kind,
+        "status": job.status,
+        "result": json.loads(job.result) if job.result else None,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def enqueue(kind, params=None, key=None, room=None):
+    """
+    Store a job and schedule it on the worker pool.
+
+    If a job of the same kind and key is still queued or running, that job
+    is returned instead of starting a second one (e.g. a double-clicked
+    "end session"). A unique index on active jobs enforces this when
+    several processes enqueue at once: the loser returns the winner's job.
+
+    Args:
+        kind (str): A kind registered with job_handler.
+        params (dict): Keyword arguments for the handler (JSON-serializable).
+        key (str): Jobs sharing a key run one at a time, in order.
+        room (str): Socket.IO room notified when the job finishes.
+
+    Returns:
+        Job: The new or already active job.
+
+    Raises:
+        UnknownJobKindError: If no handler is registered for kind.
+    """
+    if kind not in _handlers:
+        raise UnknownJobKindError(f"Unknown job kind: {kind}")
+    while True:
+        if key is not None:
+            existing = Job.query.filter(
+                Job.kind == kind, Job.key == key, Job.status.in_(ACTIVE_STATUSES)
+            ).order_by(Job.job_id.desc()).first()
+            if existing:
+                return existing
+
+        job = Job(kind=kind, key=key, room=room, params=json.dumps(params or {}), status=QUEUED)
+        db.session.add(job)
+        try:
+            db.session.commit()
+            break
+        except IntegrityError:
+            # Another process enqueued the same kind and key meanwhile.
+            db.session.rollback()
+    _schedule(job.job_id, key)
+    logger.info(f"Job {job.job_id} ({kind}) queued")
+    return job
+
+
+def _schedule(job_id, key):
+    job_pool.submit(key or f"job:{job_id}", run_job, job_id)
+
+
+def run_job(job_id):
+    """
+    Claim and execute one job (runs on the pool, inside an app context).
+    """
+    claimed = Job.query.filter(Job.job_id == job_id, Job.status == QUEUED).update({
+        Job.status: RUNNING,
+        Job.started_at: datetime.utcnow(),
+        Job.attempts: Job.attempts + 1
+    }, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        # Already taken by another process, or no longer queued.
+        return
+
+    job = db.session.get(Job, job_id)
+    kind, params = job.kind, json.loads(job.params or "{}")
+    handler = _handlers.get(kind)
+    try:
+        if handler is None:
+            raise UnknownJobKindError(f"Unknown job kind: {kind}")
+        result = handler(**params)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Job {job_id} ({kind}) failed: {str(e)}")
+        _finish(job_id, FAILED, error=str(e))
+        return
+    _finish(job_id, SUCCEEDED, result=result)
+    logger.info(f"Job {job_id} ({kind}) finished")
+
+
+def _finish(job_id, status, result=None, error=None):
+    job = db.session.get(Job, job_id)
+    job.status = status
+    job.result = json.dumps(result) if result is not None else None
+    job.error = error
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    payload = serialize_job(job)
+    if job.room and _socketio is not None:
+        _socketio.emit('job_finished', payload, room=job.room)
+
+
+def resume_jobs():
+    """
+    Reschedule jobs left queued by a previous run, and requeue running jobs
+    that have been running longer than AIDM_JOB_STALE_SECONDS.
+
+    Returns:
+        int: Number of jobs scheduled.
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=STALE_SECONDS)
+    Job.query.filter(Job.status == RUNNING, Job.started_at < stale_before)\
+        .update({Job.status: QUEUED}, synchronize_session=False)
+    db.session.commit()
+    pending = Job.query.with_entities(Job.job_id, Job.key)\
+        .filter(Job.status == QUEUED).order_by(Job.job_id).all()
+    for job_id, key in pending:
+        _schedule(job_id, key)
+    return len(pending)
+
+
+def init_app(app, socketio, max_workers=None, resume=True):
+    """
+    Bind the job pool to the app and, unless resume is False (CLI
+    commands), pick up unfinished jobs.
+    """
+    global _socketio
+    _socketio = socketio
+    job_pool.init_app(app, socketio, max_workers=max_workers)
+    if not resume:
+        return
+    with app.app_context():
+        try:
+            resumed = resume_jobs()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Could not resume background jobs: {str(e)}")
+            return
+    if resumed:
+        logger.info(f"Resumed {resumed} background jobs")
+
+
+# ----------------------------------------------------------------------
+# Handlers
+# ----------------------------------------------------------------------
+def _llm_call(prompt, system_message):
+    from aidm_server.llm import query_gpt
+    return job_pool.run_blocking(query_gpt, prompt, system_message)
+
+
+@job_handler("session_summaries")
+def summarize_session(session_id):
+    """
+    Fold the session log into rolling summaries.
+    """
+    from aidm_server import memory
+    from aidm_server.context_cache import dm_context_cache
+
+    created = memory.summarize_pending(session_id, llm_call=_llm_call)
+    if created:
+        dm_context_cache.invalidate_session(session_id)
+    return {"session_id": session_id, "summaries_created": created}
+
+
+@job_handler("session_recap")
+def recap_session(session_id):
+    """
+    Summarize the whole session, store the recap in Session.state_snapshot
+    and return it.
+    """
+    from aidm_server import memory
+    from aidm_server.context_cache import dm_context_cache
+
+    if not db.session.get(Session, session_id):
+        raise ValueError(f"Session not found: ID {session_id}")
+
+    # Recap from the rolling summaries plus the unsummarized tail,
+    # instead of sending the whole log in one prompt.
+    if memory.summarize_pending(session_id, llm_call=_llm_call, keep_recent=0):
+        dm_context_cache.invalidate_session(session_id)
+    recap_prompt = (
+        "Please provide a concise summary of this D&D session, highlighting key events, "
+        "important decisions, and any significant character developments:\n\n"
+        + memory.build_recap_source(session_id)
+    )
+    # Don't hold a read transaction open while the model runs.
+    db.session.close()
+    recap = _llm_call(recap_prompt, "You are a D&D session summarizer.")
+
+    ended_at = datetime.utcnow().isoformat()
+    session_obj = db.session.get(Session, session_id)
+    session_obj.state_snapshot = json.dumps({"recap": recap, "ended_at": ended_at})
+    db.session.commit()
+    logger.info(f"Session ended with ID: {session_id}")
+    return {"session_id": session_id, "recap": recap, "ended_at": ended_at}
@@ -0,0 +1,398 @@
+"""
+jsonfields.py
+
+Typed JSON columns.
+
+A JSON column is stored as compact JSON text under a private mapped
+attribute, and the public name is a synonym whose descriptor:
+
+- decodes the text on first access only, and keeps the decoded value until
+  the row is reloaded (rows loaded for other columns never pay for it);
+- checks assigned values against the column's schema and encodes them;
+- hands out dicts and lists that notice in-place changes
+  (player.inventory.append(...)), so that on flush only the columns that
+  were actually changed are validated and re-encoded.
+
+    _stats = db.Column('stats', db.Text)
+    stats = json_field('_stats', PLAYER_STATS)
+
+At class level Player.stats is still the SQL column, so it works in
+queries, load_only() and Core selects (which return the raw text).
+json_contains() builds filters on the contents of a JSON array column that
+run in the database (SQLite JSON1, PostgreSQL jsonb) instead of decoding
+every row in Python.
+
+Only top-level changes are tracked: after changing a nested value, assign
+the column again.
+
+orjson is used to encode and decode when it is installed;
+AIDM_JSON_CODEC=json forces the standard library.
+"""
+
+import json
+import os
+import weakref
+
+from sqlalchemy import cast, event, exists, inspect, literal, or_, select
+from sqlalchemy.orm import Session, synonym
+from sqlalchemy.orm.attributes import flag_modified
+
+from aidm_server.database import db
+
+orjson = None
+if os.getenv("AIDM_JSON_CODEC", "auto").lower() != "json":
+    try:
+        import orjson
+    except ImportError:
+        pass
+
+# Instance __dict__ key of the JSON fields changed in place since the last flush.
+_CHANGED_KEY = "_json_changed"
+
+
+class JSONSchemaError(ValueError):
+    """Raised when a value doesn't fit the schema of its JSON column."""
+
+
+# ----------------------------------------------------------------------
+# Codec
+# ----------------------------------------------------------------------
+def dumps(value):
+    """
+    Encode a value as compact JSON text.
+
+    Raises:
+        TypeError: If the value is not JSON serializable.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode("utf-8")
+        except TypeError:
+            pass  # e.g. integers beyond 64 bits: let json have a go
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def loads(text):
+    """
+    Decode JSON text (str or bytes).
+
+    Raises:
+        ValueError: If the text is not valid JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+# ----------------------------------------------------------------------
+# Schemas
+# ----------------------------------------------------------------------
+class JSONSchema:
+    """
+    Any JSON value. The subclasses narrow it down.
+    """
+
+    def validate(self, value, path="$"):
+        """
+        Raises:
+            JSONSchemaError: If value does not match, naming the offending path.
+        """
+
+    def from_text(self, text):
+        """
+        The value of a column that holds plain text from before it was
+        JSON (see the normalize_json_columns migration).
+        """
+        return text
+
+
+class JSONScalar(JSONSchema):
+    def __init__(self, *types, name=None):
+        self.types = types
+        self.name = name or " or ".join(t.__name__ for t in types)
+
+    def validate(self, value, path="$"):
+        # bool is an int, but true is not a number here.
+        if not isinstance(value, self.types) or (isinstance(value, bool) and bool not in self.types):
+            raise JSONSchemaError(f"{path} must be a {self.name}")
+
+
+class JSONList(JSONSchema):
+    """
+    A list of items. Plain text is split into items on separators.
+    """
+
+    def __init__(self, items=None, separators="\n"):
+        self.items = items
+        self.separators = separators
+
+    def validate(self, value, path="$"):
+        if not isinstance(value, list):
+            raise JSONSchemaError(f"{path} must be a list")
+        if self.items is not None:
+            for index, item in enumerate(value):
+                self.items.validate(item, f"{path}[{index}]")
+
+    def from_text(self, text):
+        for separator in self.separators[1:]:
+            text = text.replace(separator, self.separators[0])
+        return [item.strip() for item in text.split(self.separators[0]) if item.strip()]
+
+
+class JSONObject(JSONSchema):
+    """
+    An object. fields gives the schema of specific members, values that of
+    all the others; required members must be present.
+    """
+
+    def __init__(self, values=None, fields=None, required=()):
+        self.values = values
+        self.fields = fields or {}
+        self.required = required
+
+    def validate(self, value, path="$"):
+        if not isinstance(value, dict):
+            raise JSONSchemaError(f"{path} must be an object")
+        for name in self.required:
+            if name not in value:
+                raise JSONSchemaError(f"{path}.{name} is required")
+        for name, member in value.items():
+            if not isinstance(name, str):
+                raise JSONSchemaError(f"{path} keys must be strings")
+            schema = self.fields.get(name, self.values)
+            if schema is not None:
+                schema.validate(member, f"{path}.{name}")
+
+    def from_text(self, text):
+        return {"text": text}
+
+
+class JSONOneOf(JSONSchema):
+    def __init__(self, *options, name=None):
+        self.options = options
+        self.name = name
+
+    def validate(self, value, path="$"):
+        errors = []
+        for option in self.options:
+            try:
+                option.validate(value, path)
+                return
+            except JSONSchemaError as e:
+                errors.append(str(e))
+        raise JSONSchemaError(f"{path} must be {self.name}" if self.name else "; or ".join(errors))
+
+
+JSON_STRING = JSONScalar(str, name="string")
+JSON_NUMBER = JSONScalar(int, float, name="number")
+
+
+# ----------------------------------------------------------------------
+# Change tracking
+# ----------------------------------------------------------------------
+class _Tracked:
+    __slots__ = ()
+
+    def _bind(self, owner, field):
+        self._owner = weakref.ref(owner)
+        self._field = field
+        return self
+
+    def _changed(self):
+        owner = self._owner()
+        if owner is not None:
+            self._field.mark_changed(owner)
+
+
+class TrackedDict(_Tracked, dict):
+    __slots__ = ("_owner", "_field")
+
+    def __reduce_ex__(self, protocol):
+        # Copies (and pickles) are plain dicts, detached from the row.
+        return dict, (dict(self),)
+
+
+class TrackedList(_Tracked, list):
+    __slots__ = ("_owner", "_field")
+
+    def __reduce_ex__(self, protocol):
+        return list, (list(self),)
+
+
+def _tracking(method):
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._changed()
+        return result
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+for _name in ("__setitem__", "__delitem__", "__ior__", "clear", "pop", "popitem",
+              "setdefault", "update"):
+    setattr(TrackedDict, _name, _tracking(getattr(dict, _name)))
+for _name in ("__setitem__", "__delitem__", "__iadd__", "__imul__", "append", "extend",
+              "insert", "pop", "remove", "clear", "sort", "reverse"):
+    setattr(TrackedList, _name, _tracking(getattr(list, _name)))
+del _name
+
+
+# ----------------------------------------------------------------------
+# Fields
+# ----------------------------------------------------------------------
+class JSONField:
+    """
+    Descriptor behind a JSON column's public name (see json_field).
+
+    Args:
+        key (str): The private mapped attribute holding the JSON text.
+        schema (JSONSchema): What the column may hold (None is always allowed).
+    """
+
+    def __init__(self, key, schema=None):
+        self.key = key
+        self.schema = schema or JSONSchema()
+        self._cache_key = f"_json{key}"
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        text = getattr(obj, self.key)
+        cached = obj.__dict__.get(self._cache_key)
+        if cached is not None and cached[0] is text:
+            return cached[1]
+        value = self._track(obj, self.decode(text))
+        obj.__dict__[self._cache_key] = (text, value)
+        return value
+
+    def __set__(self, obj, value):
+        text = self.encode(value)
+        setattr(obj, self.key, text)
+        obj.__dict__[self._cache_key] = (text, self._track(obj, value))
+
+    def _track(self, obj, value):
+        if isinstance(value, dict):
+            return TrackedDict(value)._bind(obj, self)
+        if isinstance(value, list):
+            return TrackedList(value)._bind(obj, self)
+        return value
+
+    def decode(self, text):
+        """
+        The value of a column's raw text, as read with a Core select.
+        Not validated: whatever was written passed the schema then.
+        """
+        if text is None or text == "":
+            return None
+        try:
+            return loads(text)
+        except ValueError:
+            return self.schema.from_text(text)
+
+    def encode(self, value):
+        """
+        Validate a value and return its JSON text.
+
+        Raises:
+            JSONSchemaError: If it doesn't fit the schema.
+        """
+        if value is None:
+            return None
+        self.schema.validate(value)
+        try:
+            return dumps(value)
+        except (TypeError, ValueError) as e:
+            raise JSONSchemaError(f"not JSON serializable: {str(e)}")
+
+    def normalize_text(self, text, allow_plain_text=True):
+        """
+        Validate raw text written without the descriptor (an archive, the
+        admin panel) and return it as compact JSON.
+
+        Raises:
+            JSONSchemaError: If it is not valid JSON (or, with
+                allow_plain_text, convertible plain text) fitting the schema.
+        """
+        if text is None or (isinstance(text, str) and not text.strip()):
+            return None
+        if not isinstance(text, str):
+            return self.encode(text)
+        try:
+            value = loads(text)
+        except ValueError:
+            if not allow_plain_text:
+                raise JSONSchemaError("not valid JSON")
+            value = self.schema.from_text(text)
+        return self.encode(value)
+
+    def mark_changed(self, obj):
+        """
+        Have the column re-encoded at the next flush, after its decoded
+        value was changed in place.
+        """
+        obj.__dict__.setdefault(_CHANGED_KEY, set()).add(self)
+        flag_modified(obj, self.key)
+
+    def flush_changes(self, obj):
+        value = self.__get__(obj)
+        text = self.encode(value)
+        setattr(obj, self.key, text)
+        obj.__dict__[self._cache_key] = (text, value)
+
+
+def json_field(key, schema=None):
+    """
+    Map a JSON column's public name onto its private text attribute.
+
+    Args:
+        key (str): The private attribute, e.g. '_stats' for
+            _stats = db.Column('stats', db.Text).
+        schema (JSONSchema): What the column may hold.
+    """
+    return synonym(key, descriptor=JSONField(key, schema))
+
+
+def json_fields(model):
+    """
+    Return {public name: JSONField} of a model's JSON columns.
+    """
+    return {
+        prop.key: prop.descriptor
+        for prop in inspect(model).synonyms
+        if isinstance(prop.descriptor, JSONField)
+    }
+
+
+@event.listens_for(Session, "before_flush")
+def _encode_changed_fields(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        changed = obj.__dict__.pop(_CHANGED_KEY, None)
+        for field in changed or ():
+            field.flush_changes(obj)
+
+
+# ----------------------------------------------------------------------
+# Filters
+# ----------------------------------------------------------------------
+def json_contains(column, value, member=None):
+    """
+    SQL condition: the JSON array in column has an element equal to value
+    or, with member, an object element whose member equals value.
+
+    Uses jsonb containment on PostgreSQL and JSON1's json_each elsewhere
+    (SQLite), so only the matching rows are loaded.
+    """
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import JSONB
+        document = cast(column, JSONB)
+        condition = document.op("@>")(cast(literal(dumps([value])), JSONB))
+        if member is not None:
+            condition = or_(condition, document.op("@>")(cast(literal(dumps([{member: value}])), JSONB)))
+        return condition
+
+    elements = db.func.json_each(column).table_valued("value", "type")
+    condition = elements.c.value == value
+    if member is not None:
+        condition = or_(condition, (elements.c.type == "object")
+                        & (db.func.json_extract(elements.c.value, f'$."{member}"') == value))
+    return exists(select(1).select_from(elements).where(condition))
@@ -2,31 +2,34 @@
 llm.py
 
 Revised module for LLM interactions, with unused roll logic removed.
+
+All model calls go through the configured provider (see providers/), so the
+Gemini SDK is only loaded when the Gemini backend is actually used.
+
+Calls whose result only depends on the prompt (recaps, summaries) are served
+from the LLM result cache (see llm_cache.py); the DM entry points can opt in
+with cache=True.
+
+DM prompts are assembled by prompts.py as a stable prefix plus a volatile
+suffix; with a provider that supports context caching, long prefixes are
+cached on the provider side and only the suffix is sent.
 """
 
-import os
 import json
+import logging
 from dotenv import load_dotenv
-import google.generativeai as genai
-from datetime import datetime
-from sqlalchemy import desc
 
-from aidm_server.models import (
-    World, Campaign, Player, Session, PlayerAction,
-    Map, SessionLogEntry, CampaignSegment
-)
-from aidm_server.database import db
+from aidm_server.context_cache import dm_context_cache
+from aidm_server.providers import get_provider
+from aidm_server.llm_cache import llm_cache, cache_key
+from aidm_server.prompts import Prompt, assemble_dm_prompt, prefix_registry
+from aidm_server import search
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
-api_key = os.getenv("GOOGLE_GENAI_API_KEY")
-if not api_key:
-    raise ValueError("GOOGLE_GENAI_API_KEY environment variable is not set")
-
-genai.configure(api_key=api_key)
-model = genai.GenerativeModel("gemini-exp-1206")
-
 
 def validate_dm_response(response_json, active_players):
     """
@@ -44,88 +47,79 @@ def gather_segment_context(campaign_id):
     return {}
 
 
-def build_dm_context(world_id, campaign_id, session_id=None):
+def build_dm_context(world_id, campaign_id, session_id=None, query=None):
     """
-    Build a context string for the DM logic:
+    Build the context for the DM logic:
       - World info
       - Campaign info
       - Player data
       - Recent session events
       - Triggered segments
+      - Earlier events and NPCs relevant to the player input (with query)
       - Etc.
+
+    Sections are served from the per-session context cache
+    (see context_cache.py) and only reloaded when they go cold.
+
+    Args:
+        query (str): The player input; the top AIDM_SEARCH_RECALL search
+            hits for it that aren't already in the context are added.
+
+    Returns:
+        prompts.DMContext: The sections; str() gives the context as text.
     """
-    # 1. World data
-    world = World.query.get(world_id)
-    if not world:
-        world_summary = "World: Unknown\nDescription: No data."
-    else:
-        world_summary = f"World: {world.name}\nDescription: {world.description}"
-
-    # 2. Campaign data
-    campaign = Campaign.query.get(campaign_id)
-    if not campaign:
-        campaign_summary = "Campaign: Unknown\nDescription: No data."
-    else:
-        campaign_summary = f"Campaign: {campaign.title}\nDescription: {campaign.description}"
-
-    # 3. Players
-    active_players = {}
-    players = Player.query.filter_by(campaign_id=campaign_id).all()
-    for player in players:
-        recent_actions = PlayerAction.query.filter_by(player_id=player.player_id)\
-            .order_by(PlayerAction.timestamp.desc()).limit(3).all()
-        action_history = [action.action_text for action in recent_actions]
-        active_players[str(player.player_id)] = {
-            "character_name": player.character_name,
-            "race": player.race,
-            "class": player.class_,
-            "level": player.level,
-            "recent_actions": action_history
-        }
-
-    active_players_text = "ACTIVE PLAYERS:\n" + json.dumps(active_players, indent=2)
-
-    # 4. Recent session log
-    recent_events = ""
-    if session_id:
-        entries = SessionLogEntry.query.filter_by(session_id=session_id)\
-            .order_by(SessionLogEntry.timestamp.desc())\
-            .limit(10).all()
-        if entries:
-            entries.reverse()
-            recent_events = "\nRECENT EVENTS:\n" + "\n".join(e.message for e in entries)
-
-    # 5. Triggered segments
-    triggered_segments = CampaignSegment.query.filter_by(
-        campaign_id=campaign_id,
-        is_triggered=True
-    ).all()
-    segment_text = ""
-    for seg in triggered_segments:
-        segment_text += f"\n[SEGMENT] {seg.title}\n{seg.description}\n"
-
-    # 6. Combine
-    context = (
-        f"{world_summary}\n\n"
-        f"{campaign_summary}\n\n"
-        f"{active_players_text}\n"
-        f"{recent_events}\n"
+    context = dm_context_cache.build(world_id, campaign_id, session_id)
+    if query:
+        try:
+            context.recall = search.render_recall(
+                search.recall(campaign_id, world_id, session_id, query)
+            )
+        except Exception as e:
+            # Recall is a bonus; never fail a turn over it.
+            logger.error(f"Search recall failed for campaign {campaign_id}: {str(e)}")
+    return context
+
+
+def _generate(full_prompt, cache):
+    provider = get_provider()
+    if not cache:
+        return provider.generate(full_prompt)
+    key = cache_key(provider.name, provider.model, full_prompt)
+    return llm_cache.get_or_call(
+        key, lambda: provider.generate(full_prompt), provider.name, provider.model
     )
-    if campaign:
-        context += f"\nCurrent Quest: {campaign.current_quest or 'None'}"
-        context += f"\nLocation: {campaign.location or 'Unknown'}"
-        # Potentially include campaign.plot_points or active_npcs as needed
 
-    context += f"\n{segment_text}"
 
-    return context
+def _stream(full_prompt, cache, session_id=None):
+    """
+    Stream a prompt. full_prompt is a string, or a prompts.Prompt whose
+    prefix is registered (and cached by the provider where supported).
+    """
+    provider = get_provider()
+    stream = provider.stream
+    if isinstance(full_prompt, Prompt):
+        prompt = full_prompt
+        full_prompt = str(prompt)
+        prefix_registry.record(prompt, session_id)
+        handle = prefix_registry.provider_handle(provider, prompt)
+        if handle is not None:
+            def stream(_text):
+                return provider.stream_cached(handle, prompt.suffix)
+    if not cache:
+        return stream(full_prompt)
+    key = cache_key(provider.name, provider.model, full_prompt)
+    return llm_cache.stream_or_call(
+        key, lambda: stream(full_prompt), provider.name, provider.model
+    )
 
 
-def query_dm_function(user_input, context, speaking_player_id=None):
+def query_dm_function(user_input, context, speaking_player_id=None, cache=False):
     """
     Non-streaming DM logic. You can request structured JSON or simple text.
     We keep references to dice rolls if the story calls for them,
     but do not handle the result server-side.
+
+    Pass cache=True to reuse the response for an identical prompt.
     """
     system_instructions = """
 You are a Dungeons & Dragons Dungeon Master.
@@ -137,8 +131,7 @@ You are a Dungeons & Dragons Dungeon Master.
 """
 
     full_prompt = f"{system_instructions}\nCONTEXT:\n{context}\n\nPLAYER ACTION:\n{user_input}\n"
-    response = model.generate_content(full_prompt)
-    response_text = response.text.strip()
+    response_text = _generate(full_prompt, cache).strip()
 
     # Optionally attempt to parse JSON if it starts with { or [
     if response_text.startswith("{") or response_text.startswith("["):
@@ -151,53 +144,46 @@ You are a Dungeons & Dragons Dungeon Master.
     return response_text
 
 
-def query_dm_function_stream(user_input, context, speaking_player=None):
+def query_dm_function_stream(user_input, context, speaking_player=None, cache=False,
+                             acting_players=None, session_id=None):
     """
     Streaming version that outputs narrative text chunk-by-chunk.
     The DM can mention dice rolls and request them, but we are not
     automatically interpreting or resolving them here.
+
+    For a round (several players' actions in user_input, one per line),
+    pass the players as acting_players instead of speaking_player.
+    session_id attributes the prompt's prefix reuse to a session.
+
+    Pass cache=True to replay the response for an identical prompt.
     """
-    system_instructions = """
-You are a Dungeons & Dragons DM. Provide descriptive, story-focused responses.
-If an action warrants a dice roll, explicitly request it from the player.
-"""
-    speaker_text = ""
-    if speaking_player:
-        speaker_text = (
-            f"\nCurrent speaker: {speaking_player['character_name']} "
-            f"(ID: {speaking_player['player_id']})."
-        )
-
-    full_prompt = (
-        f"{system_instructions}\n"
-        f"{speaker_text}\n"
-        f"CONTEXT:\n{context}\n\n"
-        f"PLAYER INPUT:\n{user_input}\n"
+    prompt = assemble_dm_prompt(
+        context, user_input, speaking_player=speaking_player, acting_players=acting_players
     )
 
     try:
-        response = model.generate_content(full_prompt, stream=True)
-        for chunk in response:
-            if chunk.text:
-                yield chunk.text.strip()
+        for chunk in _stream(prompt, cache, session_id=session_id):
+            if chunk:
+                # Don't strip: whitespace between chunks is part of the text.
+                yield chunk
     except Exception as e:
         yield f"Error during streaming: {str(e)}"
 
 
-def query_gpt(prompt, system_message=None):
+def query_gpt(prompt, system_message=None, cache=True):
     """
     Simple wrapper for quick queries (used e.g. in /end session).
+    Results are cached by prompt unless cache=False.
     """
     full_prompt = f"{system_message}\n\n{prompt}" if system_message else prompt
-    response = model.generate_content(full_prompt)
-    return response.text
+    return _generate(full_prompt, cache)
 
 
-def query_gpt_stream(prompt, system_message=None):
+def query_gpt_stream(prompt, system_message=None, cache=True):
     """
     Streaming version for backward compatibility. 
+    Results are cached by prompt unless cache=False.
     """
     full_prompt = f"{system_message}\n\n{prompt}" if system_message else prompt
-    response = model.generate_content(full_prompt, stream=True)
-    for chunk in response:
-        yield chunk.text
+    for chunk in _stream(full_prompt, cache):
+        yield chunk
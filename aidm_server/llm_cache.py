@@ -0,0 +1,387 @@
+"""
+llm_cache.py
+
+Content-addressed cache for LLM results.
+
+Results are keyed on a hash of the provider, model and full prompt, so a
+repeated recap or summary for unchanged input (retries, double-clicks,
+repeated /end calls) is served without another model call. There are two
+tiers:
+
+- an in-process LRU of recent results (AIDM_LLM_CACHE_MEMORY_ENTRIES), and
+- a persistent SQLite file (AIDM_LLM_CACHE_PATH, default
+  instance/llm_cache.db) with a TTL (AIDM_LLM_CACHE_TTL seconds) and
+  least-recently-used eviction above AIDM_LLM_CACHE_MAX_ENTRIES rows.
+
+Concurrent requests for the same key are coalesced ("single flight"): the
+first caller runs the model, the others wait for its result, for at most
+AIDM_LLM_CACHE_WAIT_SECONDS before making their own call. Model calls run
+on real threads (see workers.run_blocking), so waiting uses the real
+threading primitives, even when eventlet has monkey-patched threading: a
+green Event can't be waited on in one OS thread and set from another. Set
+AIDM_LLM_CACHE=0 to turn the cache off.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_ENTRIES = 256
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL = 7 * 24 * 3600
+# Run TTL/size eviction on the SQLite tier every this many writes.
+EVICT_EVERY = 100
+DEFAULT_WAIT_SECONDS = 300
+
+
+def _os_threading():
+    """
+    The threading module of real OS threads: the original one if eventlet
+    has monkey-patched it.
+    """
+    patcher = sys.modules.get("eventlet.patcher")
+    if patcher is not None and patcher.is_monkey_patched("thread"):
+        return patcher.original("threading")
+    return threading
+
+
+def _default_path():
+    instance_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance')
+    return os.path.join(instance_path, 'llm_cache.db')
+
+
+def cache_key(provider, model, prompt):
+    """
+    Content address of an LLM call.
+    """
+    digest = hashlib.sha256()
+    for part in (provider or "", model or "", prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class _Flight:
+    def __init__(self, event):
+        self.event = event
+        self.result = None
+        self.failed = False
+
+
+class LLMCache:
+    """
+    Two-tier LLM result cache with single-flight de-duplication.
+
+    Args:
+        path (str): SQLite file for the persistent tier ("" for memory only).
+        ttl (float): Seconds a persisted result stays valid.
+        memory_entries (int): Size of the in-process LRU.
+        max_entries (int): Row limit of the SQLite tier.
+        enabled (bool): When False every lookup misses and nothing is stored.
+        event_factory (callable): Creates the events followers wait on
+            (default: a real threading.Event).
+        wait_seconds (float): How long a follower waits for the leader
+            before calling the model itself.
+    """
+
+    def __init__(self, path=None, ttl=None, memory_entries=None, max_entries=None,
+                 enabled=None, event_factory=None, wait_seconds=None):
+        if enabled is None:
+            enabled = os.getenv("AIDM_LLM_CACHE", "1").lower() not in ("0", "false", "off", "no")
+        self.enabled = enabled
+        self.path = path if path is not None else os.getenv("AIDM_LLM_CACHE_PATH", _default_path())
+        self.ttl = ttl if ttl is not None else float(os.getenv("AIDM_LLM_CACHE_TTL", DEFAULT_TTL))
+        self.memory_entries = (memory_entries if memory_entries is not None else
+                               int(os.getenv("AIDM_LLM_CACHE_MEMORY_ENTRIES", DEFAULT_MEMORY_ENTRIES)))
+        self.max_entries = (max_entries if max_entries is not None else
+                            int(os.getenv("AIDM_LLM_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)))
+        self.wait_seconds = (wait_seconds if wait_seconds is not None else
+                             float(os.getenv("AIDM_LLM_CACHE_WAIT_SECONDS", DEFAULT_WAIT_SECONDS)))
+        self.event_factory = event_factory
+        self._lock = _os_threading().Lock()
+        self._memory = OrderedDict()  # key -> (expires_at, text)
+        self._flights = {}
+        self._local = threading.local()
+        self._schema_ready = False
+        self._writes = 0
+        self._stats = dict.fromkeys(
+            ("memory_hits", "disk_hits", "misses", "coalesced", "stores", "evictions", "errors"), 0
+        )
+
+    # ------------------------------------------------------------------
+    # SQLite tier
+    # ------------------------------------------------------------------
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache ("
+                    " key TEXT PRIMARY KEY,"
+                    " provider TEXT,"
+                    " model TEXT,"
+                    " response TEXT NOT NULL,"
+                    " created_at REAL NOT NULL,"
+                    " accessed_at REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed_at ON llm_cache (accessed_at)"
+                )
+                self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _disk_get(self, key, now):
+        row = self._connection().execute(
+            "SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        response, created_at = row
+        if created_at + self.ttl <= now:
+            self._connection().execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            return None
+        self._connection().execute(
+            "UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key)
+        )
+        return response, created_at + self.ttl
+
+    def _disk_put(self, key, provider, model, text, now):
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, provider, model, response, created_at, accessed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (key, provider, model, text, now, now)
+        )
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % EVICT_EVERY == 1
+        if evict:
+            self.evict(now)
+
+    def evict(self, now=None):
+        """
+        Drop expired rows, then the least recently used ones above max_entries.
+
+        Returns:
+            int: Rows removed.
+        """
+        if not (self.enabled and self.path):
+            return 0
+        now = time.time() if now is None else now
+        conn = self._connection()
+        removed = conn.execute(
+            "DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,)
+        ).rowcount
+        (count,) = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        if count > self.max_entries:
+            removed += conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                " SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            ).rowcount
+        if removed:
+            self._count("evictions", removed)
+        return removed
+
+    # ------------------------------------------------------------------
+    # Lookups
+    # ------------------------------------------------------------------
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def _remember(self, key, text, expires_at):
+        with self._lock:
+            self._memory[key] = (expires_at, text)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Return the cached text for a key, or None.
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return entry[1]
+                del self._memory[key]
+
+        if self.path:
+            try:
+                found = self._disk_get(key, now)
+            except sqlite3.Error as e:
+                self._count("errors")
+                logger.warning(f"LLM cache read failed: {str(e)}")
+                found = None
+            if found is not None:
+                text, expires_at = found
+                self._remember(key, text, expires_at)
+                self._count("disk_hits")
+                return text
+        return None
+
+    def put(self, key, text, provider=None, model=None):
+        """
+        Store a result in both tiers. Empty results are not cached.
+        """
+        if not self.enabled or not text:
+            return
+        now = time.time()
+        self._remember(key, text, now + self.ttl)
+        if self.path:
+            try:
+                self._disk_put(key, provider, model, text, now)
+            except sqlite3.Error as e:
+                self._count("errors")
+                logger.warning(f"LLM cache write failed: {str(e)}")
+        self._count("stores")
+
+    # ------------------------------------------------------------------
+    # Single flight
+    # ------------------------------------------------------------------
+    def _join_flight(self, key):
+        """
+        Returns (flight, leader): the leader must call _finish_flight.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._stats["coalesced"] += 1
+                return flight, False
+            event_factory = self.event_factory or _os_threading().Event
+            flight = _Flight(event_factory())
+            self._flights[key] = flight
+            return flight, True
+
+    def _finish_flight(self, key, flight, result=None, failed=False):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.result = result
+        flight.failed = failed
+        flight.event.set()
+
+    def _wait_flight(self, flight):
+        """
+        Wait for the leader. Returns False if it failed or took longer than
+        wait_seconds, in which case the caller makes its own call.
+        """
+        if not flight.event.wait(self.wait_seconds):
+            logger.warning(f"LLM cache: gave up waiting for a coalesced call after {self.wait_seconds}s")
+            return False
+        return not flight.failed
+
+    def get_or_call(self, key, fn, provider=None, model=None):
+        """
+        Return the cached result for key, or call fn() once for all
+        concurrent callers asking for the same key and cache its result.
+
+        If the leading call fails, waiting callers make their own call.
+        """
+        if not self.enabled:
+            return fn()
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        flight, leader = self._join_flight(key)
+        if not leader:
+            if self._wait_flight(flight):
+                return flight.result
+            return fn()
+
+        self._count("misses")
+        try:
+            result = fn()
+        except BaseException:
+            self._finish_flight(key, flight, failed=True)
+            raise
+        self.put(key, result, provider, model)
+        self._finish_flight(key, flight, result=result)
+        return result
+
+    def stream_or_call(self, key, stream_fn, provider=None, model=None):
+        """
+        Streaming counterpart of get_or_call.
+
+        A cached (or coalesced) result is yielded as a single chunk; on a miss
+        the leader's chunks are passed through as they arrive and the joined
+        text is cached once the stream completes.
+        """
+        if not self.enabled:
+            yield from stream_fn()
+            return
+        cached = self.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        flight, leader = self._join_flight(key)
+        if not leader:
+            if self._wait_flight(flight):
+                yield flight.result
+            else:
+                yield from stream_fn()
+            return
+
+        self._count("misses")
+        parts = []
+        completed = False
+        try:
+            for chunk in stream_fn():
+                parts.append(chunk)
+                yield chunk
+            completed = True
+        finally:
+            if completed:
+                result = "".join(parts)
+                self.put(key, result, provider, model)
+                self._finish_flight(key, flight, result=result)
+            else:
+                # Failed or abandoned midway: nothing reusable to share.
+                self._finish_flight(key, flight, failed=True)
+
+    # ------------------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------------------
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self.enabled and self.path:
+            self._connection().execute("DELETE FROM llm_cache")
+
+    def stats(self):
+        """
+        Return hit/miss/coalescing counters and the memory tier size.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["in_flight"] = len(self._flights)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = ((lookups - stats["misses"]) / lookups) if lookups else 0.0
+        return stats
+
+
+llm_cache = LLMCache()
@@ -0,0 +1,142 @@
+"""
+logging_config.py
+
+Central logging setup, applied once from create_app.
+
+Records are handed to a QueueHandler and written by a QueueListener on its
+own thread, so logging never blocks the event loop on terminal or file I/O.
+Output is JSON (python-json-logger) by default, one object per line.
+
+Settings (environment variables):
+    AIDM_LOG_LEVEL          Root level (default INFO).
+    AIDM_LOG_LEVELS         Per-category levels, e.g.
+                            "aidm_server.blueprints=WARNING,aidm.prompts=INFO".
+    AIDM_LOG_FORMAT         "json" (default) or "text".
+    AIDM_LOG_DM_CONTEXT     Set to 1 to log DM contexts/prompts (aidm.prompts).
+    AIDM_LOG_PROMPT_SAMPLE_RATE   Share of prompt payloads written (default 1.0).
+    AIDM_LOG_PROMPT_MAX_CHARS     Payloads are truncated to this length (default 4000).
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+try:
+    from pythonjsonlogger.json import JsonFormatter
+except ImportError:  # python-json-logger < 3.1
+    from pythonjsonlogger.jsonlogger import JsonFormatter
+
+PROMPT_LOGGER = "aidm.prompts"
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+
+_listener = None
+_prompt_sample_rate = 1.0
+_prompt_max_chars = 4000
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Plain-text formatter that also prints large payloads logged with log_payload.
+    """
+
+    def format(self, record):
+        text = super().format(record)
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            text += "\n" + payload
+        return text
+
+
+def parse_levels(spec):
+    """
+    Parse "logger=LEVEL,other=LEVEL" into {logger: level}.
+
+    Raises:
+        ValueError: On a malformed entry or unknown level name.
+    """
+    levels = {}
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, level = item.partition("=")
+        level = level.strip().upper()
+        if not sep or not name.strip() or not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Invalid log level entry: {item!r}")
+        levels[name.strip()] = level
+    return levels
+
+
+def _enabled(value):
+    return (value or "").lower() in ("1", "true", "yes", "on")
+
+
+def configure_logging():
+    """
+    Route all logging through a background queue listener. Safe to call
+    more than once; only the first call has an effect.
+    """
+    global _listener, _prompt_sample_rate, _prompt_max_chars
+    if _listener is not None:
+        return
+
+    if os.getenv("AIDM_LOG_FORMAT", "json").lower() == "text":
+        formatter = TextFormatter(TEXT_FORMAT)
+    else:
+        formatter = JsonFormatter(
+            "%(asctime)s %(levelname)s %(name)s %(message)s",
+            rename_fields={"asctime": "timestamp", "levelname": "level", "name": "logger"}
+        )
+    output = logging.StreamHandler()
+    output.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(os.getenv("AIDM_LOG_LEVEL", "INFO").upper())
+
+    # Prompt/context dumps are off unless explicitly enabled.
+    logging.getLogger(PROMPT_LOGGER).setLevel(
+        logging.INFO if _enabled(os.getenv("AIDM_LOG_DM_CONTEXT")) else logging.WARNING
+    )
+    for name, level in parse_levels(os.getenv("AIDM_LOG_LEVELS")).items():
+        logging.getLogger(name).setLevel(level)
+
+    _prompt_sample_rate = float(os.getenv("AIDM_LOG_PROMPT_SAMPLE_RATE", "1.0"))
+    _prompt_max_chars = int(os.getenv("AIDM_LOG_PROMPT_MAX_CHARS", "4000"))
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def log_payload(kind, text, **fields):
+    """
+    Log a large payload (DM context, prompt) on the aidm.prompts logger,
+    if that category is enabled and the record is sampled. Nothing is
+    formatted when it isn't.
+
+    Args:
+        kind (str): Short label used as the log message, e.g. "dm_context".
+        text: The payload. Non-strings (e.g. a DMContext) are only passed
+            to str() when the record is actually logged.
+        **fields: Extra structured fields (session_id, ...).
+    """
+    logger = logging.getLogger(PROMPT_LOGGER)
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    if _prompt_sample_rate < 1.0 and random.random() >= _prompt_sample_rate:
+        return
+    text = str(text)
+    truncated = len(text) > _prompt_max_chars
+    logger.info(kind, extra=dict(
+        fields,
+        payload=text[:_prompt_max_chars] if truncated else text,
+        payload_chars=len(text),
+        truncated=truncated
+    ))
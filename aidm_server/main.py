@@ -1,6 +1,12 @@
 # main.py
+#
+# Application factory. Nothing is built at import time: the Flask CLI
+# (`flask --app aidm_server.main ...`) and WSGI servers
+# (`gunicorn -k eventlet -w 1 "aidm_server.main:create_app()"`) call
+# create_app(), and `python -m aidm_server.main` runs the development server.
 
 import os
+import click
 from flask import Flask
 from flask_cors import CORS
 from flask_socketio import SocketIO
@@ -12,17 +18,77 @@ from aidm_server.blueprints.worlds import worlds_bp
 from aidm_server.blueprints.players import players_bp
 from aidm_server.blueprints.sessions import sessions_bp
 from aidm_server.blueprints.maps import maps_bp
-from aidm_server.blueprints.socketio_events import register_socketio_events
-from aidm_server.blueprints.admin import configure_admin
+from aidm_server.blueprints.socketio_events import register_socketio_events, generation_pool
 # NEW:
 from aidm_server.blueprints.segments import segments_bp
+from aidm_server.blueprints.metrics import metrics_bp
+from aidm_server.blueprints.jobs import jobs_bp
+from aidm_server.blueprints.search import search_bp
+from aidm_server import metrics, jobs
+from aidm_server.invalidation import invalidation_bus
+from aidm_server.cli import archive_cli, search_cli
+from aidm_server.logging_config import configure_logging
 
-def create_app():
+logger = logging.getLogger(__name__)
+
+# Bound to the app in create_app. With a message queue (e.g.
+# redis://localhost:6379/0) several server processes share rooms, so
+# broadcasts reach clients connected to any of them.
+socketio = SocketIO()
+register_socketio_events(socketio)
+
+def _enabled(app, key, default=True):
+    """
+    Read an on/off setting from app.config first, then the environment.
+    """
+    value = app.config.get(key)
+    if value is None:
+        value = os.getenv(key)
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() not in ("0", "false", "off", "no", "")
+    return bool(value)
+
+def _cli_mode(app):
+    """
+    Whether the app is built for a flask CLI command rather than to serve.
+    AIDM_CLI in the config decides when set; otherwise any click command
+    but `flask run` (which serves the app) counts.
+    """
+    if app.config.get("AIDM_CLI") is not None:
+        return bool(app.config["AIDM_CLI"])
+    ctx = click.get_current_context(silent=True)
+    return ctx is not None and ctx.command.name != "run"
+
+def create_app(config=None):
+    """
+    Create and configure the application.
+
+    Args:
+        config (dict): Settings applied to app.config before anything is
+            initialized, e.g. {"DATABASE_URL": ..., "AIDM_ADMIN": False}.
+            "AIDM_CLI": True/False says whether the app is for a CLI
+            command or a server; by default it is detected.
+
+    Returns:
+        Flask: The application, with Socket.IO and the worker pools bound to it.
+    """
+    configure_logging()
     app = Flask(__name__)
     CORS(app)
     app.secret_key = os.getenv("FLASK_SECRET_KEY") or "my_dev_secret"
+    if config:
+        app.config.update(config)
+    # Under the flask CLI (`flask db upgrade`, `flask archive ...`) skip the
+    # server's startup work: migrations manage the schema, and background
+    # jobs are left for the server to resume. Only the CLI needs the
+    # `flask db` commands (and the alembic import behind them).
+    from_cli = _cli_mode(app)
+    if from_cli:
+        app.config.setdefault("AIDM_AUTO_CREATE_DB", False)
 
-    init_db(app)
+    init_db(app, migrations=from_cli)
 
     # Register blueprints with /api prefix
     app.register_blueprint(campaigns_bp, url_prefix='/api/campaigns')
@@ -32,27 +98,54 @@ def create_app():
     app.register_blueprint(maps_bp, url_prefix='/api/maps')
     # Register our new segments blueprint
     app.register_blueprint(segments_bp, url_prefix='/api/segments')
+    app.register_blueprint(jobs_bp, url_prefix='/api/jobs')
+    app.register_blueprint(search_bp, url_prefix='/api/search')
+    # Prometheus scrape endpoint
+    app.register_blueprint(metrics_bp, url_prefix='/metrics')
 
-    # Flask-Admin setup
-    configure_admin(app, db)
+    app.cli.add_command(archive_cli)
+    app.cli.add_command(search_cli)
 
-    return app
+    # Flask-Admin setup (imported only when enabled)
+    if _enabled(app, "AIDM_ADMIN"):
+        from aidm_server.blueprints.admin import configure_admin
+        configure_admin(app, db)
 
-app = create_app()
-socketio = SocketIO(app, cors_allowed_origins="*")
-register_socketio_events(socketio)
+    socketio.init_app(
+        app,
+        cors_allowed_origins="*",
+        message_queue=os.getenv("AIDM_SOCKETIO_MESSAGE_QUEUE") or None
+    )
+    generation_pool.init_app(
+        app, socketio,
+        max_workers=int(os.getenv("AIDM_GENERATION_WORKERS", "4")),
+        max_pending_per_key=int(os.getenv("AIDM_GENERATION_MAX_PENDING", "8"))
+    )
+    # Recaps, summaries and other long LLM tasks requested over HTTP.
+    jobs.init_app(
+        app, socketio,
+        max_workers=int(os.getenv("AIDM_JOB_WORKERS", "2")),
+        resume=not from_cli
+    )
+    metrics.init_app(app, socketio, generation_pool)
+    if not from_cli:
+        # Other server processes' cache invalidations (with a Redis queue).
+        invalidation_bus.init_app(app, socketio)
+
+    return app
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
         try:
             db.create_all()
-            logging.info("Database tables created successfully.")
+            logger.info("Database tables created successfully.")
         except Exception as e:
-            logging.error(f"Error creating database tables: {str(e)}")
+            logger.error(f"Error creating database tables: {str(e)}")
             raise
 
     try:
         socketio.run(app, debug=True, port=5000, allow_unsafe_werkzeug=True)
     except Exception as e:
-        logging.error(f"Error running the server: {str(e)}")
+        logger.error(f"Error running the server: {str(e)}")
         raise
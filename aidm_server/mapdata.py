@@ -0,0 +1,420 @@
+"""
+mapdata.py
+
+Chunked storage and partial updates for map data.
+
+A map's data is a JSON object. Its "tiles" member, the part that grows
+large, is a sparse grid {"x,y": tile, ...} (a list of rows is accepted on
+input and converted, skipping nulls). Tiles are stored in map_chunks rows of
+CHUNK_SIZE x CHUNK_SIZE tiles (AIDM_MAP_CHUNK_SIZE); everything else stays
+in Map.map_data. So:
+
+- a viewport query reads only the chunks overlapping the requested region,
+- a JSON Patch (RFC 6902 add/remove/replace/test) touching a few tiles
+  rewrites only their chunks, plus the small map_data for other paths,
+- every change bumps Map.data_version, which clients use to order the
+  map_delta events carrying the applied operations.
+
+Maps written before chunking keep their tiles inline in map_data until
+their next update moves them into chunks.
+"""
+
+import copy
+import os
+
+from flask import current_app
+from sqlalchemy import insert
+
+from aidm_server.database import db
+from aidm_server.jsonfields import dumps, loads
+from aidm_server.models import Map, MapChunk
+
+CHUNK_SIZE = int(os.getenv("AIDM_MAP_CHUNK_SIZE", "32"))
+TILES_KEY = "tiles"
+PATCH_OPS = ("add", "remove", "replace", "test")
+
+
+class MapDataError(ValueError):
+    """Raised for invalid map data, tile keys, regions or patch operations."""
+
+
+class MapVersionConflict(Exception):
+    """Raised when a patch was made against an older data_version."""
+
+    def __init__(self, current_version):
+        super().__init__(f"Map data is at version {current_version}")
+        self.current_version = current_version
+
+
+# ----------------------------------------------------------------------
+# Tiles and chunks
+# ----------------------------------------------------------------------
+def parse_tile_key(key):
+    """
+    Parse "x,y" into integer coordinates.
+
+    Raises:
+        MapDataError: If the key is not two comma separated integers.
+    """
+    try:
+        x, y = str(key).split(",")
+        return int(x), int(y)
+    except ValueError:
+        raise MapDataError(f"Invalid tile key: {key!r} (expected \"x,y\")")
+
+
+def tile_key(x, y):
+    return f"{x},{y}"
+
+
+def chunk_of(x, y):
+    return x // CHUNK_SIZE, y // CHUNK_SIZE
+
+
+def normalize_tiles(tiles):
+    """
+    Return tiles as {"x,y": tile} with canonical keys.
+
+    Args:
+        tiles: A {"x,y": tile} object, or a list of rows (row index is y,
+            column index is x; null cells are left out).
+    """
+    if isinstance(tiles, dict):
+        return {tile_key(*parse_tile_key(key)): value for key, value in tiles.items()}
+    if isinstance(tiles, list):
+        normalized = {}
+        for y, row in enumerate(tiles):
+            if not isinstance(row, list):
+                raise MapDataError("tiles rows must be lists")
+            for x, value in enumerate(row):
+                if value is not None:
+                    normalized[tile_key(x, y)] = value
+        return normalized
+    raise MapDataError("tiles must be an object of \"x,y\" keys or a list of rows")
+
+
+def parse_region(value):
+    """
+    Parse "x0,y0,x1,y1" (inclusive bounds, in any corner order).
+
+    Raises:
+        MapDataError: If the value is malformed.
+    """
+    try:
+        x0, y0, x1, y1 = (int(part) for part in value.split(","))
+    except (AttributeError, ValueError):
+        raise MapDataError("region must be x0,y0,x1,y1")
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def _in_region(key, region):
+    x, y = parse_tile_key(key)
+    x0, y0, x1, y1 = region
+    return x0 <= x <= x1 and y0 <= y <= y1
+
+
+def _group_by_chunk(tiles):
+    chunks = {}
+    for key, value in tiles.items():
+        chunks.setdefault(chunk_of(*parse_tile_key(key)), {})[key] = value
+    return chunks
+
+
+def _insert_chunks(map_id, chunks):
+    rows = [
+        {"map_id": map_id, "cx": cx, "cy": cy, "data": dumps(tiles)}
+        for (cx, cy), tiles in chunks.items() if tiles
+    ]
+    if rows:
+        db.session.execute(insert(MapChunk), rows)
+
+
+def load_tiles(map_id, region=None):
+    """
+    Return a map's tiles as {"x,y": tile}, optionally only those inside
+    region (x0, y0, x1, y1), reading only the chunks that overlap it.
+    """
+    query = MapChunk.query.with_entities(MapChunk.data).filter(MapChunk.map_id == map_id)
+    if region is not None:
+        (cx0, cy0), (cx1, cy1) = chunk_of(*region[:2]), chunk_of(*region[2:])
+        query = query.filter(MapChunk.cx.between(cx0, cx1), MapChunk.cy.between(cy0, cy1))
+    tiles = {}
+    for (data,) in query:
+        chunk = loads(data)
+        if region is None:
+            tiles.update(chunk)
+        else:
+            tiles.update((key, value) for key, value in chunk.items() if _in_region(key, region))
+    return tiles
+
+
+def load_tiles_for_maps(map_ids):
+    """
+    Return {map_id: tiles} for several maps in one query.
+    """
+    tiles = {}
+    if not map_ids:
+        return tiles
+    rows = MapChunk.query.with_entities(MapChunk.map_id, MapChunk.data)\
+        .filter(MapChunk.map_id.in_(list(map_ids))).all()
+    for map_id, data in rows:
+        tiles.setdefault(map_id, {}).update(loads(data))
+    return tiles
+
+
+# ----------------------------------------------------------------------
+# Whole-map reads and writes
+# ----------------------------------------------------------------------
+def load_meta(map_data):
+    """
+    Decode map_data as read by a Core query (JSON text).
+    """
+    return loads(map_data) if map_data else {}
+
+
+def merge_map_data(meta, tiles):
+    """
+    The map data as clients know it: map_data with the chunked tiles added.
+    """
+    if tiles:
+        meta = dict(meta)
+        meta[TILES_KEY] = tiles
+    return meta
+
+
+def load_map_data(map_obj):
+    """
+    Return the full map data (all tiles included) of a Map.
+    """
+    return merge_map_data(map_obj.map_data or {}, load_tiles(map_obj.map_id))
+
+
+def read_region(map_obj, region=None):
+    """
+    Return (map_data without tiles, tiles inside region). Without a region
+    no tiles are read and the second value is None.
+    """
+    meta = dict(map_obj.map_data or {})
+    if TILES_KEY in meta:
+        # Not chunked yet: filter the inline tiles.
+        inline = normalize_tiles(meta.pop(TILES_KEY))
+        if region is None:
+            return meta, None
+        return meta, {key: value for key, value in inline.items() if _in_region(key, region)}
+    if region is None:
+        return meta, None
+    return meta, load_tiles(map_obj.map_id, region)
+
+
+def replace_map_data(map_obj, data):
+    """
+    Replace a map's whole data. The map must already have an id (flush a
+    new map first). Does not commit.
+
+    Raises:
+        MapDataError: If data is not an object or its tiles are malformed.
+    """
+    if not isinstance(data, dict):
+        raise MapDataError("map_data must be a JSON object")
+    meta = dict(data)
+    tiles = normalize_tiles(meta.pop(TILES_KEY)) if TILES_KEY in meta else {}
+    MapChunk.query.filter_by(map_id=map_obj.map_id).delete(synchronize_session=False)
+    _insert_chunks(map_obj.map_id, _group_by_chunk(tiles))
+    map_obj.map_data = meta
+    map_obj.data_version = (map_obj.data_version or 0) + 1
+
+
+# ----------------------------------------------------------------------
+# JSON Patch
+# ----------------------------------------------------------------------
+def parse_pointer(path):
+    """
+    Split a JSON Pointer ("/a/b~1c") into unescaped reference tokens.
+    """
+    if not isinstance(path, str) or (path and not path.startswith("/")):
+        raise MapDataError(f"Invalid path: {path!r}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in path.split("/")[1:]]
+
+
+def _list_index(container, token, allow_end):
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith("0")):
+        raise MapDataError(f"Invalid array index: {token!r}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise MapDataError(f"Array index out of range: {index}")
+    return index
+
+
+def _apply_op(document, tokens, op, value, path):
+    """
+    Apply one operation at tokens (non-empty) inside document, in place.
+    path is the operation's full path, for error messages.
+    """
+    parent = document
+    for token in tokens[:-1]:
+        try:
+            parent = parent[_list_index(parent, token, False) if isinstance(parent, list) else token]
+        except (KeyError, TypeError):
+            raise MapDataError(f"Path not found: {path}")
+    last = tokens[-1]
+
+    if isinstance(parent, dict):
+        exists = last in parent
+        if op == "add":
+            parent[last] = value
+        elif not exists:
+            raise MapDataError(f"Path not found: {path}")
+        elif op == "replace":
+            parent[last] = value
+        elif op == "remove":
+            del parent[last]
+        elif parent[last] != value:
+            raise MapDataError(f"Test failed at {path}")
+    elif isinstance(parent, list):
+        index = _list_index(parent, last, op == "add")
+        if op == "add":
+            parent.insert(index, value)
+        elif op == "replace":
+            parent[index] = value
+        elif op == "remove":
+            del parent[index]
+        elif parent[index] != value:
+            raise MapDataError(f"Test failed at {path}")
+    else:
+        raise MapDataError(f"Path not found: {path}")
+
+
+def _escape_token(token):
+    return token.replace("~", "~0").replace("/", "~1")
+
+
+def validate_patch(ops):
+    """
+    Check the shape of a patch and return its operations with parsed paths
+    as (op, tokens, value) tuples.
+
+    Raises:
+        MapDataError: On anything but a list of add/remove/replace/test ops.
+    """
+    if not isinstance(ops, list) or not ops:
+        raise MapDataError("A patch is a non-empty list of operations")
+    parsed = []
+    for op in ops:
+        if not isinstance(op, dict) or op.get("op") not in PATCH_OPS:
+            raise MapDataError(f"Unsupported patch operation: {op!r} (use {', '.join(PATCH_OPS)})")
+        tokens = parse_pointer(op.get("path"))
+        if not tokens:
+            raise MapDataError("Patch the map's members; update the map's map_data to replace all of it")
+        if tokens[0] == TILES_KEY:
+            if len(tokens) == 1:
+                raise MapDataError("Patch individual tiles (/tiles/x,y); update the map's map_data to replace all tiles")
+            tokens[1] = tile_key(*parse_tile_key(tokens[1]))
+        if op["op"] != "remove" and "value" not in op:
+            raise MapDataError(f"Operation {op['op']} needs a value")
+        parsed.append((op["op"], tokens, op.get("value")))
+    return parsed
+
+
+def apply_patch(map_id, ops, base_version=None):
+    """
+    Apply a JSON Patch to a map's data atomically. Does not commit.
+
+    Paths under /tiles/<x,y> only load and rewrite the chunks of those
+    tiles; other paths edit the map's small map_data object.
+
+    Args:
+        map_id (int): The map to patch.
+        ops (list): RFC 6902 operations (add, remove, replace, test).
+        base_version (int): If given, the data_version the patch was made
+            against; the patch is rejected if the map has changed since.
+
+    Returns:
+        tuple: (new data_version, the applied add/remove/replace operations
+        with canonical paths, for broadcasting). A patch of only test
+        operations changes nothing and leaves the version as it was.
+
+    Raises:
+        MapDataError: If the patch is malformed or an operation fails.
+        MapVersionConflict: If base_version is not the current version.
+    """
+    parsed = validate_patch(ops)
+
+    # Bump the version first: the UPDATE takes the map's write lock, so
+    # concurrent patches of one map apply one after the other.
+    bumped = Map.query.filter(Map.map_id == map_id)\
+        .update({Map.data_version: Map.data_version + 1}, synchronize_session=False)
+    if not bumped:
+        raise MapDataError(f"Map not found: ID {map_id}")
+    version, map_data = db.session.query(Map.data_version, Map.map_data)\
+        .filter(Map.map_id == map_id).one()
+    if base_version is not None and base_version != version - 1:
+        raise MapVersionConflict(version - 1)
+
+    meta = load_meta(map_data)
+    meta_changed = False
+    chunks = {}
+    if TILES_KEY in meta:
+        # Written before chunking: move the inline tiles into chunks now.
+        legacy = _group_by_chunk(normalize_tiles(meta.pop(TILES_KEY)))
+        _insert_chunks(map_id, legacy)
+        meta_changed = True
+
+    dirty = set()
+    applied = []
+    for op, tokens, value in parsed:
+        path = "/" + "/".join(_escape_token(token) for token in tokens)
+        if tokens[0] == TILES_KEY:
+            position = chunk_of(*parse_tile_key(tokens[1]))
+            if position not in chunks:
+                row = db.session.get(MapChunk, (map_id, *position))
+                chunks[position] = [row, loads(row.data) if row else {}]
+            _apply_op(chunks[position][1], tokens[1:], op, copy.deepcopy(value), path)
+            if op != "test":
+                dirty.add(position)
+        else:
+            _apply_op(meta, tokens, op, copy.deepcopy(value), path)
+            meta_changed = meta_changed or op != "test"
+        if op == "test":
+            continue
+        entry = {"op": op, "path": path}
+        if op != "remove":
+            entry["value"] = value
+        applied.append(entry)
+
+    for position in dirty:
+        row, tiles = chunks[position]
+        if row is None:
+            if tiles:
+                db.session.add(MapChunk(map_id=map_id, cx=position[0], cy=position[1],
+                                        data=dumps(tiles)))
+        elif tiles:
+            row.data = dumps(tiles)
+        else:
+            db.session.delete(row)
+    if meta_changed:
+        Map.query.filter(Map.map_id == map_id)\
+            .update({Map.map_data: dumps(meta)}, synchronize_session=False)
+    if not applied:
+        # Nothing changed: take the bump back, so versions stay gapless.
+        Map.query.filter(Map.map_id == map_id)\
+            .update({Map.data_version: Map.data_version - 1}, synchronize_session=False)
+        version -= 1
+    return version, applied
+
+
+def broadcast_map_delta(map_id, version, ops=None):
+    """
+    Tell clients watching the map (see the watch_map event) what changed.
+    ops=None means the whole map was replaced and should be reloaded.
+    """
+    socketio = current_app.extensions.get('socketio')
+    if socketio is None:
+        return
+    payload = {"map_id": map_id, "version": version}
+    if ops is None:
+        payload["reload"] = True
+    else:
+        payload["ops"] = ops
+    socketio.emit('map_delta', payload, room=f"map:{map_id}")
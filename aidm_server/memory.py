@@ -0,0 +1,238 @@
+"""
+memory.py
+
+Hierarchical session memory for the DM prompt.
+
+Older session log entries are periodically folded into stored rolling
+summaries (SessionSummary). Level 0 summaries cover raw log entries; once
+enough of them pile up they are rolled up into a level 1 summary, and so on.
+The DM prompt is then built from the summaries plus the most recent raw
+entries, kept under a configurable token budget, and the end-of-session recap
+is produced from the summaries instead of the whole log.
+
+Summaries can be produced concurrently for one session (the per-message
+memory update and the summaries/recap jobs). Each run of entries is stored
+once per level, enforced by a unique index; the writer that loses the race
+rolls back and continues from the row the other one stored.
+"""
+
+import logging
+import os
+
+from sqlalchemy.exc import IntegrityError
+
+from aidm_server.database import db
+from aidm_server.models import SessionLogEntry, SessionSummary
+
+logger = logging.getLogger(__name__)
+
+# Rough size of the memory section of the DM prompt, in tokens.
+TOKEN_BUDGET = int(os.getenv("AIDM_MEMORY_TOKEN_BUDGET", "1500"))
+# Number of raw log entries folded into one level 0 summary.
+CHUNK_ENTRIES = int(os.getenv("AIDM_MEMORY_CHUNK_ENTRIES", "40"))
+# Raw entries always left unsummarized at the end of the log.
+KEEP_RECENT_ENTRIES = int(os.getenv("AIDM_MEMORY_KEEP_RECENT", "20"))
+# Number of summaries of one level rolled up into the next level.
+ROLLUP_SIZE = int(os.getenv("AIDM_MEMORY_ROLLUP_SIZE", "4"))
+# Share of the budget reserved for raw recent entries before summaries are added.
+RECENT_SHARE = 0.6
+
+SUMMARY_SYSTEM_MESSAGE = "You are a D&D session chronicler. Be concise and factual."
+
+
+def estimate_tokens(text):
+    """
+    Cheap token estimate (~4 characters per token), good enough for budgeting.
+    """
+    return len(text) // 4 + 1
+
+
+def summarized_up_to(session_id):
+    """
+    Return the id of the last log entry covered by a summary (0 if none).
+    """
+    last = db.session.query(db.func.max(SessionSummary.last_entry_id))\
+        .filter(SessionSummary.session_id == session_id).scalar()
+    return last or 0
+
+
+def load_summaries(session_id):
+    """
+    Return the active (not superseded) summaries in story order.
+    """
+    return SessionSummary.query.filter_by(session_id=session_id, superseded=False)\
+        .order_by(SessionSummary.first_entry_id).all()
+
+
+def select_within_budget(summaries, entries, token_budget=None):
+    """
+    Pick what fits in the token budget: the newest raw entries first (up to
+    RECENT_SHARE of the budget), then the newest summaries, then any
+    remaining raw entries.
+
+    Args:
+        summaries (list[str]): Summary texts in story order.
+        entries (list[str]): Raw log messages in story order.
+        token_budget (int): Budget in estimated tokens.
+
+    Returns:
+        tuple: (selected summaries, selected entries), both in story order.
+    """
+    budget = TOKEN_BUDGET if token_budget is None else token_budget
+
+    def take_newest(items, limit):
+        taken, used = [], 0
+        for item in reversed(items):
+            cost = estimate_tokens(item)
+            if used + cost > limit:
+                break
+            taken.append(item)
+            used += cost
+        taken.reverse()
+        return taken, used
+
+    recent, used = take_newest(entries, int(budget * RECENT_SHARE))
+    chosen_summaries, summary_used = take_newest(summaries, budget - used)
+    used += summary_used
+    if len(recent) < len(entries):
+        older, _ = take_newest(entries[:len(entries) - len(recent)], budget - used)
+        recent = older + recent
+    return chosen_summaries, recent
+
+
+def render_memory(summaries, entries):
+    """
+    Render the memory section of the DM context.
+    """
+    text = ""
+    if summaries:
+        text += "\nSTORY SO FAR:\n" + "\n".join(summaries)
+    if entries:
+        text += "\nRECENT EVENTS:\n" + "\n".join(entries)
+    return text
+
+
+def _default_llm_call(prompt, system_message):
+    from aidm_server.llm import query_gpt
+    return query_gpt(prompt=prompt, system_message=system_message)
+
+
+def _summarize(texts, llm_call, level):
+    what = "session log excerpt" if level == 0 else "sequence of earlier summaries"
+    prompt = (
+        f"Summarize this {what} from an ongoing D&D session in a short paragraph. "
+        "Keep names, places, items, decisions and unresolved threads:\n\n" + "\n".join(texts)
+    )
+    return (llm_call(prompt, SUMMARY_SYSTEM_MESSAGE) or "").strip()
+
+
+def _store(session_id, summary):
+    """
+    Commit a new summary (and any superseded flags set on the session).
+
+    Returns:
+        bool: False if another writer already stored this run, in which
+        case the transaction has been rolled back.
+    """
+    db.session.add(summary)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        logger.info(f"Level {summary.level} summary from entry {summary.first_entry_id} "
+                    f"of session {session_id} was already stored by another worker")
+        return False
+    return True
+
+
+def summarize_pending(session_id, llm_call=None, keep_recent=None):
+    """
+    Fold complete chunks of unsummarized log entries into level 0 summaries
+    and roll summaries up into higher levels where enough have accumulated.
+
+    Args:
+        session_id (int): The session to summarize.
+        llm_call (callable): llm_call(prompt, system_message) -> str. Defaults
+            to llm.query_gpt; pass a wrapper to run it off the event loop.
+        keep_recent (int): Raw entries to leave unsummarized at the end.
+
+    Returns:
+        int: Number of summaries created.
+    """
+    llm_call = llm_call or _default_llm_call
+    keep_recent = KEEP_RECENT_ENTRIES if keep_recent is None else keep_recent
+    created = 0
+
+    while True:
+        boundary = summarized_up_to(session_id)
+        pending = SessionLogEntry.query\
+            .filter(SessionLogEntry.session_id == session_id, SessionLogEntry.id > boundary)\
+            .order_by(SessionLogEntry.id)\
+            .limit(CHUNK_ENTRIES + keep_recent).all()
+        if len(pending) < CHUNK_ENTRIES + keep_recent:
+            break
+
+        chunk = pending[:CHUNK_ENTRIES]
+        summary = _summarize([e.message for e in chunk], llm_call, level=0)
+        if not summary:
+            break
+        if _store(session_id, SessionSummary(
+            session_id=session_id,
+            level=0,
+            first_entry_id=chunk[0].id,
+            last_entry_id=chunk[-1].id,
+            summary=summary
+        )):
+            created += 1
+
+    created += _roll_up(session_id, llm_call)
+    if created:
+        logger.info(f"Stored {created} new summaries for session {session_id}")
+    return created
+
+
+def _roll_up(session_id, llm_call):
+    created = 0
+    level = 0
+    while True:
+        active = SessionSummary.query.filter_by(
+            session_id=session_id, level=level, superseded=False
+        ).order_by(SessionSummary.first_entry_id).all()
+        if not active:
+            return created
+        if len(active) < ROLLUP_SIZE:
+            level += 1
+            continue
+
+        group = active[:ROLLUP_SIZE]
+        summary = _summarize([s.summary for s in group], llm_call, level=level + 1)
+        if not summary:
+            return created
+        for s in group:
+            s.superseded = True
+        if _store(session_id, SessionSummary(
+            session_id=session_id,
+            level=level + 1,
+            first_entry_id=group[0].first_entry_id,
+            last_entry_id=group[-1].last_entry_id,
+            summary=summary
+        )):
+            created += 1
+
+
+def build_recap_source(session_id):
+    """
+    Text to recap a session from: its active summaries followed by the raw
+    entries that no summary covers yet.
+    """
+    summaries = [s.summary for s in load_summaries(session_id)]
+    tail = SessionLogEntry.query\
+        .filter(SessionLogEntry.session_id == session_id,
+                SessionLogEntry.id > summarized_up_to(session_id))\
+        .order_by(SessionLogEntry.id).all()
+    parts = []
+    if summaries:
+        parts.append("Summary of earlier play:\n" + "\n\n".join(summaries))
+    if tail:
+        parts.append("Latest events:\n" + "\n".join(e.message for e in tail))
+    return "\n\n".join(parts)
@@ -0,0 +1,359 @@
+"""
+metrics.py
+
+Lightweight, dependency-free metrics in the Prometheus text format.
+
+The hot paths record into process-wide counters and fixed-bucket histograms
+(a lock and a few additions per observation, cheap enough to leave on in
+production); GET /metrics renders them. Gauges are computed on scrape from
+callbacks, so nothing is tracked between scrapes.
+
+Instrumented:
+- handle_send_message stages (validation, DB writes, segment checks,
+  DM context, LLM time to first chunk, total stream time, emits),
+- HTTP request latency per route, and SQL queries/time per request,
+- gauges for active rooms, connected sockets and in-flight generations,
+  plus the DM stream, LLM cache and response cache counters.
+
+Set AIDM_METRICS=0 to skip the request/SQL hooks entirely.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_sql_usage = contextvars.ContextVar("aidm_sql_usage", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else repr(value)
+    return str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = self.header()
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        lines = self.header()
+        for labels, values in series:
+            counts, total, count = values[:-2], values[-2], values[-1]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {count}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(float(total))}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """
+    A gauge or counter whose samples are read from a callback at scrape time.
+    The callback returns a number, or a dict of label tuple -> number.
+    """
+
+    def __init__(self, name, documentation, callback, labels=(), kind="gauge"):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self.callback = callback
+
+    def render(self):
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        samples = value.items() if isinstance(value, dict) else [((), value)]
+        lines = self.header()
+        for labels, sample in samples:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(sample)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, CallbackMetric):
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def callback(self, name, documentation, callback, labels=(), kind="gauge"):
+        return self.register(CallbackMetric(name, documentation, callback, labels, kind))
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+SEND_MESSAGE_STAGE_SECONDS = registry.histogram(
+    "aidm_send_message_stage_seconds",
+    "Time spent in each stage of handling a chat message.",
+    labels=("stage",)
+)
+SEND_MESSAGES = registry.counter(
+    "aidm_send_messages_total", "Chat messages handled, by outcome.", labels=("outcome",)
+)
+DM_ROUNDS = registry.counter(
+    "aidm_dm_rounds_total", "Round-mode batches sent to the DM, by what closed them.",
+    labels=("reason",)
+)
+DM_ROUND_ACTIONS = registry.histogram(
+    "aidm_dm_round_actions", "Player actions answered per round-mode DM call.",
+    buckets=COUNT_BUCKETS
+)
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "aidm_http_request_duration_seconds",
+    "HTTP request latency per route.",
+    labels=("method", "route", "status")
+)
+HTTP_REQUEST_SQL_QUERIES = registry.histogram(
+    "aidm_http_request_sql_queries",
+    "SQL statements executed per HTTP request.",
+    labels=("method", "route"),
+    buckets=COUNT_BUCKETS
+)
+HTTP_REQUEST_SQL_SECONDS = registry.histogram(
+    "aidm_http_request_sql_seconds",
+    "Time spent executing SQL per HTTP request.",
+    labels=("method", "route")
+)
+SQL_QUERIES = registry.counter("aidm_sql_queries_total", "SQL statements executed.")
+SQL_SECONDS = registry.counter("aidm_sql_query_seconds_total", "Time spent executing SQL statements.")
+
+
+def observe_stage(stage, seconds):
+    """
+    Record the duration of one handle_send_message stage.
+    """
+    SEND_MESSAGE_STAGE_SECONDS.observe(seconds, stage)
+
+
+def stage_timer(stage):
+    """
+    Context manager timing one handle_send_message stage.
+    """
+    return SEND_MESSAGE_STAGE_SECONDS.time(stage)
+
+
+# ----------------------------------------------------------------------
+# Request and SQL hooks
+# ----------------------------------------------------------------------
+# The start time is kept on the statement's execution context, which is
+# discarded along with it when the statement fails.
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.aidm_query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "aidm_query_started", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    SQL_QUERIES.inc()
+    SQL_SECONDS.inc(amount=elapsed)
+    usage = _sql_usage.get()
+    if usage is not None:
+        usage[0] += 1
+        usage[1] += elapsed
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_sql_token = _sql_usage.set([0, 0.0])
+
+
+def _after_request(response):
+    started = g.pop("metrics_started", None)
+    token = g.pop("metrics_sql_token", None)
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - started, request.method, route, str(response.status_code)
+    )
+    usage = _sql_usage.get()
+    if usage is not None:
+        HTTP_REQUEST_SQL_QUERIES.observe(usage[0], request.method, route)
+        HTTP_REQUEST_SQL_SECONDS.observe(usage[1], request.method, route)
+    if token is not None:
+        _sql_usage.reset(token)
+    return response
+
+
+_sql_hooks_installed = False
+
+
+def init_app(app, socketio=None, generation_pool=None):
+    """
+    Install the request/SQL hooks and register the scrape-time gauges.
+    """
+    global _sql_hooks_installed
+    if os.getenv("AIDM_METRICS", "1").lower() in ("0", "false", "off", "no"):
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    if not _sql_hooks_installed:
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        _sql_hooks_installed = True
+
+    from aidm_server.presence import get_presence_store
+    from aidm_server.streaming import stream_stats
+    from aidm_server.llm_cache import llm_cache
+    from aidm_server.response_cache import response_cache
+    from aidm_server.rounds import round_collector
+    from aidm_server.prompts import prefix_registry
+
+    registry.callback(
+        "aidm_active_rooms", "Sessions with at least one active player.",
+        lambda: get_presence_store().stats()["sessions"]
+    )
+    registry.callback(
+        "aidm_active_players", "Players active in a session.",
+        lambda: get_presence_store().stats()["players"]
+    )
+    registry.callback(
+        "aidm_prompt_prefix_total", "DM prompt prefix counters (prompts, reused, provider cache use).",
+        lambda: {(name,): value for name, value in prefix_registry.stats().items()
+                 if name not in ("entries", "reuse_rate")},
+        labels=("counter",), kind="counter"
+    )
+    registry.callback(
+        "aidm_open_rounds", "Round-mode rounds still collecting actions.",
+        lambda: round_collector.stats()["open_rounds"]
+    )
+    if socketio is not None:
+        registry.callback(
+            "aidm_connected_sockets", "Socket.IO connections open on this process.",
+            lambda: len(getattr(socketio.server.eio, "sockets", {}))
+        )
+    if generation_pool is not None:
+        registry.callback(
+            "aidm_generations_in_flight", "DM generations currently running.",
+            lambda: generation_pool.in_flight
+        )
+        registry.callback(
+            "aidm_generations_pending", "DM generation jobs waiting for a worker.",
+            lambda: generation_pool.pending()
+        )
+    registry.callback(
+        "aidm_dm_stream_total", "DM stream output counters.",
+        lambda: {(name,): value for name, value in stream_stats.snapshot().items()
+                 if name != "chunks_per_packet"},
+        labels=("counter",), kind="counter"
+    )
+    registry.callback(
+        "aidm_llm_cache_total", "LLM result cache counters.",
+        lambda: {(name,): value for name, value in llm_cache.stats().items()
+                 if name not in ("memory_entries", "in_flight", "hit_rate")},
+        labels=("counter",), kind="counter"
+    )
+    registry.callback(
+        "aidm_response_cache_total", "Cached GET response counters.",
+        lambda: {(name,): value for name, value in response_cache.stats().items()
+                 if name != "entries"},
+        labels=("counter",), kind="counter"
+    )
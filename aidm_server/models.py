@@ -1,9 +1,23 @@
 from aidm_server.database import db
+from aidm_server.jsonfields import (
+    json_field, JSONList, JSONObject, JSONOneOf, JSON_NUMBER, JSON_STRING
+)
 from datetime import datetime
 import json
-import logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Schemas of the JSON columns (see aidm_server.jsonfields). Lists of names
+# take plain strings or objects with at least a "name".
+NAMED_ENTRY = JSONOneOf(
+    JSON_STRING, JSONObject(fields={"name": JSON_STRING}, required=("name",)),
+    name="a string or an object with a name"
+)
+PLAYER_STATS = JSONObject(values=JSON_NUMBER)         # e.g. {"str": 16, "dex": 12}
+PLAYER_INVENTORY = JSONList(NAMED_ENTRY)
+CHARACTER_SHEET = JSONObject()
+PLOT_POINTS = JSONList(JSONOneOf(JSON_STRING, JSONObject(), name="a string or an object"))
+ACTIVE_NPCS = JSONList(NAMED_ENTRY)
+SEGMENT_TAGS = JSONList(JSON_STRING, separators=",\n")
+MAP_DATA = JSONObject()
 
 class World(db.Model):
     __tablename__ = 'worlds'
@@ -20,8 +34,10 @@ class Campaign(db.Model):
     world_id = db.Column(db.Integer, db.ForeignKey('worlds.world_id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     current_quest = db.Column(db.String, nullable=True)
-    plot_points = db.Column(db.Text)
-    active_npcs = db.Column(db.Text)
+    _plot_points = db.Column('plot_points', db.Text)
+    plot_points = json_field('_plot_points', PLOT_POINTS)
+    _active_npcs = db.Column('active_npcs', db.Text)
+    active_npcs = json_field('_active_npcs', ACTIVE_NPCS)
     location = db.Column(db.Text)
 
     world = db.relationship('World', backref='campaigns')
@@ -33,24 +49,48 @@ class Map(db.Model):
     campaign_id = db.Column(db.Integer, db.ForeignKey('campaigns.campaign_id'), nullable=True)
     title = db.Column(db.String, nullable=False)
     description = db.Column(db.Text)
-    map_data = db.Column(db.Text)
+    # Everything except the tiles, which live in map_chunks (see aidm_server.mapdata).
+    _map_data = db.Column('map_data', db.Text)
+    map_data = json_field('_map_data', MAP_DATA)
+    # Bumped on every change to the map data; sent with map_delta events.
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     world = db.relationship('World', backref='maps')
+    chunks = db.relationship('MapChunk', cascade="all, delete-orphan")
+
+    __table_args__ = (
+        db.Index('ix_maps_world_id_campaign_id', 'world_id', 'campaign_id'),
+        db.Index('ix_maps_campaign_id', 'campaign_id'),
+    )
     campaign = db.relationship('Campaign', backref='maps')
 
+class MapChunk(db.Model):
+    """
+    One square of a map's tiles: a JSON object of "x,y" -> tile for the
+    tiles with x // CHUNK_SIZE == cx and y // CHUNK_SIZE == cy.
+    """
+    __tablename__ = 'map_chunks'
+    map_id = db.Column(db.Integer, db.ForeignKey('maps.map_id'), primary_key=True, autoincrement=False)
+    cx = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    cy = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = db.Column(db.Text, nullable=False)
+
 class Player(db.Model):
     __tablename__ = 'players'
     player_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    campaign_id = db.Column(db.Integer, db.ForeignKey('campaigns.campaign_id'), nullable=False)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaigns.campaign_id'), nullable=False, index=True)
     name = db.Column(db.String, nullable=False)
     character_name = db.Column(db.String, nullable=False)
     race = db.Column(db.String)
     class_ = db.Column(db.String)
     level = db.Column(db.Integer, default=1)
-    stats = db.Column(db.Text)
-    inventory = db.Column(db.Text)
-    character_sheet = db.Column(db.Text)
+    _stats = db.Column('stats', db.Text)
+    stats = json_field('_stats', PLAYER_STATS)
+    _inventory = db.Column('inventory', db.Text)
+    inventory = json_field('_inventory', PLAYER_INVENTORY)
+    _character_sheet = db.Column('character_sheet', db.Text)
+    character_sheet = json_field('_character_sheet', CHARACTER_SHEET)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     campaign = db.relationship('Campaign', backref='players')
@@ -58,9 +98,13 @@ class Player(db.Model):
 class Session(db.Model):
     __tablename__ = 'sessions'
     session_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    campaign_id = db.Column(db.Integer, db.ForeignKey('campaigns.campaign_id'), nullable=False)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaigns.campaign_id'), nullable=False, index=True)
     state_snapshot = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # "message": the DM answers every chat message; "round": actions are
+    # collected and answered together (see aidm_server.rounds).
+    turn_mode = db.Column(db.String, nullable=False, default='message', server_default='message')
+    round_window_seconds = db.Column(db.Float)  # None: AIDM_ROUND_WINDOW_SECONDS
 
     campaign = db.relationship('Campaign', backref='sessions')
     log_entries = db.relationship('SessionLogEntry', backref='session', cascade="all, delete-orphan")
@@ -86,6 +130,10 @@ class PlayerAction(db.Model):
     player = db.relationship('Player', backref='actions')
     session = db.relationship('Session', backref='player_actions')
 
+    __table_args__ = (
+        db.Index('ix_player_actions_player_id_timestamp', 'player_id', 'timestamp'),
+    )
+
 class StoryEvent(db.Model):
     __tablename__ = 'story_events'
     event_id = db.Column(db.Integer, primary_key=True)
@@ -102,9 +150,96 @@ class SessionLogEntry(db.Model):
     entry_type = db.Column(db.String, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_session_log_entries_session_id_timestamp', 'session_id', 'timestamp'),
+    )
+
+class SessionSummary(db.Model):
+    """
+    Rolling summary of a run of session log entries.
+
+    Level 0 summaries cover raw SessionLogEntry rows; level N+1 summaries
+    roll up several level N summaries, which are then marked superseded.
+    A run is summarized once per level: (session_id, level, first_entry_id)
+    is unique.
+    """
+    __tablename__ = 'session_summaries'
+    summary_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.session_id'), nullable=False)
+    level = db.Column(db.Integer, nullable=False, default=0)
+    first_entry_id = db.Column(db.Integer, nullable=False)
+    last_entry_id = db.Column(db.Integer, nullable=False)
+    summary = db.Column(db.Text, nullable=False)
+    superseded = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    session = db.relationship('Session', backref=db.backref('summaries', cascade="all, delete-orphan"))
+
+    __table_args__ = (
+        db.Index('ix_session_summaries_session_id_superseded', 'session_id', 'superseded'),
+        db.Index('uq_session_summaries_session_id_level_first_entry_id',
+                 'session_id', 'level', 'first_entry_id', unique=True),
+    )
+
+class Job(db.Model):
+    """
+    A long-running task (session recap, summaries, ...) executed in the
+    background by aidm_server.jobs. params and result are JSON text.
+    """
+    __tablename__ = 'jobs'
+    job_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String, nullable=False)
+    # Jobs sharing a key run one at a time; an active job is reused for the same kind and key.
+    key = db.Column(db.String)
+    # Socket.IO room notified when the job finishes.
+    room = db.Column(db.String)
+    params = db.Column(db.Text)
+    status = db.Column(db.String, nullable=False, default='queued')
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_jobs_status', 'status'),
+        db.Index('ix_jobs_kind_key_status', 'kind', 'key', 'status'),
+        # At most one queued or running job per kind and key.
+        db.Index('uq_jobs_kind_key_active', 'kind', 'key', unique=True,
+                 sqlite_where=db.text("status IN ('queued', 'running')"),
+                 postgresql_where=db.text("status IN ('queued', 'running')")),
+    )
+
+def session_log_query(session_id, after=None, descending=False):
+    """
+    Query a session's log in (timestamp, id) order, optionally starting
+    strictly after (or, when descending, before) a (timestamp, id) key.
+    """
+    key = db.tuple_(SessionLogEntry.timestamp, SessionLogEntry.id)
+    query = SessionLogEntry.query.filter(SessionLogEntry.session_id == session_id)
+    if after is not None:
+        query = query.filter(key < after if descending else key > after)
+    if descending:
+        return query.order_by(SessionLogEntry.timestamp.desc(), SessionLogEntry.id.desc())
+    return query.order_by(SessionLogEntry.timestamp, SessionLogEntry.id)
+
+def iter_session_log(session_id, after=None, batch_size=500):
+    """
+    Yield a session's log entries in order, one keyset batch at a time,
+    so memory stays flat however long the log is.
+    """
+    while True:
+        batch = session_log_query(session_id, after).limit(batch_size).all()
+        if not batch:
+            return
+        yield from batch
+        after = (batch[-1].timestamp, batch[-1].id)
+        if len(batch) < batch_size:
+            return
+
 def get_full_session_log(session_id):
-    entries = SessionLogEntry.query.filter_by(session_id=session_id).order_by(SessionLogEntry.timestamp).all()
-    return "\n".join(entry.message for entry in entries)
+    return "\n".join(entry.message for entry in iter_session_log(session_id))
 
 # -- NEW MODEL FOR CAMPAIGN SEGMENTS --
 class CampaignSegment(db.Model):
@@ -118,8 +253,13 @@ class CampaignSegment(db.Model):
     title = db.Column(db.String, nullable=False)
     description = db.Column(db.Text, nullable=True)
     trigger_condition = db.Column(db.Text, nullable=True)  # e.g. JSON or mini-DSL
-    tags = db.Column(db.Text, nullable=True)               # store keywords / context data
+    _tags = db.Column('tags', db.Text, nullable=True)
+    tags = json_field('_tags', SEGMENT_TAGS)               # list of keywords
     is_triggered = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     campaign = db.relationship('Campaign', backref='segments')
+
+    __table_args__ = (
+        db.Index('ix_campaign_segments_campaign_id_is_triggered', 'campaign_id', 'is_triggered'),
+    )
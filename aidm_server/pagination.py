@@ -0,0 +1,198 @@
+"""
+pagination.py
+
+Helpers shared by the list endpoints: limit parsing, opaque keyset cursors
+and column projections (?fields=) for the paginated list endpoints.
+
+A cursor is the sort key of the last row a client has seen, encoded as
+URL-safe base64 JSON, so the next page is fetched with a plain indexed
+range query instead of OFFSET.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from flask import jsonify
+from sqlalchemy.orm import load_only
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+class PaginationError(ValueError):
+    """Raised for malformed limit/cursor parameters."""
+
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """
+    Parse a ?limit= value, clamped to [1, maximum].
+
+    Raises:
+        PaginationError: If the value is not an integer.
+    """
+    if value in (None, ""):
+        return default
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise PaginationError("limit must be an integer")
+    return max(1, min(limit, maximum))
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and "dt" in value:
+        return datetime.fromisoformat(value["dt"])
+    return value
+
+
+def encode_cursor(*values):
+    """
+    Encode a row's sort key (e.g. timestamp, id) as an opaque cursor string.
+    """
+    raw = json.dumps([_encode_value(v) for v in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, size):
+    """
+    Decode a cursor produced by encode_cursor into a tuple of `size` values.
+
+    Raises:
+        PaginationError: If the cursor is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if not isinstance(values, list) or len(values) != size:
+            raise ValueError("wrong cursor size")
+        return tuple(_decode_value(v) for v in values)
+    except (ValueError, TypeError, UnicodeError):
+        raise PaginationError("invalid cursor")
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+class Projection:
+    """
+    Describes which columns a list endpoint may return.
+
+    Args:
+        model: The SQLAlchemy model being listed.
+        key (str): Primary-key attribute used for ordering and cursors.
+        fields (dict): Output name -> (model attribute, serializer or None).
+        optional (iterable): Output names left out unless asked for with ?fields=,
+            i.e. heavy columns and anything the endpoint did not return before.
+    """
+
+    SERIALIZERS = {"datetime": _isoformat}
+
+    def __init__(self, model, key, fields, optional=()):
+        self.model = model
+        self.key = key
+        self.fields = fields
+        self.optional = set(optional)
+        self.default = [name for name in fields if name not in self.optional]
+
+    def parse_fields(self, value):
+        """
+        Parse ?fields=a,b,c. Returns the default projection if empty.
+
+        Raises:
+            PaginationError: If an unknown field is requested.
+        """
+        if not value:
+            return list(self.default)
+        requested = [name.strip() for name in value.split(",") if name.strip()]
+        unknown = [name for name in requested if name not in self.fields]
+        if unknown:
+            raise PaginationError(f"unknown fields: {', '.join(unknown)}")
+        return requested
+
+    def load_options(self, selected):
+        """
+        Only load the selected columns (plus the key); everything else stays
+        deferred and never leaves the database.
+        """
+        attributes = {self.key} | {self.fields[name][0] for name in selected}
+        return load_only(*(getattr(self.model, attr) for attr in sorted(attributes)))
+
+    def prepare(self, rows, selected):
+        """
+        Hook for loading data for a whole page at once before it is
+        serialized. The return value is passed to serialize as context.
+        """
+        return None
+
+    def serialize(self, obj, selected, context=None):
+        result = {}
+        for name in selected:
+            attr, serializer = self.fields[name]
+            value = getattr(obj, attr)
+            if serializer:
+                value = self.SERIALIZERS[serializer](value)
+            result[name] = value
+        return result
+
+    def serialize_all(self, rows, selected):
+        context = self.prepare(rows, selected)
+        return [self.serialize(obj, selected, context) for obj in rows]
+
+
+def paginated_list(query, projection, args):
+    """
+    Apply ?fields=, ?limit= and ?cursor= to a query and serialize the page.
+
+    Paging is opt-in: without limit or cursor every row is returned, as the
+    list endpoints always did, but optional (heavy) columns are still left out.
+
+    Args:
+        query: Base query (filters already applied).
+        projection (Projection): Column description of the model.
+        args: The request's query arguments.
+
+    Returns:
+        tuple: (list of serialized rows, next cursor or None)
+
+    Raises:
+        PaginationError: On malformed fields, limit or cursor values.
+    """
+    selected = projection.parse_fields(args.get('fields'))
+    key_column = getattr(projection.model, projection.key)
+    query = query.options(projection.load_options(selected)).order_by(key_column)
+
+    cursor = args.get('cursor')
+    paged = cursor is not None or args.get('limit') is not None
+    if cursor:
+        (last_key,) = decode_cursor(cursor, 1)
+        query = query.filter(key_column > last_key)
+
+    if not paged:
+        return projection.serialize_all(query.all(), selected), None
+
+    limit = parse_limit(args.get('limit'))
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(getattr(rows[-1], projection.key))
+    return projection.serialize_all(rows, selected), next_cursor
+
+
+def list_response(results, next_cursor):
+    """
+    JSON array response; the next page's cursor goes in the X-Next-Cursor
+    header so existing clients that expect a bare list keep working.
+    """
+    response = jsonify(results)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
@@ -0,0 +1,330 @@
+"""
+presence.py
+
+Who is connected to which game session.
+
+Presence used to live in module-level dicts in socketio_events.py, which
+pins every session to a single server process. The store is now pluggable:
+
+- "memory" (default): in-process dicts, for a single server process.
+- "redis": a shared Redis hash per session, so several server processes
+  (each running Socket.IO with the same message queue) see the same roster.
+
+The backend is chosen with AIDM_PRESENCE_BACKEND. When it is not set, the
+Redis store is used whenever AIDM_SOCKETIO_MESSAGE_QUEUE is configured, and
+it connects to AIDM_PRESENCE_URL (defaulting to the message queue URL).
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+CONNECTIONS_KEY = "connections"
+DEFAULT_PROCESS_TTL = 30.0
+
+
+class PresenceStore:
+    """
+    Tracks active players per session and which socket belongs to whom.
+
+    Session and player ids are stored as strings so every backend keys them
+    the same way no matter how a client sent them.
+    """
+
+    name = "base"
+
+    def join(self, session_id, player_id, player_data):
+        """
+        Add a player to a session's roster.
+
+        Returns:
+            bool: True if the player was not already active in the session.
+        """
+        raise NotImplementedError
+
+    def leave(self, session_id, player_id):
+        """
+        Remove a player from a session's roster.
+
+        Returns:
+            bool: True if the player was active and has been removed.
+        """
+        raise NotImplementedError
+
+    def players(self, session_id):
+        """
+        Return the session's active players (list of player data dicts).
+        """
+        raise NotImplementedError
+
+    def bind_connection(self, sid, session_id, player_id):
+        """
+        Remember which session/player a socket belongs to (for disconnects).
+        """
+        raise NotImplementedError
+
+    def pop_connection(self, sid):
+        """
+        Forget a socket.
+
+        Returns:
+            dict: {'session_id': ..., 'player_id': ...} or None if unknown.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Return counts of tracked sessions, players and connections.
+        """
+        raise NotImplementedError
+
+
+class InMemoryPresenceStore(PresenceStore):
+    """
+    Process-local presence; only correct with a single server process.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # { session_id: { player_id: {...player_data...} } }
+        self.sessions = {}
+        # { sid: {'session_id': x, 'player_id': y} }
+        self.connections = {}
+
+    def join(self, session_id, player_id, player_data):
+        with self._lock:
+            roster = self.sessions.setdefault(str(session_id), {})
+            if str(player_id) in roster:
+                return False
+            roster[str(player_id)] = player_data
+            return True
+
+    def leave(self, session_id, player_id):
+        with self._lock:
+            roster = self.sessions.get(str(session_id))
+            if not roster or str(player_id) not in roster:
+                return False
+            del roster[str(player_id)]
+            if not roster:
+                del self.sessions[str(session_id)]
+            return True
+
+    def players(self, session_id):
+        with self._lock:
+            return list(self.sessions.get(str(session_id), {}).values())
+
+    def bind_connection(self, sid, session_id, player_id):
+        with self._lock:
+            self.connections[sid] = {'session_id': session_id, 'player_id': player_id}
+
+    def pop_connection(self, sid):
+        with self._lock:
+            return self.connections.pop(sid, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self.sessions),
+                "players": sum(len(roster) for roster in self.sessions.values()),
+                "connections": len(self.connections),
+            }
+
+
+class RedisPresenceStore(PresenceStore):
+    """
+    Presence shared between server processes through Redis.
+
+    Each session's roster is a hash of player id -> JSON player data, and
+    socket ids map to their session/player in one more hash. Adds and
+    removals go through HSETNX/HDEL, so exactly one process broadcasts a
+    join or a leave even when two of them race on the same player.
+
+    Entries record the process that added them. Every process refreshes a
+    key that expires after process_ttl seconds (AIDM_PRESENCE_TTL) from a
+    heartbeat thread; entries of a process whose key has expired (it
+    crashed or was killed without its players leaving) are dropped when
+    they are read, and a player can join again in their place.
+
+    Args:
+        url (str): Redis URL, used when no client is given.
+        client: Any object with the redis-py hash API (hset, hsetnx, hget,
+            hdel, hgetall, hlen, scan_iter, set, exists). Pass a stand-in
+            such as fakeredis.FakeRedis() to run without a Redis server.
+        prefix (str): Key prefix, so several deployments can share a server.
+        process_ttl (float): Seconds after its last heartbeat that a
+            process's players are considered gone.
+        heartbeat (bool): Start the heartbeat thread.
+    """
+
+    name = "redis"
+
+    def __init__(self, url=None, client=None, prefix="aidm:presence:", process_ttl=None,
+                 heartbeat=True):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError(
+                    "The redis presence backend needs the 'redis' package (pip install redis)"
+                )
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0")
+        self.client = client
+        self.prefix = prefix
+        self.process_ttl = (process_ttl if process_ttl is not None else
+                            float(os.getenv("AIDM_PRESENCE_TTL", DEFAULT_PROCESS_TTL)))
+        self.owner = uuid.uuid4().hex
+        self.heartbeat()
+        if heartbeat:
+            threading.Thread(target=self._heartbeat_loop, name="presence-heartbeat",
+                             daemon=True).start()
+
+    def _session_key(self, session_id):
+        return f"{self.prefix}session:{session_id}"
+
+    def _process_key(self, owner):
+        return f"{self.prefix}process:{owner}"
+
+    @staticmethod
+    def _text(value):
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def heartbeat(self):
+        """
+        Mark this process as alive for another process_ttl seconds.
+        """
+        self.client.set(self._process_key(self.owner), "1", px=int(self.process_ttl * 1000))
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.process_ttl / 3)
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.warning(f"Presence heartbeat failed: {str(e)}")
+
+    def _decode(self, value):
+        """
+        Return (owner, data) of a stored entry; entries written before
+        owners were recorded have owner None and never expire.
+        """
+        entry = json.loads(self._text(value))
+        if isinstance(entry, dict) and set(entry) == {"owner", "data"}:
+            return entry["owner"], entry["data"]
+        return None, entry
+
+    def _encode(self, data):
+        return json.dumps({"owner": self.owner, "data": data})
+
+    def _gone(self, owners):
+        """
+        Return the owners among owners whose process is no longer alive.
+        """
+        return {
+            owner for owner in owners
+            if owner is not None and owner != self.owner
+            and not self.client.exists(self._process_key(owner))
+        }
+
+    def _live_entries(self, key):
+        """
+        Return {field: data} of a hash, deleting the entries of dead processes.
+        """
+        entries = {
+            self._text(field): self._decode(value)
+            for field, value in self.client.hgetall(key).items()
+        }
+        gone = self._gone({owner for owner, _ in entries.values()})
+        stale = [field for field, (owner, _) in entries.items() if owner in gone]
+        if stale:
+            self.client.hdel(key, *stale)
+        return {field: data for field, (owner, data) in entries.items() if owner not in gone}
+
+    def join(self, session_id, player_id, player_data):
+        key = self._session_key(session_id)
+        value = self._encode(player_data)
+        if self.client.hsetnx(key, str(player_id), value):
+            return True
+        current = self.client.hget(key, str(player_id))
+        if current is not None and not self._gone({self._decode(current)[0]}):
+            return False
+        # Left behind by a process that died: take the player over.
+        self.client.hset(key, str(player_id), value)
+        return True
+
+    def leave(self, session_id, player_id):
+        return bool(self.client.hdel(self._session_key(session_id), str(player_id)))
+
+    def players(self, session_id):
+        return list(self._live_entries(self._session_key(session_id)).values())
+
+    def bind_connection(self, sid, session_id, player_id):
+        self.client.hset(
+            self.prefix + CONNECTIONS_KEY, sid,
+            self._encode({'session_id': session_id, 'player_id': player_id})
+        )
+
+    def pop_connection(self, sid):
+        key = self.prefix + CONNECTIONS_KEY
+        data = self.client.hget(key, sid)
+        if data is None or not self.client.hdel(key, sid):
+            # Unknown, or another process handled this socket first.
+            return None
+        return self._decode(data)[1]
+
+    def stats(self):
+        session_keys = list(self.client.scan_iter(match=self._session_key("*")))
+        rosters = [self._live_entries(key) for key in session_keys]
+        return {
+            "sessions": sum(1 for roster in rosters if roster),
+            "players": sum(len(roster) for roster in rosters),
+            "connections": len(self._live_entries(self.prefix + CONNECTIONS_KEY)),
+        }
+
+
+_store = None
+_lock = threading.Lock()
+
+
+def create_presence_store(name=None):
+    """
+    Build the presence store selected by name or by the environment.
+
+    Raises:
+        ValueError: If the backend name is unknown.
+    """
+    message_queue = os.getenv("AIDM_SOCKETIO_MESSAGE_QUEUE")
+    name = (name or os.getenv("AIDM_PRESENCE_BACKEND") or
+            ("redis" if message_queue else "memory")).lower()
+    if name == "memory":
+        return InMemoryPresenceStore()
+    if name == "redis":
+        return RedisPresenceStore(url=os.getenv("AIDM_PRESENCE_URL") or message_queue)
+    raise ValueError(f"Unknown presence backend: {name}")
+
+
+def get_presence_store():
+    """
+    Return the process-wide presence store, creating it on first use.
+    """
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                _store = create_presence_store()
+    return _store
+
+
+def set_presence_store(store):
+    """
+    Replace the process-wide presence store (tests, benchmarks).
+    """
+    global _store
+    with _lock:
+        _store = store
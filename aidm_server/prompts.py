@@ -0,0 +1,334 @@
+"""
+prompts.py
+
+Assembly of DM prompts with a stable prefix.
+
+A DM prompt is split in two:
+
+- the prefix: system instructions, world, campaign (with the current quest
+  and location), the characters and the triggered segments' lore. It only
+  changes when one of those rows does, so consecutive turns of a session
+  (and sessions of the same campaign) send the same prefix byte for byte;
+- the suffix: the players' recent actions, the session memory, older
+  events and NPCs recalled by search for this input, the speaker(s) and
+  the player input, which change every turn.
+
+Each prefix is identified by a hash of PROMPT_VERSION and its text; bump
+PROMPT_VERSION whenever the templates here change. The prefix registry
+remembers recent prefix hashes, counts how often each session's prompts
+reuse a known prefix and, for providers with a context-caching API, keeps
+the provider-side cache handle of prefixes long enough to be worth caching
+(AIDM_PROMPT_CACHE_MIN_CHARS), so only the suffix is sent with each call.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+PROMPT_VERSION = "dm-3"
+
+DM_SYSTEM_INSTRUCTIONS = """
+You are a Dungeons & Dragons DM. Provide descriptive, story-focused responses.
+If an action warrants a dice roll, explicitly request it from the player.
+"""
+
+DEFAULT_REGISTRY_ENTRIES = 256
+DEFAULT_SESSION_ENTRIES = 1024
+DEFAULT_CACHE_MIN_CHARS = 16000
+DEFAULT_CACHE_TTL = 3600
+# After a failed provider cache creation, send full prompts for this long.
+CACHE_RETRY_SECONDS = 300
+
+
+class DMContext:
+    """
+    The sections of the DM context, as loaded by the context cache.
+
+    world, campaign, characters and segments make up the stable part;
+    recent_actions, memory and recall (search hits for the player input,
+    see search.py) change from turn to turn.
+    """
+
+    __slots__ = ("world", "campaign", "characters", "segments", "recent_actions", "memory", "recall")
+
+    def __init__(self, world, campaign, characters, segments, recent_actions="", memory="", recall=""):
+        self.world = world
+        self.campaign = campaign
+        self.characters = characters
+        self.segments = segments
+        self.recent_actions = recent_actions
+        self.memory = memory
+        self.recall = recall
+
+    def stable_text(self):
+        text = f"{self.world}\n\n{self.campaign}\n\n{self.characters}\n"
+        if self.segments:
+            text += f"\nTRIGGERED SEGMENTS:{self.segments}"
+        return text
+
+    def volatile_text(self):
+        text = f"{self.recent_actions}\n{self.memory}\n"
+        if self.recall:
+            text += f"\n{self.recall}"
+        return text
+
+    def __str__(self):
+        return f"{self.stable_text()}\n{self.volatile_text()}"
+
+
+def render_characters(players):
+    """
+    Render the character sheets of a roster ({player_id: info}).
+    """
+    characters = {
+        str(player_id): {key: info[key] for key in ("character_name", "race", "class", "level")}
+        for player_id, info in players.items()
+    }
+    return "PLAYER CHARACTERS:\n" + json.dumps(characters, indent=2)
+
+
+def render_recent_actions(players):
+    """
+    Render each player's latest actions, newest first.
+    """
+    actions = {
+        str(player_id): list(info["recent_actions"])
+        for player_id, info in players.items() if info["recent_actions"]
+    }
+    if not actions:
+        return ""
+    return "RECENT PLAYER ACTIONS (by player ID, newest first):\n" + json.dumps(actions, indent=2)
+
+
+class Prompt:
+    """
+    A prompt as a stable prefix plus a volatile suffix. str(prompt) is the
+    full text sent to providers without prefix caching.
+    """
+
+    __slots__ = ("prefix", "suffix", "prefix_hash")
+
+    def __init__(self, prefix, suffix):
+        self.prefix = prefix
+        self.suffix = suffix
+        digest = hashlib.sha256(PROMPT_VERSION.encode("utf-8") + b"\0" + prefix.encode("utf-8"))
+        self.prefix_hash = digest.hexdigest()
+
+    def __str__(self):
+        return self.prefix + self.suffix
+
+
+def assemble_dm_prompt(context, user_input, speaking_player=None, acting_players=None):
+    """
+    Build the DM prompt for a turn.
+
+    Args:
+        context (DMContext | str): The DM context. A plain string has no
+            known stable part and goes into the suffix.
+        user_input (str): The player input (one line per action for a round).
+        speaking_player (dict): {"character_name", "player_id"} of the speaker.
+        acting_players (list): The players of a round, instead of speaking_player.
+
+    Returns:
+        Prompt
+    """
+    if isinstance(context, DMContext):
+        prefix = f"{DM_SYSTEM_INSTRUCTIONS}\nCONTEXT:\n{context.stable_text()}\n"
+        volatile = context.volatile_text()
+    else:
+        prefix = f"{DM_SYSTEM_INSTRUCTIONS}\n"
+        volatile = f"CONTEXT:\n{context}\n"
+
+    speaker_text = ""
+    if speaking_player:
+        speaker_text = (
+            f"Current speaker: {speaking_player['character_name']} "
+            f"(ID: {speaking_player['player_id']}).\n"
+        )
+    elif acting_players:
+        names = ", ".join(
+            f"{player['character_name']} (ID: {player['player_id']})" for player in acting_players
+        )
+        speaker_text = (
+            f"Players acting this round: {names}.\n"
+            "Narrate one response that resolves all of their actions together, "
+            "in the order given, and address each of them.\n"
+        )
+
+    suffix = f"{volatile}\n{speaker_text}\nPLAYER INPUT:\n{user_input}\n"
+    return Prompt(prefix, suffix)
+
+
+class _PrefixEntry:
+    __slots__ = ("chars", "uses", "handle", "handle_owner", "handle_expires_at",
+                 "creating", "retry_at")
+
+    def __init__(self, chars):
+        self.chars = chars
+        self.uses = 0
+        self.handle = None
+        self.handle_owner = None  # (provider name, model) the handle belongs to
+        self.handle_expires_at = 0.0
+        self.creating = False
+        self.retry_at = 0.0
+
+
+class PrefixRegistry:
+    """
+    Recently used prompt prefixes by hash, with their provider cache
+    handles and per-session reuse counters.
+
+    Args:
+        max_entries (int): Prefixes remembered (least recently used dropped).
+        min_chars (int): Shortest prefix cached on the provider side.
+        ttl (float): Lifetime of provider-side caches, in seconds.
+        enabled (bool): Whether provider-side caching is used at all.
+    """
+
+    def __init__(self, max_entries=None, min_chars=None, ttl=None, enabled=None,
+                 max_sessions=DEFAULT_SESSION_ENTRIES):
+        self.max_entries = (max_entries if max_entries is not None else
+                            int(os.getenv("AIDM_PROMPT_PREFIX_ENTRIES", DEFAULT_REGISTRY_ENTRIES)))
+        self.min_chars = (min_chars if min_chars is not None else
+                          int(os.getenv("AIDM_PROMPT_CACHE_MIN_CHARS", DEFAULT_CACHE_MIN_CHARS)))
+        self.ttl = ttl if ttl is not None else float(os.getenv("AIDM_PROMPT_CACHE_TTL", DEFAULT_CACHE_TTL))
+        if enabled is None:
+            enabled = os.getenv("AIDM_PROMPT_CACHE", "1").lower() not in ("0", "false", "off", "no")
+        self.enabled = enabled
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._sessions = OrderedDict()
+        self._stats = dict.fromkeys(
+            ("prompts", "reused", "provider_cached", "provider_creates", "provider_errors"), 0
+        )
+
+    def record(self, prompt, session_id=None):
+        """
+        Register a prompt about to be sent. Returns True if its prefix was
+        already known (used by an earlier prompt).
+        """
+        released = []
+        with self._lock:
+            entry = self._entries.get(prompt.prefix_hash)
+            reused = entry is not None
+            if entry is None:
+                entry = self._entries[prompt.prefix_hash] = _PrefixEntry(len(prompt.prefix))
+                while len(self._entries) > self.max_entries:
+                    _, evicted = self._entries.popitem(last=False)
+                    if evicted.handle is not None:
+                        released.append(evicted)
+            self._entries.move_to_end(prompt.prefix_hash)
+            entry.uses += 1
+            self._stats["prompts"] += 1
+            self._stats["reused"] += reused
+
+            if session_id is not None:
+                stats = self._sessions.get(session_id)
+                if stats is None:
+                    stats = self._sessions[session_id] = {"prompts": 0, "reused": 0, "prefix_changes": 0,
+                                                          "prefix_hash": None}
+                    while len(self._sessions) > self.max_sessions:
+                        self._sessions.popitem(last=False)
+                self._sessions.move_to_end(session_id)
+                stats["prompts"] += 1
+                stats["reused"] += reused
+                if stats["prefix_hash"] not in (None, prompt.prefix_hash):
+                    stats["prefix_changes"] += 1
+                stats["prefix_hash"] = prompt.prefix_hash
+
+        for evicted in released:
+            self._release(evicted)
+        return reused
+
+    def provider_handle(self, provider, prompt):
+        """
+        Return the provider-side cache handle for the prompt's prefix,
+        creating it if the provider supports caching and the prefix is long
+        enough, or None to send the full prompt. Blocking (it may call the
+        provider); run it where model calls run.
+        """
+        if not self.enabled or not provider.supports_prefix_cache or len(prompt.prefix) < self.min_chars:
+            return None
+        owner = (provider.name, provider.model)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(prompt.prefix_hash)
+            if entry is None:
+                return None
+            if entry.handle is not None and entry.handle_owner == owner and entry.handle_expires_at > now:
+                self._stats["provider_cached"] += 1
+                return entry.handle
+            if entry.creating or entry.retry_at > now:
+                return None
+            entry.creating = True
+
+        try:
+            handle = provider.cache_prefix(prompt.prefix, self.ttl)
+        except Exception as e:
+            logger.warning(f"Could not cache prompt prefix {prompt.prefix_hash[:12]} "
+                           f"with {provider.name}: {str(e)}")
+            with self._lock:
+                entry.creating = False
+                entry.retry_at = now + CACHE_RETRY_SECONDS
+                self._stats["provider_errors"] += 1
+            return None
+
+        with self._lock:
+            entry.creating = False
+            entry.handle = handle
+            entry.handle_owner = owner
+            # Stop using the handle a little before the provider drops it.
+            entry.handle_expires_at = now + self.ttl * 0.9
+            self._stats["provider_creates"] += 1
+            self._stats["provider_cached"] += 1
+        logger.info(f"Cached prompt prefix {prompt.prefix_hash[:12]} ({len(prompt.prefix)} chars) "
+                    f"with {provider.name}")
+        return handle
+
+    def _release(self, entry):
+        from aidm_server.providers import get_provider
+        provider = get_provider()
+        if entry.handle_owner != (provider.name, provider.model):
+            return
+        try:
+            provider.release_prefix(entry.handle)
+        except Exception as e:
+            logger.debug(f"Could not release cached prompt prefix: {str(e)}")
+
+    def session_stats(self, session_id):
+        """
+        Prefix reuse of one session's prompts, or None if it sent none
+        since this process started.
+        """
+        with self._lock:
+            stats = self._sessions.get(session_id)
+            if stats is None:
+                return None
+            result = dict(stats)
+            entry = self._entries.get(stats["prefix_hash"])
+        result["reuse_rate"] = result["reused"] / result["prompts"]
+        result["prefix_chars"] = entry.chars if entry else None
+        result["provider_cached"] = bool(entry and entry.handle is not None)
+        return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        stats["reuse_rate"] = stats["reused"] / stats["prompts"] if stats["prompts"] else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sessions.clear()
+
+
+prefix_registry = PrefixRegistry()
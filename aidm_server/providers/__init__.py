@@ -0,0 +1,60 @@
+"""
+LLM provider selection.
+
+The backend is chosen with AIDM_LLM_PROVIDER ("gemini" by default, or
+"stub" for the local deterministic stand-in). Provider modules are only
+imported when selected.
+"""
+
+import importlib
+import os
+import threading
+
+from aidm_server.providers.base import LLMProvider
+
+PROVIDERS = {
+    "gemini": "aidm_server.providers.gemini:GeminiProvider",
+    "stub": "aidm_server.providers.stub:StubProvider",
+}
+
+_provider = None
+_lock = threading.Lock()
+
+
+def create_provider(name):
+    """
+    Instantiate a provider by its registered name.
+
+    Raises:
+        ValueError: If the name is not registered.
+    """
+    try:
+        target = PROVIDERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown LLM provider: {name}")
+    module_name, class_name = target.split(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def get_provider():
+    """
+    Return the process-wide provider, creating it on first use.
+    """
+    global _provider
+    if _provider is None:
+        with _lock:
+            if _provider is None:
+                _provider = create_provider(os.getenv("AIDM_LLM_PROVIDER", "gemini").lower())
+    return _provider
+
+
+def set_provider(provider):
+    """
+    Replace the process-wide provider (tests, benchmarks).
+    """
+    global _provider
+    with _lock:
+        _provider = provider
+
+
+__all__ = ['LLMProvider', 'PROVIDERS', 'create_provider', 'get_provider', 'set_provider']
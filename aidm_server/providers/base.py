@@ -0,0 +1,59 @@
+"""
+base.py
+
+Interface every LLM backend implements.
+"""
+
+
+class LLMProvider:
+    """
+    A text-generation backend.
+
+    Subclasses implement generate() and stream(); the llm.py entry points
+    only ever talk to a provider through these two calls. Providers with a
+    context-caching API also set supports_prefix_cache and implement the
+    *_cached methods, which send only a prompt's suffix after a prefix
+    cached with cache_prefix().
+    """
+
+    name = "base"
+    supports_prefix_cache = False
+
+    def __init__(self, model=None):
+        self.model = model
+
+    def generate(self, prompt):
+        """
+        Return the full response text for a prompt.
+        """
+        raise NotImplementedError
+
+    def stream(self, prompt):
+        """
+        Yield the response text for a prompt chunk by chunk.
+        """
+        raise NotImplementedError
+
+    def cache_prefix(self, prefix, ttl):
+        """
+        Store a prompt prefix on the provider side for ttl seconds and
+        return a handle for generate_cached()/stream_cached().
+        """
+        raise NotImplementedError
+
+    def release_prefix(self, handle):
+        """
+        Drop a cached prefix before it expires (optional).
+        """
+
+    def generate_cached(self, handle, suffix):
+        """
+        Like generate(), for the cached prefix followed by suffix.
+        """
+        raise NotImplementedError
+
+    def stream_cached(self, handle, suffix):
+        """
+        Like stream(), for the cached prefix followed by suffix.
+        """
+        raise NotImplementedError
@@ -0,0 +1,74 @@
+"""
+gemini.py
+
+Google Gemini backend. The SDK is imported and configured on first use,
+so importing the server (or selecting another provider) never pays for it.
+Long prompt prefixes are stored with Gemini context caching (see prompts.py).
+"""
+
+import datetime
+import os
+import threading
+
+from aidm_server.providers.base import LLMProvider
+
+DEFAULT_MODEL = "gemini-exp-1206"
+
+
+class GeminiProvider(LLMProvider):
+    name = "gemini"
+    # Context caching; only models that support it accept the cached
+    # content, others fail at cache creation and get full prompts.
+    supports_prefix_cache = True
+
+    def __init__(self, model=None, api_key=None):
+        super().__init__(model or os.getenv("AIDM_GEMINI_MODEL", DEFAULT_MODEL))
+        self._api_key = api_key
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    api_key = self._api_key or os.getenv("GOOGLE_GENAI_API_KEY")
+                    if not api_key:
+                        raise ValueError("GOOGLE_GENAI_API_KEY environment variable is not set")
+                    import google.generativeai as genai
+                    genai.configure(api_key=api_key)
+                    self._client = genai.GenerativeModel(self.model)
+        return self._client
+
+    def generate(self, prompt):
+        response = self._get_client().generate_content(prompt)
+        return response.text
+
+    def stream(self, prompt):
+        response = self._get_client().generate_content(prompt, stream=True)
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+    def cache_prefix(self, prefix, ttl):
+        self._get_client()
+        from google.generativeai import caching
+        return caching.CachedContent.create(
+            model=self.model, contents=[prefix], ttl=datetime.timedelta(seconds=ttl)
+        )
+
+    def release_prefix(self, handle):
+        handle.delete()
+
+    def _cached_client(self, handle):
+        import google.generativeai as genai
+        return genai.GenerativeModel.from_cached_content(cached_content=handle)
+
+    def generate_cached(self, handle, suffix):
+        response = self._cached_client(handle).generate_content(suffix)
+        return response.text
+
+    def stream_cached(self, handle, suffix):
+        response = self._cached_client(handle).generate_content(suffix, stream=True)
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
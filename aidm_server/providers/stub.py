@@ -0,0 +1,89 @@
+"""
+stub.py
+
+Local, deterministic LLM stand-in for load tests and offline benchmarks.
+
+Responses come from a script (AIDM_STUB_SCRIPT: a JSON list of strings, or a
+text file with responses separated by blank lines); the response for a
+prompt is picked by hashing the prompt, so the same prompt always gets the
+same answer. Streaming simulates a real model: the first chunk arrives after
+AIDM_STUB_LATENCY_MS, and the rest at AIDM_STUB_TOKENS_PER_SEC.
+"""
+
+import hashlib
+import json
+import os
+import re
+import time
+
+from aidm_server.providers.base import LLMProvider
+
+DEFAULT_SCRIPT = [
+    "The torchlight flickers as you step forward. Somewhere ahead, water drips "
+    "onto stone, and a low growl echoes through the corridor. Roll a d20 for "
+    "Perception to see what waits in the dark.",
+    "The innkeeper leans across the bar and lowers her voice. \"Strangers have "
+    "been asking about the old mine,\" she says. \"Folk who go up there don't "
+    "come back the same.\"",
+    "Your blade meets the goblin's rusty scimitar with a ringing clash. It "
+    "snarls and leaps back, eyeing the rest of the party. Roll initiative!",
+]
+
+_TOKEN_RE = re.compile(r"\S+\s*|\s+")
+
+
+def _load_script(path):
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    if path.endswith(".json"):
+        script = json.loads(content)
+    else:
+        script = [block.strip() for block in content.split("\n\n") if block.strip()]
+    if not script:
+        raise ValueError(f"Stub script {path} has no responses")
+    return script
+
+
+class StubProvider(LLMProvider):
+    name = "stub"
+
+    def __init__(self, script=None, latency_ms=None, tokens_per_sec=None, chunk_tokens=None):
+        super().__init__("stub")
+        script_path = os.getenv("AIDM_STUB_SCRIPT")
+        if script is None:
+            script = _load_script(script_path) if script_path else DEFAULT_SCRIPT
+        self.script = list(script)
+        self.latency = (latency_ms if latency_ms is not None
+                        else float(os.getenv("AIDM_STUB_LATENCY_MS", "200"))) / 1000.0
+        self.tokens_per_sec = (tokens_per_sec if tokens_per_sec is not None
+                               else float(os.getenv("AIDM_STUB_TOKENS_PER_SEC", "50")))
+        self.chunk_tokens = (chunk_tokens if chunk_tokens is not None
+                             else int(os.getenv("AIDM_STUB_CHUNK_TOKENS", "4")))
+
+    def response_for(self, prompt):
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        return self.script[int.from_bytes(digest[:4], "big") % len(self.script)]
+
+    def _chunks(self, text):
+        tokens = _TOKEN_RE.findall(text)
+        for i in range(0, len(tokens), self.chunk_tokens):
+            yield "".join(tokens[i:i + self.chunk_tokens]), len(tokens[i:i + self.chunk_tokens])
+
+    def generate(self, prompt):
+        text = self.response_for(prompt)
+        delay = self.latency
+        if self.tokens_per_sec > 0:
+            delay += len(_TOKEN_RE.findall(text)) / self.tokens_per_sec
+        if delay > 0:
+            time.sleep(delay)
+        return text
+
+    def stream(self, prompt):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        first = True
+        for chunk, token_count in self._chunks(self.response_for(prompt)):
+            if not first and self.tokens_per_sec > 0:
+                time.sleep(token_count / self.tokens_per_sec)
+            first = False
+            yield chunk
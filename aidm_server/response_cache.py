@@ -0,0 +1,149 @@
+"""
+response_cache.py
+
+Read-through cache of serialized JSON responses for the hot single-object
+REST reads (GET /api/worlds/<id>, /campaigns/<id>, /maps/<id>,
+/segments/<id>, /players/<id>), which the web client polls during play.
+
+Entries hold the ready-to-send response body and its ETag, so a hit costs
+neither a query nor JSON parsing/encoding (map_data in particular), and a
+client that sends If-None-Match with the current ETag gets a bodyless 304.
+The handlers that create, update or delete one of these rows call
+response_cache.invalidate(kind, id) after committing.
+
+The cache is per process and LRU-bounded (AIDM_RESPONSE_CACHE_ENTRIES).
+Invalidations are published to the other server processes (see
+invalidation.py). Entries also expire after AIDM_RESPONSE_CACHE_TTL seconds
+(0 disables expiry), which bounds staleness should one be lost.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+from aidm_server.invalidation import invalidation_bus
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 60.0
+
+
+class CachedResponse:
+    __slots__ = ("body", "etag", "expires_at")
+
+    def __init__(self, body, expires_at):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """
+    LRU cache of JSON response bodies keyed by (kind, id).
+
+    Args:
+        max_entries (int): Number of cached responses kept.
+        ttl (float): Seconds an entry stays valid (0 for no expiry).
+    """
+
+    def __init__(self, max_entries=None, ttl=None):
+        self.max_entries = (max_entries if max_entries is not None else
+                            int(os.getenv("AIDM_RESPONSE_CACHE_ENTRIES", DEFAULT_MAX_ENTRIES)))
+        self.ttl = ttl if ttl is not None else float(os.getenv("AIDM_RESPONSE_CACHE_TTL", DEFAULT_TTL))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # (kind, key) -> [loads in flight, invalidations since the first began]
+        self._loads = {}
+        self._stats = dict.fromkeys(("hits", "misses", "not_modified", "invalidations"), 0)
+
+    def get(self, kind, key, loader):
+        """
+        Return the CachedResponse for (kind, key), calling loader(key) on a
+        miss. The loader returns the JSON-serializable payload, or None if
+        the row doesn't exist (not cached).
+        """
+        cache_key = (kind, key)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and (entry.expires_at is None or entry.expires_at > now):
+                self._entries.move_to_end(cache_key)
+                self._stats["hits"] += 1
+                return entry
+            self._stats["misses"] += 1
+            load = self._loads.setdefault(cache_key, [0, 0])
+            load[0] += 1
+            version = load[1]
+
+        entry = None
+        try:
+            data = loader(key)
+            if data is not None:
+                entry = CachedResponse(
+                    current_app.json.response(data).get_data(),
+                    now + self.ttl if self.ttl > 0 else None
+                )
+        finally:
+            with self._lock:
+                # Only store the result if nothing invalidated this key while loading.
+                if entry is not None and load[1] == version:
+                    self._entries[cache_key] = entry
+                    self._entries.move_to_end(cache_key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                load[0] -= 1
+                if not load[0]:
+                    del self._loads[cache_key]
+        return entry
+
+    def _drop(self, kind, key):
+        cache_key = (kind, key)
+        with self._lock:
+            self._entries.pop(cache_key, None)
+            load = self._loads.get(cache_key)
+            if load is not None:
+                load[1] += 1
+            self._stats["invalidations"] += 1
+
+    def invalidate(self, kind, key):
+        self._drop(kind, key)
+        invalidation_bus.publish("response", kind, key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for load in self._loads.values():
+                load[1] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        return stats
+
+    def respond(self, kind, key, loader):
+        """
+        Build the response for a cached GET: 200 with the cached body, or
+        304 if the request's If-None-Match matches. Returns None when the
+        loader found nothing.
+        """
+        entry = self.get(kind, key, loader)
+        if entry is None:
+            return None
+        if request.if_none_match.contains(entry.etag):
+            with self._lock:
+                self._stats["not_modified"] += 1
+            response = Response(status=304)
+        else:
+            response = Response(entry.body, mimetype=current_app.json.mimetype)
+        response.set_etag(entry.etag)
+        # Clients may keep the body but must revalidate before using it.
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+
+response_cache = ResponseCache()
+invalidation_bus.register("response", response_cache._drop, response_cache.clear)
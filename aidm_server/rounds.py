@@ -0,0 +1,155 @@
+"""
+rounds.py
+
+Round mode: instead of one DM generation per chat message, a session in
+round mode collects the players' actions and answers them all with a
+single batched DM call.
+
+A round opens with the first action after the previous one closed and
+closes when every active player has acted or when its window runs out,
+whichever comes first. Actions are still stored, logged and checked for
+segment triggers as they arrive; only the DM call is deferred.
+
+Rounds are collected per server process. With several processes behind
+a message queue, each one batches the actions it receives.
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TURN_MODES = ("message", "round")
+DEFAULT_ROUND_WINDOW = float(os.getenv("AIDM_ROUND_WINDOW_SECONDS", "10"))
+MAX_ROUND_WINDOW = 300.0
+
+
+class Round:
+    """
+    The actions collected for one session since its round opened.
+    """
+
+    __slots__ = ("session_id", "world_id", "campaign_id", "token", "window",
+                 "opened_at", "actions", "pre_llm_db_time")
+
+    def __init__(self, session_id, world_id, campaign_id, token, window):
+        self.session_id = session_id
+        self.world_id = world_id
+        self.campaign_id = campaign_id
+        self.token = token
+        self.window = window
+        self.opened_at = time.monotonic()
+        self.actions = []  # (speaking_player, text), in arrival order
+        self.pre_llm_db_time = 0.0
+
+    @property
+    def player_ids(self):
+        return {player["player_id"] for player, _ in self.actions}
+
+    def players(self):
+        """The acting players, once each, in order of their first action."""
+        seen = {}
+        for player, _ in self.actions:
+            seen.setdefault(player["player_id"], player)
+        return list(seen.values())
+
+    def user_input(self):
+        """The round's actions as one block of PLAYER INPUT for the DM."""
+        return "\n".join(f"{player['character_name']}: {text}" for player, text in self.actions)
+
+    def remaining(self):
+        return max(0.0, self.window - (time.monotonic() - self.opened_at))
+
+
+class RoundCollector:
+    """
+    Open rounds by session id. Thread-safe; timers are left to the caller
+    (see socketio_events), which closes a round with close(session_id, token)
+    when its window has passed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rounds = {}
+        self._tokens = itertools.count(1)
+
+    def add(self, session_id, world_id, campaign_id, speaking_player, text,
+            active_player_ids, window, pre_llm_db_time=0.0):
+        """
+        Add one action to the session's round, opening a round if needed.
+
+        Args:
+            speaking_player (dict): {"character_name", "player_id"} of the actor.
+            active_player_ids (iterable): Players currently in the session;
+                the round closes once all of them have acted.
+            window (float): Seconds a newly opened round stays open.
+
+        Returns:
+            tuple: (round, opened, closed). opened is True if this action
+            opened the round (the caller starts its timer); closed is True
+            if it completed the round, which is then no longer collecting
+            and should be sent to the DM.
+        """
+        active = {str(player_id) for player_id in active_player_ids}
+        with self._lock:
+            current = self._rounds.get(session_id)
+            opened = current is None
+            if opened:
+                current = Round(session_id, world_id, campaign_id, next(self._tokens), window)
+                self._rounds[session_id] = current
+            current.actions.append((speaking_player, text))
+            current.pre_llm_db_time += pre_llm_db_time
+            closed = bool(active) and active <= current.player_ids
+            if closed:
+                del self._rounds[session_id]
+        return current, opened, closed
+
+    def close(self, session_id, token=None):
+        """
+        Stop collecting the session's open round and return it, or None if
+        there is none (or, with token, if that round already closed).
+        """
+        with self._lock:
+            current = self._rounds.get(session_id)
+            if current is None or (token is not None and current.token != token):
+                return None
+            return self._rounds.pop(session_id)
+
+    def complete(self, session_id, active_player_ids):
+        """
+        Close and return the session's round if every player still active
+        has acted (e.g. after the only one who hadn't left), else None.
+        """
+        active = {str(player_id) for player_id in active_player_ids}
+        with self._lock:
+            current = self._rounds.get(session_id)
+            if current is None or not active <= current.player_ids:
+                return None
+            return self._rounds.pop(session_id)
+
+    def get(self, session_id):
+        with self._lock:
+            return self._rounds.get(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "open_rounds": len(self._rounds),
+                "pending_actions": sum(len(r.actions) for r in self._rounds.values())
+            }
+
+
+def round_window(session_obj):
+    """
+    The window of a session's rounds: its own setting, or the
+    AIDM_ROUND_WINDOW_SECONDS default.
+    """
+    if session_obj.round_window_seconds is not None:
+        return session_obj.round_window_seconds
+    return DEFAULT_ROUND_WINDOW
+
+
+round_collector = RoundCollector()
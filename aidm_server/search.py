@@ -0,0 +1,365 @@
+"""
+search.py
+
+Full-text search over past play: session log entries, NPCs (name, role,
+backstory), segments (title, description, tags) and campaign lore (title,
+description, plot points).
+
+The index is an SQLite FTS5 table, search_index, with one row per source
+row. SQL triggers on the source tables keep it current, whatever writes
+them (the API, the admin panel, archive imports, bulk deletes). Each row
+carries scope tokens (c<campaign_id>, w<world_id> for NPCs, s<session_id>
+for log entries), so a campaign's search only walks that campaign's part of
+the index. Results are ranked with bm25, titles weighing twice as much as
+text.
+
+Besides GET /api/search, the DM context uses recall() to add the few older
+log entries and NPCs most relevant to the current player input that the
+prompt doesn't already have.
+
+The index needs SQLite with FTS5 (Python's bundled SQLite has it). On other
+databases search is reported as unavailable and recall is skipped.
+"""
+
+import logging
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+
+from aidm_server.database import db
+from aidm_server import memory
+
+logger = logging.getLogger(__name__)
+
+INDEX_TABLE = "search_index"
+KINDS = ("log", "npc", "segment", "campaign")
+# Segments are left out of recall: untriggered ones would give the plot away.
+# So is the campaign: its only row in scope is the one the prompt already has.
+RECALL_KINDS = ("log", "npc")
+RECALL_LIMIT = int(os.getenv("AIDM_SEARCH_RECALL", "3"))
+RECALL_MAX_CHARS = int(os.getenv("AIDM_SEARCH_RECALL_MAX_CHARS", "400"))
+MAX_QUERY_TERMS = 16
+SNIPPET_TOKENS = 16
+# bm25 column weights: title, body, scope.
+RANKING = "bm25(search_index, 2.0, 1.0, 0.0)"
+
+_TERM_RE = re.compile(r"\w+\*?")
+STOPWORDS = frozenset("""
+a an and are as at be but by can did do does for from had has have he her him his how i if in
+into is it its me my no not of on or our she so than that the their them then there they this
+to up us was we were what when where which who why will with you your
+""".split())
+
+
+class SearchUnavailable(Exception):
+    """Raised when the database has no search index (not SQLite, or no FTS5)."""
+
+
+# ----------------------------------------------------------------------
+# Index definition
+# ----------------------------------------------------------------------
+def _json_text(column):
+    """SQL for the text values of a JSON column, space separated."""
+    return (f"CASE WHEN json_valid({column}) THEN "
+            f"(SELECT group_concat(value, ' ') FROM json_tree({column}) WHERE type = 'text') "
+            f"ELSE {column} END")
+
+
+# kind -> (rowid code, table, alias, key, columns whose changes re-index a row,
+#          SELECT of its index row)
+SOURCES = {
+    "log": (1, "session_log_entries", "e", "id", ("session_id", "entry_type", "message"),
+            "SELECT e.id * 8 + 1, e.entry_type, e.message, "
+            "'c' || s.campaign_id || ' s' || e.session_id, "
+            "'log', e.id, s.campaign_id, e.session_id, e.timestamp "
+            "FROM session_log_entries e JOIN sessions s ON s.session_id = e.session_id"),
+    "npc": (2, "npcs", "n", "npc_id", ("world_id", "name", "role", "backstory"),
+            "SELECT n.npc_id * 8 + 2, n.name, "
+            "coalesce(n.role, '') || char(10) || coalesce(n.backstory, ''), "
+            "'w' || n.world_id, 'npc', n.npc_id, NULL, NULL, NULL "
+            "FROM npcs n"),
+    "segment": (3, "campaign_segments", "g", "segment_id",
+                ("campaign_id", "title", "description", "tags"),
+                "SELECT g.segment_id * 8 + 3, g.title, "
+                f"coalesce(g.description, '') || char(10) || coalesce({_json_text('g.tags')}, ''), "
+                "'c' || g.campaign_id, 'segment', g.segment_id, g.campaign_id, NULL, g.created_at "
+                "FROM campaign_segments g"),
+    "campaign": (4, "campaigns", "c", "campaign_id", ("title", "description", "plot_points"),
+                 "SELECT c.campaign_id * 8 + 4, c.title, "
+                 f"coalesce(c.description, '') || char(10) || coalesce({_json_text('c.plot_points')}, ''), "
+                 "'c' || c.campaign_id, 'campaign', c.campaign_id, c.campaign_id, NULL, c.created_at "
+                 "FROM campaigns c"),
+}
+
+_INDEX_COLUMNS = "rowid, title, body, scope, kind, ref_id, campaign_id, session_id, created_at"
+
+
+def index_ddl():
+    """
+    The statements creating the index table and its triggers.
+    """
+    statements = [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {INDEX_TABLE} USING fts5("
+        "title, body, scope, kind UNINDEXED, ref_id UNINDEXED, campaign_id UNINDEXED, "
+        "session_id UNINDEXED, created_at UNINDEXED, "
+        "tokenize = 'porter unicode61 remove_diacritics 2')"
+    ]
+    for kind, (code, table, alias, key, columns, select) in SOURCES.items():
+        insert = (f"INSERT INTO {INDEX_TABLE}({_INDEX_COLUMNS}) "
+                  f"{select} WHERE {alias}.{key} = NEW.{key};")
+        delete = f"DELETE FROM {INDEX_TABLE} WHERE rowid = OLD.{key} * 8 + {code};"
+        statements += [
+            f"CREATE TRIGGER IF NOT EXISTS {INDEX_TABLE}_{kind}_insert AFTER INSERT ON {table} "
+            f"BEGIN {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS {INDEX_TABLE}_{kind}_update "
+            f"AFTER UPDATE OF {', '.join(columns)} ON {table} BEGIN {delete} {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS {INDEX_TABLE}_{kind}_delete AFTER DELETE ON {table} "
+            f"BEGIN {delete} END",
+        ]
+    return statements
+
+
+def create_index(connection, rebuild=False):
+    """
+    Create the index and its triggers if missing. A new index (or, with
+    rebuild, an existing one) is filled from the source tables.
+
+    Args:
+        connection: An SQLite connection, e.g. from db.engine.begin().
+        rebuild (bool): Refill the index even if it exists.
+    """
+    exists = connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (INDEX_TABLE,)
+    ).first() is not None
+    for statement in index_ddl():
+        connection.exec_driver_sql(statement)
+    if exists and not rebuild:
+        return
+    connection.exec_driver_sql(f"DELETE FROM {INDEX_TABLE}")
+    for code, table, alias, key, columns, select in SOURCES.values():
+        connection.exec_driver_sql(f"INSERT INTO {INDEX_TABLE}({_INDEX_COLUMNS}) {select}")
+    _available.clear()
+
+
+def rebuild_index():
+    """
+    Recreate the index from the source tables (`flask search rebuild`).
+
+    Raises:
+        SearchUnavailable: If the database is not SQLite.
+    """
+    if db.engine.dialect.name != "sqlite":
+        raise SearchUnavailable("Search needs an SQLite database with FTS5")
+    with db.engine.begin() as connection:
+        create_index(connection, rebuild=True)
+    return db.session.execute(text(f"SELECT count(*) FROM {INDEX_TABLE}")).scalar()
+
+
+@event.listens_for(db.metadata, "after_create")
+def _create_with_tables(target, connection, **kw):
+    # Databases created with create_all (rather than migrations) get the index too.
+    if connection.dialect.name != "sqlite":
+        return
+    try:
+        create_index(connection)
+    except OperationalError as e:
+        logger.warning(f"Search index not created (SQLite without FTS5?): {str(e)}")
+
+
+_available = {}
+
+
+def available():
+    """
+    Whether the database has the search index.
+    """
+    url = str(db.engine.url)
+    if url not in _available:
+        found = False
+        if db.engine.dialect.name == "sqlite":
+            found = db.session.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {"name": INDEX_TABLE}
+            ).first() is not None
+        _available[url] = found
+    return _available[url]
+
+
+# ----------------------------------------------------------------------
+# Queries
+# ----------------------------------------------------------------------
+def match_expression(query, scope, any_term=False):
+    """
+    Build an FTS5 MATCH expression from free text. Every word is quoted, so
+    the text can't inject FTS syntax; a trailing * keeps prefix search.
+
+    Args:
+        query (str): The user's search text.
+        scope (str): Scope condition, e.g. "scope:(c1 OR w2)".
+        any_term (bool): Match rows with any of the words (ranked by how many)
+            instead of all of them; stopwords are dropped then.
+
+    Returns:
+        str: The expression, or None if the text has no searchable words.
+    """
+    terms = []
+    for term in _TERM_RE.findall((query or "").lower()):
+        word = term.rstrip("*")
+        if any_term and (word in STOPWORDS or len(word) < 3):
+            continue
+        quoted = f'"{word}"*' if term.endswith("*") else f'"{word}"'
+        if quoted not in terms:
+            terms.append(quoted)
+    if not terms:
+        return None
+    joined = (" OR " if any_term else " ").join(terms[:MAX_QUERY_TERMS])
+    return f"{scope} AND ({joined})"
+
+
+def campaign_scope(campaign_id, world_id=None, session_id=None):
+    """
+    Scope condition for a campaign (and its world's NPCs), or for the log
+    of one of its sessions.
+    """
+    if session_id is not None:
+        return f"scope:c{int(campaign_id)} AND scope:s{int(session_id)}"
+    if world_id is not None:
+        return f"scope:(c{int(campaign_id)} OR w{int(world_id)})"
+    return f"scope:c{int(campaign_id)}"
+
+
+def _isoformat(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).isoformat()
+    except (TypeError, ValueError):
+        return value
+
+
+def search(match, kinds=None, limit=20, after=None, where=None, params=None):
+    """
+    Run a MATCH expression and return one page of ranked hits.
+
+    Ranking needs every match scored, but snippets are only made for the
+    rows on the page.
+
+    Args:
+        match (str): An expression from match_expression.
+        kinds (iterable): Only return these kinds of rows.
+        limit (int): Page size.
+        after (tuple): (score, rowid) of the last hit of the previous page.
+        where (str): Extra SQL condition on the index columns.
+        params (dict): Parameters of where.
+
+    Returns:
+        tuple: (list of hit dicts, (score, rowid) of the last hit if there
+        are more, else None)
+
+    Raises:
+        SearchUnavailable: If the database has no search index.
+    """
+    if not available():
+        raise SearchUnavailable("Search needs an SQLite database with FTS5")
+    params = dict(params or {}, match=match, limit=limit + 1)
+    conditions = [f"{INDEX_TABLE} MATCH :match"]
+    if kinds:
+        names = [f":kind{i}" for i in range(len(kinds))]
+        conditions.append(f"kind IN ({', '.join(names)})")
+        params.update({name[1:]: kind for name, kind in zip(names, kinds)})
+    if where:
+        conditions.append(where)
+    ranked = (f"SELECT rowid AS id, {RANKING} AS score FROM {INDEX_TABLE} "
+              f"WHERE {' AND '.join(conditions)}")
+    page_filter = ""
+    if after is not None:
+        page_filter = "WHERE (score, id) > (:after_score, :after_id)"
+        params.update(after_score=after[0], after_id=after[1])
+    rows = db.session.execute(
+        text(f"SELECT id, score FROM ({ranked}) {page_filter} ORDER BY score, id LIMIT :limit"),
+        params
+    ).all()
+
+    next_key = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_key = (rows[-1].score, rows[-1].id)
+    if not rows:
+        return [], None
+
+    scores = {row.id: row.score for row in rows}
+    ids = [f":id{i}" for i in range(len(rows))]
+    details = db.session.execute(
+        text(f"SELECT rowid AS id, kind, ref_id, campaign_id, session_id, created_at, title, body, "
+             f"snippet({INDEX_TABLE}, 1, '[', ']', '...', {SNIPPET_TOKENS}) AS snippet "
+             f"FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH :match AND rowid IN ({', '.join(ids)})"),
+        dict({name[1:]: row.id for name, row in zip(ids, rows)}, match=match)
+    ).all()
+    by_id = {row.id: row for row in details}
+
+    hits = []
+    for row_id in scores:
+        row = by_id.get(row_id)
+        if row is None:
+            continue
+        hits.append({
+            "kind": row.kind,
+            "id": row.ref_id,
+            "campaign_id": row.campaign_id,
+            "session_id": row.session_id,
+            "title": row.title,
+            "snippet": row.snippet,
+            "text": row.body,
+            "timestamp": _isoformat(row.created_at),
+            "score": -scores[row_id],
+        })
+    return hits, next_key
+
+
+def recall(campaign_id, world_id, session_id, text_input, limit=None):
+    """
+    The indexed rows most relevant to a player input that the DM prompt
+    doesn't already carry: this session's entries after its last summary
+    are in the prompt verbatim, so only older ones (and other sessions'
+    log entries and the world's NPCs) are considered.
+
+    Returns:
+        list: Hits as returned by search, best first; empty if search is
+        unavailable or the input has no searchable words.
+    """
+    limit = RECALL_LIMIT if limit is None else limit
+    if limit <= 0 or not available():
+        return []
+    match = match_expression(text_input, campaign_scope(campaign_id, world_id), any_term=True)
+    if match is None:
+        return []
+    boundary = memory.summarized_up_to(session_id) if session_id else 0
+    hits, _ = search(
+        match, kinds=RECALL_KINDS, limit=limit,
+        where="NOT (kind = 'log' AND session_id = :session_id AND ref_id > :boundary)",
+        params={"session_id": session_id, "boundary": boundary}
+    )
+    return hits
+
+
+def render_recall(hits):
+    """
+    Render recalled hits for the DM prompt.
+    """
+    if not hits:
+        return ""
+    lines = ["RELEVANT EARLIER EVENTS AND LORE (found by search, may be from other sessions):"]
+    for hit in hits:
+        body = " ".join(hit["text"].split())
+        if len(body) > RECALL_MAX_CHARS:
+            body = body[:RECALL_MAX_CHARS].rstrip() + "..."
+        if hit["kind"] == "log":
+            lines.append(f"- (session {hit['session_id']}) {body}")
+        elif hit["kind"] == "npc":
+            lines.append(f"- (NPC) {hit['title']}: {body}")
+        else:
+            lines.append(f"- ({hit['kind']}) {hit['title']}: {body}")
+    return "\n".join(lines) + "\n"
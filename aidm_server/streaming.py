@@ -0,0 +1,223 @@
+"""
+streaming.py
+
+Output stage between an LLM stream and the dm_chunk Socket.IO events.
+
+Model chunks are often only a few characters long, and sending each one as
+its own packet to every client in the room costs far more than the text
+itself. ChunkRelay buffers chunks and emits them together once the buffer
+reaches AIDM_STREAM_FLUSH_BYTES or has been held for AIDM_STREAM_FLUSH_MS,
+whichever comes first. Text is passed through untouched, so the concatenated
+dm_chunk payloads are exactly what the model produced.
+
+When a client in the room falls behind (more than AIDM_STREAM_MAX_BACKLOG
+packets queued on its connection), flushes are held back and chunks keep
+coalescing into a bigger packet, up to a hard cap, instead of piling more
+small packets onto the slow connection.
+"""
+
+import os
+import threading
+import time
+
+FLUSH_BYTES = int(os.getenv("AIDM_STREAM_FLUSH_BYTES", "256"))
+FLUSH_MS = float(os.getenv("AIDM_STREAM_FLUSH_MS", "50"))
+MAX_BACKLOG = int(os.getenv("AIDM_STREAM_MAX_BACKLOG", "32"))
+# A held-back buffer is sent anyway once it grows this many times past FLUSH_BYTES.
+HARD_CAP_FACTOR = 16
+# How long the end of a stream waits for a lagging room before the final flush.
+DRAIN_TIMEOUT = 1.0
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class StreamStats:
+    """
+    Process-wide counters for the DM output stage.
+    """
+
+    FIELDS = ("streams", "chunks_received", "packets_sent", "bytes_sent", "deferred_flushes")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(self.FIELDS, 0)
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self._counters[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters["chunks_per_packet"] = (
+            counters["chunks_received"] / counters["packets_sent"]
+            if counters["packets_sent"] else 0.0
+        )
+        return counters
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict.fromkeys(self.FIELDS, 0)
+
+
+stream_stats = StreamStats()
+
+
+def room_backlog(socketio, room, namespace="/"):
+    """
+    Return the deepest outgoing packet queue among this process's clients in
+    a room (clients connected to other processes are not visible here).
+    """
+    server = socketio.server
+    sockets = getattr(server.eio, "sockets", {})
+    deepest = 0
+    for _, eio_sid in server.manager.get_participants(namespace, room):
+        socket = sockets.get(eio_sid)
+        if socket is not None:
+            deepest = max(deepest, socket.queue.qsize())
+    return deepest
+
+
+class ChunkRelay:
+    """
+    Relays one streamed DM response to a session room as coalesced dm_chunk
+    events.
+
+    Args:
+        socketio: The SocketIO instance to emit through.
+        room (str): Room to emit to.
+        session_id (int): Included in every dm_chunk payload.
+        flush_bytes (int): Emit once this many bytes are buffered.
+        flush_ms (float): Emit once the oldest buffered chunk is this old.
+        max_backlog (int): Hold flushes while a client has more packets queued.
+    """
+
+    def __init__(self, socketio, room, session_id, flush_bytes=None, flush_ms=None,
+                 max_backlog=None):
+        self.socketio = socketio
+        self.room = room
+        self.session_id = session_id
+        self.flush_bytes = FLUSH_BYTES if flush_bytes is None else flush_bytes
+        self.flush_delay = (FLUSH_MS if flush_ms is None else flush_ms) / 1000.0
+        self.max_backlog = MAX_BACKLOG if max_backlog is None else max_backlog
+        self.chunks_received = 0
+        self.packets_sent = 0
+        # Timings of the last relay() call, in seconds.
+        self.first_chunk_seconds = None
+        self.total_seconds = None
+        self.emit_seconds = 0.0
+        self._parts = []
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_since = None
+
+    @property
+    def text(self):
+        """Everything received so far, exactly as streamed."""
+        return "".join(self._parts)
+
+    def relay(self, chunks):
+        """
+        Read chunks from a (blocking) iterable and emit them to the room.
+
+        The iterable is consumed on a background task, so the flush window
+        is honoured even while the model is slow to produce the next chunk.
+        Exceptions raised by the iterable are re-raised here after whatever
+        text arrived before them has been sent.
+
+        Returns:
+            str: The full response text, exactly as streamed.
+        """
+        started = time.perf_counter()
+        eio = self.socketio.server.eio
+        queue = eio.create_queue()
+        empty = eio.get_queue_empty_exception()
+        self.socketio.start_background_task(self._produce, chunks, queue)
+
+        try:
+            while True:
+                try:
+                    item = queue.get(timeout=self._time_to_flush())
+                except empty:
+                    self._maybe_flush()
+                    continue
+                if item is _END:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                if self.first_chunk_seconds is None:
+                    self.first_chunk_seconds = time.perf_counter() - started
+                self._parts.append(item)
+                self.chunks_received += 1
+                self._buffer.append(item)
+                self._buffered_bytes += len(item.encode("utf-8"))
+                if self._buffered_since is None:
+                    self._buffered_since = time.monotonic()
+                self._maybe_flush()
+        finally:
+            self._drain()
+            self.total_seconds = time.perf_counter() - started
+            stream_stats.add(streams=1, chunks_received=self.chunks_received)
+
+        return self.text
+
+    @staticmethod
+    def _produce(chunks, queue):
+        try:
+            for chunk in chunks:
+                if chunk:
+                    queue.put(chunk)
+        except Exception as e:
+            queue.put(_Failure(e))
+        finally:
+            queue.put(_END)
+
+    def _time_to_flush(self):
+        if self._buffered_since is None:
+            return None
+        return max(0.0, self._buffered_since + self.flush_delay - time.monotonic())
+
+    def _maybe_flush(self):
+        if not self._buffer:
+            return
+        due = (self._buffered_bytes >= self.flush_bytes or
+               time.monotonic() - self._buffered_since >= self.flush_delay)
+        if not due:
+            return
+        if (self._buffered_bytes < self.flush_bytes * HARD_CAP_FACTOR and
+                room_backlog(self.socketio, self.room) > self.max_backlog):
+            # Let the slow client catch up; keep coalescing meanwhile.
+            stream_stats.add(deferred_flushes=1)
+            self._buffered_since = time.monotonic()
+            return
+        self._flush()
+
+    def _drain(self):
+        if not self._buffer:
+            return
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while (room_backlog(self.socketio, self.room) > self.max_backlog and
+               time.monotonic() < deadline):
+            self.socketio.sleep(self.flush_delay)
+        self._flush()
+
+    def _flush(self):
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_since = None
+        emit_started = time.perf_counter()
+        self.socketio.emit('dm_chunk', {
+            'chunk': text,
+            'session_id': self.session_id
+        }, room=self.room)
+        self.emit_seconds += time.perf_counter() - emit_started
+        self.packets_sent += 1
+        stream_stats.add(packets_sent=1, bytes_sent=len(text.encode("utf-8")))
+        self.socketio.sleep(0)
@@ -0,0 +1,505 @@
+"""
+triggers.py
+
+Segment trigger engine.
+
+CampaignSegment.trigger_condition is either JSON or a small DSL. Each
+condition is parsed once into a predicate tree and kept per campaign, and
+the untriggered segments of a campaign are indexed by the keywords their
+conditions require, so a chat message is only evaluated against segments
+whose keywords actually occur in it.
+
+DSL, case-insensitive; AND binds tighter than OR, parentheses group:
+
+    keyword:dragon                  word or quoted phrase in the message
+    keyword:dragon,wyrm             any of several keywords
+    tags                            any of the segment's own tags in the message
+    location:"dark forest"          campaign location contains the text
+    quest:amulet                    current quest contains the text
+    players>=3                      active players in the session (<, <=, =, >=, >)
+    NOT location:town
+
+    keyword:dragon AND (location:mountain OR players>=4)
+
+JSON uses the same terms:
+
+    {"keyword": "dragon"}           {"keywords": ["dragon", "wyrm"]}
+    {"location": "dark forest"}     {"quest": "amulet"}
+    {"players": ">=3"}              {"min_players": 3, "max_players": 5}
+    {"tags": true}                  {"all": [...]}, {"any": [...]}, {"not": {...}}
+
+A JSON object with several keys requires all of them. An empty condition
+never fires.
+"""
+
+import json
+import logging
+import operator
+import re
+import threading
+
+from aidm_server.invalidation import invalidation_bus
+from aidm_server.jsonfields import json_fields
+from aidm_server.models import CampaignSegment
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w+")
+_DSL_TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|("[^"]*")|(<=|>=|=|<|>|:|,)|([^\s():,<>="]+))')
+_COMPARISONS = {
+    "<": operator.lt, "<=": operator.le, "=": operator.eq,
+    ">=": operator.ge, ">": operator.gt,
+}
+
+
+class TriggerSyntaxError(ValueError):
+    """Raised for trigger conditions that cannot be parsed."""
+
+
+def tokenize(text):
+    """
+    Lower-case word tokens of a text.
+    """
+    return _WORD_RE.findall((text or "").lower())
+
+
+def split_tags(tags):
+    """
+    Normalize segment tags: a list, or comma/newline separated text as
+    older clients send it.
+    """
+    if isinstance(tags, (list, tuple)):
+        return [tag.strip() for tag in tags if isinstance(tag, str) and tag.strip()]
+    if not isinstance(tags, str):
+        return []
+    return [tag.strip() for tag in re.split(r"[,\n]", tags) if tag.strip()]
+
+
+class TriggerContext:
+    """
+    What a condition is evaluated against. Campaign state and the player
+    count are loaded lazily, only if a candidate condition needs them.
+
+    Args:
+        message (str): The chat message.
+        campaign (callable): Returns {'location': ..., 'current_quest': ...} or None.
+        player_count (callable): Returns the number of active players.
+    """
+
+    def __init__(self, message, campaign=None, player_count=None):
+        self.tokens = tokenize(message)
+        self.token_set = set(self.tokens)
+        self.text = " " + " ".join(self.tokens) + " "
+        self._campaign_loader = campaign
+        self._player_count_loader = player_count
+        self._campaign = None
+        self._player_count = None
+
+    @property
+    def campaign(self):
+        if self._campaign is None:
+            loaded = self._campaign_loader() if self._campaign_loader else None
+            self._campaign = loaded or {}
+        return self._campaign
+
+    @property
+    def player_count(self):
+        if self._player_count is None:
+            self._player_count = self._player_count_loader() if self._player_count_loader else 0
+        return self._player_count
+
+    def has_phrase(self, words):
+        if len(words) == 1:
+            return words[0] in self.token_set
+        return (" " + " ".join(words) + " ") in self.text
+
+
+# ----------------------------------------------------------------------
+# Predicates
+# ----------------------------------------------------------------------
+class Predicate:
+    def evaluate(self, ctx):
+        raise NotImplementedError
+
+    def required_tokens(self):
+        """
+        A set of tokens at least one of which must appear in the message for
+        this predicate to hold, or None if it can hold without any.
+        """
+        return None
+
+
+class Never(Predicate):
+    def evaluate(self, ctx):
+        return False
+
+    def required_tokens(self):
+        return set()
+
+
+class Keywords(Predicate):
+    def __init__(self, phrases):
+        self.phrases = [words for words in (tokenize(p) for p in phrases) if words]
+
+    def evaluate(self, ctx):
+        return any(ctx.has_phrase(words) for words in self.phrases)
+
+    def required_tokens(self):
+        # Any single word of a phrase is necessary; index on the longest one.
+        return {max(words, key=len) for words in self.phrases}
+
+
+class Contains(Predicate):
+    def __init__(self, field, text):
+        self.field = field
+        self.text = text.lower()
+
+    def evaluate(self, ctx):
+        return self.text in (ctx.campaign.get(self.field) or "").lower()
+
+
+class PlayerCount(Predicate):
+    def __init__(self, op, value):
+        self.op = op
+        self.compare = _COMPARISONS[op]
+        self.value = value
+
+    def evaluate(self, ctx):
+        return self.compare(ctx.player_count, self.value)
+
+
+class All(Predicate):
+    def __init__(self, children):
+        self.children = children
+
+    def evaluate(self, ctx):
+        return all(child.evaluate(ctx) for child in self.children)
+
+    def required_tokens(self):
+        # Any child's requirement is necessary; use the narrowest one.
+        candidates = [t for t in (c.required_tokens() for c in self.children) if t is not None]
+        return min(candidates, key=len) if candidates else None
+
+
+class Any(Predicate):
+    def __init__(self, children):
+        self.children = children
+
+    def evaluate(self, ctx):
+        return any(child.evaluate(ctx) for child in self.children)
+
+    def required_tokens(self):
+        tokens = set()
+        for child in self.children:
+            required = child.required_tokens()
+            if required is None:
+                return None
+            tokens |= required
+        return tokens
+
+
+class Not(Predicate):
+    def __init__(self, child):
+        self.child = child
+
+    def evaluate(self, ctx):
+        return not self.child.evaluate(ctx)
+
+
+# ----------------------------------------------------------------------
+# Parsing
+# ----------------------------------------------------------------------
+def _term(name, value, tags):
+    name = name.lower()
+    if name in ("keyword", "keywords", "word"):
+        values = value if isinstance(value, list) else [value]
+        if not all(isinstance(v, str) for v in values):
+            raise TriggerSyntaxError("keywords must be strings")
+        predicate = Keywords(values)
+        if not predicate.phrases:
+            raise TriggerSyntaxError("empty keyword")
+        return predicate
+    if name == "tags":
+        if value is False:
+            return Never()
+        return Keywords(tags) if tags else Never()
+    if name in ("location", "quest"):
+        if not isinstance(value, str) or not value.strip():
+            raise TriggerSyntaxError(f"{name} needs a text value")
+        return Contains("location" if name == "location" else "current_quest", value.strip())
+    if name == "players":
+        match = re.fullmatch(r"\s*(<=|>=|=|<|>)?\s*(\d+)\s*", str(value))
+        if not match:
+            raise TriggerSyntaxError(f"invalid player count: {value!r}")
+        return PlayerCount(match.group(1) or "=", int(match.group(2)))
+    if name in ("min_players", "max_players"):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise TriggerSyntaxError(f"{name} must be an integer")
+        return PlayerCount(">=" if name == "min_players" else "<=", value)
+    raise TriggerSyntaxError(f"unknown condition: {name}")
+
+
+def _from_json(node, tags):
+    if isinstance(node, list):
+        if not node:
+            raise TriggerSyntaxError("a list of conditions must not be empty")
+        return All([_from_json(item, tags) for item in node])
+    if not isinstance(node, dict) or not node:
+        raise TriggerSyntaxError("conditions must be non-empty objects")
+    parts = []
+    for key, value in node.items():
+        key = key.lower()
+        if key in ("all", "and", "any", "or"):
+            if not isinstance(value, list) or not value:
+                raise TriggerSyntaxError(f"'{key}' needs a non-empty list")
+            children = [_from_json(item, tags) for item in value]
+            parts.append(All(children) if key in ("all", "and") else Any(children))
+        elif key == "not":
+            parts.append(Not(_from_json(value, tags)))
+        else:
+            parts.append(_term(key, value, tags))
+    return parts[0] if len(parts) == 1 else All(parts)
+
+
+class _DSLParser:
+    def __init__(self, text, tags):
+        self.tags = tags
+        self.tokens = []
+        position = 0
+        text = text.strip()
+        while position < len(text):
+            match = _DSL_TOKEN_RE.match(text, position)
+            if not match or match.end() == position:
+                raise TriggerSyntaxError(f"unexpected input at {text[position:]!r}")
+            position = match.end()
+            value = next(group for group in match.groups() if group is not None)
+            self.tokens.append(value)
+        self.position = 0
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _take(self, expected=None):
+        token = self._peek()
+        if token is None:
+            raise TriggerSyntaxError("unexpected end of condition")
+        if expected is not None and token.upper() != expected:
+            raise TriggerSyntaxError(f"expected {expected}, got {token!r}")
+        self.position += 1
+        return token
+
+    def parse(self):
+        predicate = self._or()
+        if self._peek() is not None:
+            raise TriggerSyntaxError(f"unexpected {self._peek()!r}")
+        return predicate
+
+    def _or(self):
+        children = [self._and()]
+        while (self._peek() or "").upper() == "OR":
+            self._take()
+            children.append(self._and())
+        return children[0] if len(children) == 1 else Any(children)
+
+    def _and(self):
+        children = [self._not()]
+        while (self._peek() or "").upper() == "AND":
+            self._take()
+            children.append(self._not())
+        return children[0] if len(children) == 1 else All(children)
+
+    def _not(self):
+        if (self._peek() or "").upper() == "NOT":
+            self._take()
+            return Not(self._not())
+        if self._peek() == "(":
+            self._take()
+            predicate = self._or()
+            self._take(")")
+            return predicate
+        return self._term()
+
+    def _value(self):
+        token = self._take()
+        if token in ("(", ")", ":", ",") or token in _COMPARISONS:
+            raise TriggerSyntaxError(f"expected a value, got {token!r}")
+        return token[1:-1] if token.startswith('"') else token
+
+    def _term(self):
+        name = self._take()
+        if name.lower() == "tags" and self._peek() != ":":
+            return _term("tags", True, self.tags)
+        operator_token = self._take()
+        if operator_token in _COMPARISONS:
+            return _term(name, f"{operator_token}{self._value()}", self.tags)
+        if operator_token != ":":
+            raise TriggerSyntaxError(f"expected ':' after {name!r}")
+        values = [self._value()]
+        while self._peek() == ",":
+            self._take()
+            values.append(self._value())
+        return _term(name, values if len(values) > 1 else values[0], self.tags)
+
+
+def compile_condition(condition, tags=None):
+    """
+    Parse a trigger condition into a predicate.
+
+    Args:
+        condition (str): JSON or DSL text (empty means "never").
+        tags (list): The segment's tags, used by the "tags" term.
+
+    Raises:
+        TriggerSyntaxError: If the condition cannot be parsed.
+    """
+    condition = (condition or "").strip()
+    if not condition:
+        return Never()
+    tag_list = split_tags(tags)
+    if condition[0] in "{[":
+        try:
+            node = json.loads(condition)
+        except ValueError as e:
+            raise TriggerSyntaxError(f"invalid JSON: {e}")
+        return _from_json(node, tag_list)
+    return _DSLParser(condition, tag_list).parse()
+
+
+# ----------------------------------------------------------------------
+# Engine
+# ----------------------------------------------------------------------
+class _CampaignIndex:
+    def __init__(self, segments):
+        self.segments = {}      # segment_id -> (title, predicate)
+        self.by_token = {}      # token -> set of segment_ids
+        self.unindexed = set()  # segments without a keyword requirement
+        for segment_id, title, predicate in segments:
+            required = predicate.required_tokens()
+            if required is not None and not required:
+                continue  # can never fire
+            self.segments[segment_id] = (title, predicate)
+            if required is None:
+                self.unindexed.add(segment_id)
+            else:
+                for token in required:
+                    self.by_token.setdefault(token, set()).add(segment_id)
+
+    def candidates(self, token_set):
+        ids = set(self.unindexed)
+        for token in token_set:
+            ids |= self.by_token.get(token, set())
+        return sorted(ids)
+
+    def remove(self, segment_id):
+        if self.segments.pop(segment_id, None) is None:
+            return
+        self.unindexed.discard(segment_id)
+        for ids in self.by_token.values():
+            ids.discard(segment_id)
+
+
+class TriggerEngine:
+    """
+    Keeps compiled, keyword-indexed trigger conditions of untriggered
+    segments per campaign. segments.py invalidates a campaign whenever one
+    of its segments is written; other server processes drop their index of
+    the campaign then, and when one of its segments fires here.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._campaigns = {}
+        # campaign_id -> [loads in flight, invalidations since the first began]
+        self._loads = {}
+
+    @staticmethod
+    def _load(campaign_id):
+        rows = CampaignSegment.query.with_entities(
+            CampaignSegment.segment_id, CampaignSegment.title,
+            CampaignSegment.trigger_condition, CampaignSegment.tags
+        ).filter_by(campaign_id=campaign_id, is_triggered=False).all()
+        tags_field = json_fields(CampaignSegment)["tags"]
+        compiled = []
+        for segment_id, title, condition, tags in rows:
+            try:
+                predicate = compile_condition(condition, tags_field.decode(tags))
+            except TriggerSyntaxError as e:
+                logger.warning(f"Segment {segment_id} has an invalid trigger condition: {str(e)}")
+                predicate = Never()
+            compiled.append((segment_id, title, predicate))
+        return _CampaignIndex(compiled)
+
+    def _index(self, campaign_id):
+        with self._lock:
+            index = self._campaigns.get(campaign_id)
+            if index is not None:
+                return index
+            load = self._loads.setdefault(campaign_id, [0, 0])
+            load[0] += 1
+            version = load[1]
+
+        index = None
+        try:
+            index = self._load(campaign_id)
+        finally:
+            with self._lock:
+                if index is not None and load[1] == version:
+                    self._campaigns[campaign_id] = index
+                load[0] -= 1
+                if not load[0]:
+                    del self._loads[campaign_id]
+        return index
+
+    def match(self, campaign_id, ctx):
+        """
+        Return (segment_id, title) of the untriggered segments whose
+        conditions hold for a message.
+
+        Args:
+            campaign_id (int): The campaign the message belongs to.
+            ctx (TriggerContext): The message and lazily loaded state.
+        """
+        index = self._index(campaign_id)
+        with self._lock:
+            candidates = [
+                (segment_id,) + index.segments[segment_id]
+                for segment_id in index.candidates(ctx.token_set)
+                if segment_id in index.segments
+            ]
+        return [
+            (segment_id, title)
+            for segment_id, title, predicate in candidates
+            if predicate.evaluate(ctx)
+        ]
+
+    def mark_triggered(self, campaign_id, segment_ids):
+        """
+        Drop segments that have just fired from the campaign's index.
+        """
+        with self._lock:
+            index = self._campaigns.get(campaign_id)
+            if index is not None:
+                for segment_id in segment_ids:
+                    index.remove(segment_id)
+        invalidation_bus.publish("triggers", campaign_id)
+
+    def _drop(self, campaign_id):
+        with self._lock:
+            self._campaigns.pop(campaign_id, None)
+            load = self._loads.get(campaign_id)
+            if load is not None:
+                load[1] += 1
+
+    def invalidate(self, campaign_id):
+        self._drop(campaign_id)
+        invalidation_bus.publish("triggers", campaign_id)
+
+    def clear(self):
+        with self._lock:
+            self._campaigns.clear()
+            for load in self._loads.values():
+                load[1] += 1
+
+
+trigger_engine = TriggerEngine()
+invalidation_bus.register("triggers", trigger_engine._drop, trigger_engine.clear)
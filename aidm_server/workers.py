@@ -0,0 +1,197 @@
+"""
+workers.py
+
+Background worker pool bridged to the Socket.IO async mode.
+
+Jobs are submitted under a key (e.g. a session id). Jobs sharing a key run
+one at a time in submission order; jobs with different keys run concurrently
+up to the configured number of workers. Workers are Socket.IO background
+tasks, and blocking calls (such as iterating an LLM stream) are pushed to a
+real OS thread with run_blocking/iter_blocking so they never stall the
+eventlet/gevent hub.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+_EXHAUSTED = object()
+
+
+class QueueFullError(Exception):
+    """Raised when a key already has the maximum number of pending jobs."""
+
+
+class KeyedWorkerPool:
+    def __init__(self, name, max_workers=4, max_pending_per_key=None):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending_per_key = max_pending_per_key
+        self.app = None
+        self.socketio = None
+        self._lock = threading.Lock()
+        self._pending = {}       # key -> deque of (fn, args, kwargs)
+        self._scheduled = set()  # keys currently queued or running
+        self._ready = None
+        self._workers_started = False
+        self._in_flight = 0
+
+    def init_app(self, app, socketio, max_workers=None, max_pending_per_key=None):
+        """
+        Bind the pool to a Flask app (for app contexts) and a SocketIO
+        instance (for background tasks and async-mode-aware queues).
+        """
+        self.app = app
+        self.socketio = socketio
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if max_pending_per_key is not None:
+            self.max_pending_per_key = max_pending_per_key
+
+    # ------------------------------------------------------------------
+    # Submission
+    # ------------------------------------------------------------------
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) to run on a worker, after any earlier job
+        submitted with the same key. Returns immediately.
+
+        Raises:
+            QueueFullError: If the key already has max_pending_per_key jobs waiting.
+        """
+        self._submit(key, fn, args, kwargs, bounded=True)
+
+    def submit_accepted(self, key, fn, *args, **kwargs):
+        """
+        Like submit, for a job whose input has already been stored and must
+        not be refused: it is queued even when the key is over
+        max_pending_per_key. Check has_capacity first to refuse work early.
+        """
+        self._submit(key, fn, args, kwargs, bounded=False)
+
+    def has_capacity(self, key):
+        """Whether submit would currently accept another job for key."""
+        return not self.max_pending_per_key or self.pending(key) < self.max_pending_per_key
+
+    def _submit(self, key, fn, args, kwargs, bounded):
+        if self.socketio is None:
+            raise RuntimeError(f"Worker pool '{self.name}' is not initialized")
+        self._start_workers()
+
+        with self._lock:
+            jobs = self._pending.setdefault(key, deque())
+            if bounded and self.max_pending_per_key and len(jobs) >= self.max_pending_per_key:
+                raise QueueFullError(f"Too many pending jobs for {key}")
+            jobs.append((fn, args, kwargs))
+            schedule = key not in self._scheduled
+            if schedule:
+                self._scheduled.add(key)
+
+        if schedule:
+            self._ready.put(key)
+
+    def pending(self, key=None):
+        """Number of jobs waiting (not yet running), overall or for one key."""
+        with self._lock:
+            if key is not None:
+                return len(self._pending.get(key, ()))
+            return sum(len(jobs) for jobs in self._pending.values())
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def wait_idle(self, timeout=None):
+        """
+        Block (cooperatively) until no jobs are queued or running.
+        Mostly useful for tests and benchmarks.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                idle = not self._scheduled
+            if idle:
+                return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            self.socketio.sleep(0.01)
+
+    # ------------------------------------------------------------------
+    # Blocking-call bridge
+    # ------------------------------------------------------------------
+    def run_blocking(self, fn, *args):
+        """
+        Run a blocking callable without stalling the async hub.
+        """
+        async_mode = self.socketio.async_mode if self.socketio else "threading"
+        if async_mode == "eventlet":
+            from eventlet import tpool
+            return tpool.execute(fn, *args)
+        if async_mode == "gevent":
+            import gevent
+            return gevent.get_hub().threadpool.apply(fn, args)
+        return fn(*args)
+
+    def iter_blocking(self, iterable):
+        """
+        Iterate a blocking iterator, fetching each item on a real thread.
+        """
+        iterator = iter(iterable)
+        while True:
+            item = self.run_blocking(next, iterator, _EXHAUSTED)
+            if item is _EXHAUSTED:
+                return
+            yield item
+
+    # ------------------------------------------------------------------
+    # Workers
+    # ------------------------------------------------------------------
+    def _start_workers(self):
+        with self._lock:
+            if self._workers_started:
+                return
+            self._workers_started = True
+            self._ready = self.socketio.server.eio.create_queue()
+        for _ in range(self.max_workers):
+            self.socketio.start_background_task(self._worker_loop)
+        logger.info(f"Worker pool '{self.name}' started with {self.max_workers} workers")
+
+    def _worker_loop(self):
+        while True:
+            key = self._ready.get()
+            if key is _STOP:
+                return
+
+            with self._lock:
+                fn, args, kwargs = self._pending[key].popleft()
+                self._in_flight += 1
+
+            try:
+                with self.app.app_context():
+                    fn(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"Worker pool '{self.name}' job for {key} failed: {str(e)}")
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    if self._pending[key]:
+                        reschedule = True
+                    else:
+                        reschedule = False
+                        del self._pending[key]
+                        self._scheduled.discard(key)
+                if reschedule:
+                    # Go to the back of the line so one chatty key can't starve others.
+                    self._ready.put(key)
+
+    def shutdown(self):
+        with self._lock:
+            started = self._workers_started
+            self._workers_started = False
+        if started:
+            for _ in range(self.max_workers):
+                self._ready.put(_STOP)
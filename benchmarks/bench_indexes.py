@@ -0,0 +1,182 @@
+"""
+bench_indexes.py
+
+Benchmark of the hot-path queries (DM context, session log, list endpoints)
+against growing log sizes, with and without the indexes declared in models.py.
+
+Usage:
+    python -m benchmarks.bench_indexes --sizes 1000,10000,50000 --repeat 20
+    python -m benchmarks.bench_indexes --output bench_indexes.json
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+from sqlalchemy import insert, text
+
+from aidm_server.database import db, init_db
+from aidm_server.models import (
+    World, Campaign, Player, Session, PlayerAction, Map,
+    SessionLogEntry, CampaignSegment, get_full_session_log
+)
+
+SESSIONS = 50
+PLAYERS = 20
+SEGMENTS = 500
+MAPS = 200
+
+HOT_PATH_INDEXES = {
+    "ix_session_log_entries_session_id_timestamp": "session_log_entries (session_id, timestamp)",
+    "ix_player_actions_player_id_timestamp": "player_actions (player_id, timestamp)",
+    "ix_campaign_segments_campaign_id_is_triggered": "campaign_segments (campaign_id, is_triggered)",
+    "ix_players_campaign_id": "players (campaign_id)",
+    "ix_maps_world_id_campaign_id": "maps (world_id, campaign_id)",
+    "ix_maps_campaign_id": "maps (campaign_id)",
+    "ix_sessions_campaign_id": "sessions (campaign_id)",
+}
+
+
+def make_app(database_path):
+    app = Flask(__name__)
+    app.config['DATABASE_URL'] = f"sqlite:///{database_path}"
+    init_db(app)
+    return app
+
+
+def seed(log_entries):
+    """
+    Seed two campaigns so every filter has rows to skip, with log_entries
+    session log rows and half as many player actions.
+    """
+    rng = random.Random(42)
+    start = datetime(2024, 1, 1)
+
+    db.session.execute(insert(World), [{"world_id": 1, "name": "Bench", "description": "bench"}])
+    db.session.execute(insert(Campaign), [
+        {"campaign_id": c, "title": f"Campaign {c}", "world_id": 1} for c in (1, 2)
+    ])
+    db.session.execute(insert(Player), [
+        {"player_id": p, "campaign_id": 1 + p % 2, "name": f"P{p}", "character_name": f"C{p}"}
+        for p in range(1, PLAYERS + 1)
+    ])
+    db.session.execute(insert(Session), [
+        {"session_id": s, "campaign_id": 1 + s % 2} for s in range(1, SESSIONS + 1)
+    ])
+    db.session.execute(insert(CampaignSegment), [
+        {"campaign_id": 1 + i % 2, "title": f"Segment {i}", "is_triggered": i % 10 == 0}
+        for i in range(SEGMENTS)
+    ])
+    db.session.execute(insert(Map), [
+        {"world_id": 1, "campaign_id": 1 + i % 2, "title": f"Map {i}", "map_data": "{}"}
+        for i in range(MAPS)
+    ])
+    db.session.execute(insert(SessionLogEntry), [
+        {
+            "session_id": rng.randint(1, SESSIONS),
+            "message": f"Entry {i}: the party presses on.",
+            "entry_type": "player" if i % 2 else "dm",
+            "timestamp": start + timedelta(seconds=i),
+        }
+        for i in range(log_entries)
+    ])
+    db.session.execute(insert(PlayerAction), [
+        {
+            "player_id": rng.randint(1, PLAYERS),
+            "session_id": rng.randint(1, SESSIONS),
+            "action_text": f"Action {i}",
+            "timestamp": start + timedelta(seconds=i),
+        }
+        for i in range(log_entries // 2)
+    ])
+    db.session.commit()
+
+
+def hot_path_queries():
+    return {
+        "recent_events": lambda: SessionLogEntry.query.filter_by(session_id=7)
+            .order_by(SessionLogEntry.timestamp.desc()).limit(10).all(),
+        "full_session_log": lambda: get_full_session_log(7),
+        "recent_actions": lambda: PlayerAction.query.filter_by(player_id=3)
+            .order_by(PlayerAction.timestamp.desc()).limit(3).all(),
+        "untriggered_segments": lambda: CampaignSegment.query.filter_by(
+            campaign_id=1, is_triggered=False).all(),
+        "campaign_players": lambda: Player.query.filter_by(campaign_id=1).all(),
+        "campaign_sessions": lambda: Session.query.filter_by(campaign_id=1).all(),
+        "campaign_maps": lambda: Map.query.filter_by(world_id=1, campaign_id=1).all(),
+    }
+
+
+def time_queries(repeat):
+    results = {}
+    for name, query in hot_path_queries().items():
+        samples = []
+        for _ in range(repeat):
+            db.session.expunge_all()
+            started = time.perf_counter()
+            query()
+            samples.append((time.perf_counter() - started) * 1000)
+        results[name] = statistics.median(samples)
+    return results
+
+
+def set_indexes(enabled):
+    with db.engine.begin() as conn:
+        for name, target in HOT_PATH_INDEXES.items():
+            if enabled:
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {target}"))
+            else:
+                conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        conn.execute(text("ANALYZE"))
+
+
+def run(sizes, repeat):
+    report = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            app = make_app(os.path.join(tmp, "bench.db"))
+            with app.app_context():
+                seed(size)
+                set_indexes(False)
+                before = time_queries(repeat)
+                set_indexes(True)
+                after = time_queries(repeat)
+                db.session.remove()
+                db.engine.dispose()
+        report.append({"log_entries": size, "before_ms": before, "after_ms": after})
+    return report
+
+
+def print_report(report):
+    print(f"{'log rows':>9}  {'query':<22} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for row in report:
+        for name, before in row["before_ms"].items():
+            after = row["after_ms"][name]
+            speedup = before / after if after else float("inf")
+            print(f"{row['log_entries']:>9}  {name:<22} {before:>10.3f} {after:>10.3f} {speedup:>7.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,50000",
+                        help="Comma-separated session log sizes to benchmark")
+    parser.add_argument("--repeat", type=int, default=20, help="Runs per query (median is reported)")
+    parser.add_argument("--output", help="Optional path to write the results as JSON")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    report = run(sizes, args.repeat)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
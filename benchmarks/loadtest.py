@@ -0,0 +1,375 @@
+"""
+loadtest.py
+
+End-to-end Socket.IO load test of the chat pipeline against the stub LLM.
+
+The harness seeds worlds, campaigns, players and sessions through the REST
+blueprints, then drives simulated clients through join_session /
+send_message / leave_session with the in-process Socket.IO test client.
+Each client waits for the DM's reply to its message before sending the next
+one. Results are written as JSON so runs can be compared across versions.
+
+Usage:
+    python -m benchmarks.loadtest --sessions 10 --players 4 --messages 5
+    python -m benchmarks.loadtest --stub-latency-ms 300 --stub-tokens-per-sec 40 \\
+        --output loadtest.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from datetime import datetime
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=10, help="Concurrent game sessions")
+    parser.add_argument("--players", type=int, default=4, help="Players (clients) per session")
+    parser.add_argument("--messages", type=int, default=5, help="Messages sent by each client")
+    parser.add_argument("--think-ms", type=float, default=0, help="Pause between a reply and the next message")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for a single reply")
+    parser.add_argument("--stub-latency-ms", type=float, default=100)
+    parser.add_argument("--stub-tokens-per-sec", type=float, default=200)
+    parser.add_argument("--workers", type=int, default=None, help="AIDM_GENERATION_WORKERS override")
+    parser.add_argument("--db-profile", default=None, help="AIDM_DB_PROFILE override")
+    parser.add_argument("--output", help="Optional path to write the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Keep server INFO logs")
+    return parser.parse_args()
+
+
+def configure_environment(args, database_path):
+    """
+    Point the server at a throwaway database and the stub LLM. Must run
+    before aidm_server is imported.
+    """
+    os.environ["DATABASE_URL"] = f"sqlite:///{database_path}"
+    os.environ["AIDM_LLM_CACHE_PATH"] = os.path.join(os.path.dirname(database_path), "llm_cache.db")
+    os.environ["AIDM_LLM_PROVIDER"] = "stub"
+    os.environ["AIDM_STUB_LATENCY_MS"] = str(args.stub_latency_ms)
+    os.environ["AIDM_STUB_TOKENS_PER_SEC"] = str(args.stub_tokens_per_sec)
+    os.environ["AIDM_GENERATION_MAX_PENDING"] = str(max(8, args.players * 2))
+    if args.workers is not None:
+        os.environ["AIDM_GENERATION_WORKERS"] = str(args.workers)
+    if args.db_profile:
+        os.environ["AIDM_DB_PROFILE"] = args.db_profile
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered),
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": ordered[-1],
+    }
+
+
+def deep_size(obj, seen=None):
+    """
+    Approximate retained size of nested dicts/lists, in bytes.
+    """
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+class Ticket:
+    def __init__(self, sent_at):
+        self.sent_at = sent_at
+        self.first_chunk_at = None
+        self.done_at = None
+
+
+class EmissionRecorder:
+    """
+    Wraps the Socket.IO server's emit to timestamp DM events per session.
+    Replies for a session stream in the order the messages were sent, so
+    each start/chunk/end is matched to the oldest outstanding ticket.
+    """
+
+    def __init__(self, server):
+        self.outstanding = defaultdict(deque)
+        self.packets = defaultdict(int)
+        self._original_emit = server.emit
+        server.emit = self._emit
+
+    def expect(self, session_id):
+        ticket = Ticket(time.perf_counter())
+        self.outstanding[session_id].append(ticket)
+        return ticket
+
+    def _emit(self, event, data=None, *args, **kwargs):
+        now = time.perf_counter()
+        self.packets[event] += 1
+        if isinstance(data, dict) and event in ("dm_chunk", "dm_response_end"):
+            queue = self.outstanding.get(data.get("session_id"))
+            if queue:
+                ticket = queue[0]
+                if event == "dm_chunk" and ticket.first_chunk_at is None:
+                    ticket.first_chunk_at = now
+                elif event == "dm_response_end":
+                    ticket.done_at = now
+                    queue.popleft()
+        return self._original_emit(event, data, *args, **kwargs)
+
+
+class DBTimer:
+    """
+    Sums time spent executing SQL statements via engine events.
+    """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.total = 0.0
+        self.statements = 0
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("bench_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        self.total += time.perf_counter() - conn.info["bench_started"].pop()
+        self.statements += 1
+
+    def reset(self):
+        self.total = 0.0
+        self.statements = 0
+
+
+def seed(client, sessions, players_per_session):
+    """
+    Create one world, and one campaign + session + players per game session,
+    through the REST API.
+    """
+    world_id = client.post("/api/worlds", json={
+        "name": "Loadtest Realm", "description": "A world for benchmarks."
+    }).get_json()["world_id"]
+
+    games = []
+    for s in range(sessions):
+        campaign_id = client.post("/api/campaigns", json={
+            "title": f"Campaign {s}", "description": "Benchmark campaign", "world_id": world_id
+        }).get_json()["campaign_id"]
+        player_ids = [
+            client.post(f"/api/players/campaigns/{campaign_id}/players", json={
+                "name": f"Player {s}-{p}", "character_name": f"Hero {s}-{p}",
+                "race": "Human", "char_class": "Fighter", "level": 1
+            }).get_json()["player_id"]
+            for p in range(players_per_session)
+        ]
+        session_id = client.post("/api/sessions/start", json={
+            "campaign_id": campaign_id
+        }).get_json()["session_id"]
+        games.append({
+            "world_id": world_id, "campaign_id": campaign_id,
+            "session_id": session_id, "player_ids": player_ids,
+        })
+    return games
+
+
+def run(args):
+    from aidm_server.main import create_app, socketio
+    from aidm_server.blueprints.socketio_events import generation_pool
+    from aidm_server.context_cache import dm_context_cache
+    from aidm_server.database import db
+    from aidm_server.presence import get_presence_store
+    from aidm_server.streaming import stream_stats
+
+    app = create_app()
+    http = app.test_client()
+    games = seed(http, args.sessions, args.players)
+
+    with app.app_context():
+        db_timer = DBTimer(db.engine)
+    recorder = EmissionRecorder(socketio.server)
+
+    presence_store = get_presence_store()
+
+    def presence_snapshot():
+        snapshot = dict(presence_store.stats(), backend=presence_store.name)
+        if presence_store.name == "memory":
+            snapshot["sessions_bytes"] = deep_size(presence_store.sessions)
+            snapshot["connections_bytes"] = deep_size(presence_store.connections)
+        return snapshot
+
+    tracemalloc.start()
+    memory_start = tracemalloc.get_traced_memory()[0]
+    presence = {"before_join": presence_snapshot()}
+
+    clients = []
+    for game in games:
+        for player_id in game["player_ids"]:
+            sio = socketio.test_client(app, flask_test_client=http)
+            sio.emit("join_session", {"session_id": game["session_id"], "player_id": player_id})
+            clients.append((sio, game, player_id))
+    presence["after_join"] = presence_snapshot()
+    db_timer.reset()
+    stream_stats.reset()
+
+    tickets = []
+    failures = []
+    finished = []
+
+    def drive(sio, game, player_id):
+        try:
+            _drive(sio, game, player_id)
+        finally:
+            finished.append(player_id)
+
+    def _drive(sio, game, player_id):
+        for n in range(args.messages):
+            ticket = recorder.expect(game["session_id"])
+            sio.emit("send_message", {
+                "session_id": game["session_id"],
+                "campaign_id": game["campaign_id"],
+                "world_id": game["world_id"],
+                "player_id": player_id,
+                "message": f"Hero {player_id} tries action number {n}.",
+            })
+            tickets.append(ticket)
+            deadline = time.perf_counter() + args.timeout
+            while ticket.done_at is None:
+                if time.perf_counter() > deadline:
+                    failures.append({"player_id": player_id, "message": n, "reason": "timeout"})
+                    return
+                socketio.sleep(0.005)
+            sio.get_received()  # drop buffered packets so client memory stays flat
+            if args.think_ms:
+                socketio.sleep(args.think_ms / 1000.0)
+
+    started = time.perf_counter()
+    for client in clients:
+        socketio.start_background_task(drive, *client)
+    # Poll instead of joining the tasks: a green join can be woken early by
+    # unrelated hub switches and return before the clients are done.
+    while len(finished) < len(clients):
+        socketio.sleep(0.01)
+    generation_pool.wait_idle(args.timeout)
+    elapsed = time.perf_counter() - started
+
+    presence["after_messages"] = presence_snapshot()
+    memory_after_messages = tracemalloc.get_traced_memory()[0]
+
+    for sio, game, player_id in clients:
+        sio.emit("leave_session", {"session_id": game["session_id"], "player_id": player_id})
+        sio.disconnect()
+    presence["after_leave"] = presence_snapshot()
+    memory_end, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    completed = [t for t in tickets if t.done_at is not None]
+    ttfc = [(t.first_chunk_at - t.sent_at) * 1000 for t in completed if t.first_chunk_at]
+    latency = [(t.done_at - t.sent_at) * 1000 for t in completed]
+
+    return {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "async_mode": socketio.async_mode,
+            "config": vars(args),
+        },
+        "throughput": {
+            "messages_sent": len(tickets),
+            "messages_completed": len(completed),
+            "failures": failures,
+            "elapsed_s": elapsed,
+            "messages_per_sec": len(completed) / elapsed if elapsed else 0.0,
+        },
+        "time_to_first_chunk": percentiles(ttfc),
+        "dm_response_end_latency": percentiles(latency),
+        "db": {
+            "total_ms": db_timer.total * 1000,
+            "statements": db_timer.statements,
+            "ms_per_message": (db_timer.total * 1000 / len(completed)) if completed else None,
+            "statements_per_message": (db_timer.statements / len(completed)) if completed else None,
+        },
+        "packets": dict(recorder.packets),
+        "dm_stream": stream_stats.snapshot(),
+        "presence": presence,
+        "memory": {
+            "traced_start_bytes": memory_start,
+            "traced_after_messages_bytes": memory_after_messages,
+            "traced_end_bytes": memory_end,
+            "traced_peak_bytes": memory_peak,
+        },
+        "context_cache": dm_context_cache.stats(),
+    }
+
+
+def print_summary(results):
+    t = results["throughput"]
+    print(f"messages: {t['messages_completed']}/{t['messages_sent']} in {t['elapsed_s']:.2f}s "
+          f"({t['messages_per_sec']:.1f} msg/s), failures: {len(t['failures'])}")
+    for name in ("time_to_first_chunk", "dm_response_end_latency"):
+        p = results[name]
+        if p:
+            print(f"{name}: p50 {p['p50_ms']:.1f} ms, p95 {p['p95_ms']:.1f} ms, "
+                  f"p99 {p['p99_ms']:.1f} ms, max {p['max_ms']:.1f} ms")
+    db_stats = results["db"]
+    if db_stats["ms_per_message"] is not None:
+        print(f"db: {db_stats['ms_per_message']:.2f} ms and "
+              f"{db_stats['statements_per_message']:.1f} statements per message")
+    stream = results["dm_stream"]
+    print(f"dm stream: {stream['chunks_received']} chunks in {stream['packets_sent']} packets "
+          f"({stream['chunks_per_packet']:.1f} chunks/packet), "
+          f"{stream['deferred_flushes']} deferred flushes")
+    after_leave = results["presence"]["after_leave"]
+    print(f"presence after leave: {after_leave['players']} players, "
+          f"{after_leave['connections']} connections")
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_environment(args, os.path.join(tmp, "loadtest.db"))
+        if args.verbose:
+            results = run(args)
+        else:
+            logging.disable(logging.INFO)
+            results = run(args)
+            logging.disable(logging.NOTSET)
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
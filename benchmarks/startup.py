@@ -0,0 +1,189 @@
+"""
+startup.py
+
+Cold-start benchmark of the server: how long a fresh process takes to
+import aidm_server.main and to build the app with create_app() (the work
+every worker repeats after a fork), and which modules that pulls in.
+
+Each run is a new interpreter started with `python -X importtime`, against
+a throwaway SQLite database and the stub LLM. The report lists the
+slowest imports by cumulative time and flags heavy optional dependencies
+(the Gemini SDK, Flask-Admin when AIDM_ADMIN is off) that should only be
+loaded on first use. With --max-import-ms / --max-create-ms the exit
+status is 1 when the medians go over budget, so it can guard CI.
+
+Usage:
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --no-admin --max-import-ms 1500 --output startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Imported by the child process; prints its timings as JSON on stdout.
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import aidm_server.main as main
+imported = time.perf_counter()
+main.create_app()
+created = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "modules": sorted(sys.modules),
+}))
+"""
+
+# Modules that must not be loaded just by starting the server.
+LAZY_MODULES = ("google.generativeai", "google.genai")
+ADMIN_MODULES = ("flask_admin",)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="AIDM server cold-start benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes to time")
+    parser.add_argument("--top", type=int, default=15, help="Slowest imports to report")
+    parser.add_argument("--no-admin", action="store_true", help="Start with AIDM_ADMIN=0")
+    parser.add_argument("--max-import-ms", type=float, default=None,
+                        help="Fail if the median import time is above this")
+    parser.add_argument("--max-create-ms", type=float, default=None,
+                        help="Fail if the median create_app() time is above this")
+    parser.add_argument("--output", help="Optional path to write the results as JSON")
+    return parser.parse_args()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def child_environment(args, tmp):
+    env = dict(os.environ)
+    env["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'startup.db')}"
+    env["AIDM_LLM_CACHE_PATH"] = os.path.join(tmp, "llm_cache.db")
+    env["AIDM_LLM_PROVIDER"] = "stub"
+    env["AIDM_LOG_LEVEL"] = "WARNING"
+    env["AIDM_ADMIN"] = "0" if args.no_admin else "1"
+    return env
+
+
+def parse_importtime(stderr):
+    """
+    Return {module: (self_us, cumulative_us)} from -X importtime output.
+    """
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        imports[name.strip()] = (int(self_us), int(cumulative_us))
+    return imports
+
+
+def run_once(env):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD],
+        env=env, capture_output=True, text=True, cwd=os.getcwd()
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"Server start failed:\n{result.stderr[-2000:]}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings["process_ms"] = wall_ms
+    timings["imports"] = parse_importtime(result.stderr)
+    return timings
+
+
+def summarize(samples):
+    return {
+        "median_ms": statistics.median(samples),
+        "min_ms": min(samples),
+        "max_ms": max(samples),
+    }
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = child_environment(args, tmp)
+        # The first start creates the database; don't count it.
+        run_once(env)
+        runs = [run_once(env) for _ in range(args.runs)]
+
+    last = runs[-1]
+    slowest = sorted(last["imports"].items(), key=lambda item: item[1][1], reverse=True)
+    top_level = [(name, times) for name, times in slowest if "." not in name][:args.top]
+    watched = LAZY_MODULES + (ADMIN_MODULES if args.no_admin else ())
+    loaded_lazy = [name for name in watched if name in last["modules"]]
+
+    return {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "config": vars(args),
+        },
+        "import": summarize([r["import_ms"] for r in runs]),
+        "create_app": summarize([r["create_app_ms"] for r in runs]),
+        "process": summarize([r["process_ms"] for r in runs]),
+        "modules_loaded": len(last["modules"]),
+        "slowest_imports": [
+            {"module": name, "self_ms": self_us / 1000, "cumulative_ms": cumulative_us / 1000}
+            for name, (self_us, cumulative_us) in top_level
+        ],
+        "lazy_modules_loaded": loaded_lazy,
+    }
+
+
+def print_summary(results):
+    for name in ("import", "create_app", "process"):
+        s = results[name]
+        print(f"{name}: median {s['median_ms']:.1f} ms (min {s['min_ms']:.1f}, max {s['max_ms']:.1f})")
+    print(f"modules loaded: {results['modules_loaded']}")
+    print("slowest top-level imports (cumulative):")
+    for entry in results["slowest_imports"]:
+        print(f"  {entry['cumulative_ms']:8.1f} ms  {entry['module']}")
+    if results["lazy_modules_loaded"]:
+        print(f"loaded at startup but should be lazy: {', '.join(results['lazy_modules_loaded'])}")
+
+
+def check_budgets(args, results):
+    failures = []
+    if args.max_import_ms is not None and results["import"]["median_ms"] > args.max_import_ms:
+        failures.append(f"import {results['import']['median_ms']:.1f} ms > {args.max_import_ms} ms")
+    if args.max_create_ms is not None and results["create_app"]["median_ms"] > args.max_create_ms:
+        failures.append(f"create_app {results['create_app']['median_ms']:.1f} ms > {args.max_create_ms} ms")
+    if results["lazy_modules_loaded"]:
+        failures.append(f"eagerly imported: {', '.join(results['lazy_modules_loaded'])}")
+    return failures
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+    failures = check_budgets(args, results)
+    if failures:
+        print("over budget: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
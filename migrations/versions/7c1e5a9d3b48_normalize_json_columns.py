@@ -0,0 +1,88 @@
+"""normalize json columns
+
+Rewrites the JSON text columns (player stats, inventory and character
+sheet, campaign plot points and active NPCs, segment tags, map data) as
+compact JSON of the shapes in aidm_server.models, so they can be read
+with the JSON1 functions. Plain text from before is converted: tags are
+split on commas and newlines, list columns on newlines, and anything else
+that isn't a JSON object is kept as {"text": ...}.
+
+Revision ID: 7c1e5a9d3b48
+Revises: e6a4c2b7d915
+Create Date: 2026-10-18 23:41:27.519304
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e5a9d3b48'
+down_revision = 'e6a4c2b7d915'
+branch_labels = None
+depends_on = None
+
+# (table, primary key, column, shape, separators for plain text)
+COLUMNS = [
+    ('players', 'player_id', 'stats', 'object', None),
+    ('players', 'player_id', 'inventory', 'list', '\n'),
+    ('players', 'player_id', 'character_sheet', 'object', None),
+    ('campaigns', 'campaign_id', 'plot_points', 'list', '\n'),
+    ('campaigns', 'campaign_id', 'active_npcs', 'list', '\n'),
+    ('campaign_segments', 'segment_id', 'tags', 'list', ',\n'),
+    ('maps', 'map_id', 'map_data', 'object', None),
+]
+
+
+def _normalize(text, shape, separators):
+    if text is None or not text.strip():
+        return None
+    try:
+        value = json.loads(text)
+    except ValueError:
+        if shape == 'object':
+            value = {"text": text}
+        else:
+            for separator in separators[1:]:
+                text = text.replace(separator, separators[0])
+            value = [item.strip() for item in text.split(separators[0]) if item.strip()]
+    if shape == 'object' and not isinstance(value, dict):
+        value = {"text": text}
+    elif shape == 'list' and not isinstance(value, list):
+        value = [value]
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def _rewrite(table_name, key, column, convert):
+    bind = op.get_bind()
+    table = sa.table(table_name, sa.column(key), sa.column(column))
+    rows = bind.execute(
+        sa.select(table.c[key], table.c[column]).where(table.c[column].isnot(None))
+    ).fetchall()
+    for row_id, text in rows:
+        new_text = convert(text)
+        if new_text != text:
+            bind.execute(
+                table.update().where(table.c[key] == row_id).values({column: new_text})
+            )
+
+
+def upgrade():
+    for table_name, key, column, shape, separators in COLUMNS:
+        _rewrite(table_name, key, column,
+                 lambda text, shape=shape, separators=separators: _normalize(text, shape, separators))
+
+
+def downgrade():
+    # Older code reads tags as comma separated text; the other columns
+    # stay valid JSON text.
+    def tags_text(text):
+        try:
+            tags = json.loads(text)
+        except ValueError:
+            return text
+        return ", ".join(str(tag) for tag in tags) if isinstance(tags, list) else text
+
+    _rewrite('campaign_segments', 'segment_id', 'tags', tags_text)
@@ -0,0 +1,89 @@
+"""add search index
+
+Full-text search over session log entries, NPCs, segments and campaign
+lore: an FTS5 table, search_index, filled from the existing rows and kept
+current by triggers on the source tables (see aidm_server/search.py).
+
+SQLite only; on other databases this does nothing and search reports
+itself unavailable. Batch migrations that later recreate one of the source
+tables drop its triggers: run `flask search rebuild` after them.
+
+Revision ID: 9f2b6d4e8a17
+Revises: 7c1e5a9d3b48
+Create Date: 2026-10-19 00:37:52.114863
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9f2b6d4e8a17'
+down_revision = '7c1e5a9d3b48'
+branch_labels = None
+depends_on = None
+
+
+def _json_text(column):
+    return (f"CASE WHEN json_valid({column}) THEN "
+            f"(SELECT group_concat(value, ' ') FROM json_tree({column}) WHERE type = 'text') "
+            f"ELSE {column} END")
+
+
+# kind -> (rowid code, table, alias, key, re-indexed columns, SELECT of the index row)
+SOURCES = {
+    "log": (1, "session_log_entries", "e", "id", ("session_id", "entry_type", "message"),
+            "SELECT e.id * 8 + 1, e.entry_type, e.message, "
+            "'c' || s.campaign_id || ' s' || e.session_id, "
+            "'log', e.id, s.campaign_id, e.session_id, e.timestamp "
+            "FROM session_log_entries e JOIN sessions s ON s.session_id = e.session_id"),
+    "npc": (2, "npcs", "n", "npc_id", ("world_id", "name", "role", "backstory"),
+            "SELECT n.npc_id * 8 + 2, n.name, "
+            "coalesce(n.role, '') || char(10) || coalesce(n.backstory, ''), "
+            "'w' || n.world_id, 'npc', n.npc_id, NULL, NULL, NULL "
+            "FROM npcs n"),
+    "segment": (3, "campaign_segments", "g", "segment_id",
+                ("campaign_id", "title", "description", "tags"),
+                "SELECT g.segment_id * 8 + 3, g.title, "
+                f"coalesce(g.description, '') || char(10) || coalesce({_json_text('g.tags')}, ''), "
+                "'c' || g.campaign_id, 'segment', g.segment_id, g.campaign_id, NULL, g.created_at "
+                "FROM campaign_segments g"),
+    "campaign": (4, "campaigns", "c", "campaign_id", ("title", "description", "plot_points"),
+                 "SELECT c.campaign_id * 8 + 4, c.title, "
+                 f"coalesce(c.description, '') || char(10) || coalesce({_json_text('c.plot_points')}, ''), "
+                 "'c' || c.campaign_id, 'campaign', c.campaign_id, c.campaign_id, NULL, c.created_at "
+                 "FROM campaigns c"),
+}
+
+COLUMNS = "rowid, title, body, scope, kind, ref_id, campaign_id, session_id, created_at"
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return
+    op.execute(
+        "CREATE VIRTUAL TABLE search_index USING fts5("
+        "title, body, scope, kind UNINDEXED, ref_id UNINDEXED, campaign_id UNINDEXED, "
+        "session_id UNINDEXED, created_at UNINDEXED, "
+        "tokenize = 'porter unicode61 remove_diacritics 2')"
+    )
+    for kind, (code, table, alias, key, columns, select) in SOURCES.items():
+        insert = f"INSERT INTO search_index({COLUMNS}) {select} WHERE {alias}.{key} = NEW.{key};"
+        delete = f"DELETE FROM search_index WHERE rowid = OLD.{key} * 8 + {code};"
+        op.execute(f"CREATE TRIGGER search_index_{kind}_insert AFTER INSERT ON {table} "
+                   f"BEGIN {insert} END")
+        op.execute(f"CREATE TRIGGER search_index_{kind}_update "
+                   f"AFTER UPDATE OF {', '.join(columns)} ON {table} BEGIN {delete} {insert} END")
+        op.execute(f"CREATE TRIGGER search_index_{kind}_delete AFTER DELETE ON {table} "
+                   f"BEGIN {delete} END")
+        op.execute(f"INSERT INTO search_index({COLUMNS}) {select}")
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return
+    for kind in SOURCES:
+        for event in ("insert", "update", "delete"):
+            op.execute(f"DROP TRIGGER IF EXISTS search_index_{kind}_{event}")
+    op.execute("DROP TABLE IF EXISTS search_index")
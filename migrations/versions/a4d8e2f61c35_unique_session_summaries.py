@@ -0,0 +1,34 @@
+"""unique session summaries
+
+A run of log entries is summarized once per level. Duplicates left by
+concurrent summarizers are removed (keeping the oldest) before the unique
+index is created.
+
+Revision ID: a4d8e2f61c35
+Revises: 9f2b6d4e8a17
+Create Date: 2026-10-19 02:14:05.381927
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d8e2f61c35'
+down_revision = '9f2b6d4e8a17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        "DELETE FROM session_summaries WHERE summary_id NOT IN ("
+        " SELECT MIN(summary_id) FROM session_summaries"
+        " GROUP BY session_id, level, first_entry_id)"
+    )
+    with op.batch_alter_table('session_summaries', schema=None) as batch_op:
+        batch_op.create_index('uq_session_summaries_session_id_level_first_entry_id', ['session_id', 'level', 'first_entry_id'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('session_summaries', schema=None) as batch_op:
+        batch_op.drop_index('uq_session_summaries_session_id_level_first_entry_id')
@@ -0,0 +1,39 @@
+"""unique active jobs
+
+At most one queued or running job per kind and key. Duplicates left by
+concurrent enqueues are marked failed (keeping the oldest) before the
+partial unique index is created.
+
+Revision ID: d5b1c7e3f920
+Revises: a4d8e2f61c35
+Create Date: 2026-10-19 03:06:41.527308
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5b1c7e3f920'
+down_revision = 'a4d8e2f61c35'
+branch_labels = None
+depends_on = None
+
+ACTIVE = "status IN ('queued', 'running')"
+
+
+def upgrade():
+    op.execute(
+        "UPDATE jobs SET status = 'failed', error = 'Duplicate of an active job with the same key', "
+        "finished_at = CURRENT_TIMESTAMP "
+        f"WHERE {ACTIVE} AND key IS NOT NULL AND job_id NOT IN ("
+        f" SELECT MIN(job_id) FROM jobs WHERE {ACTIVE} AND key IS NOT NULL GROUP BY kind, key)"
+    )
+    with op.batch_alter_table('jobs', schema=None) as batch_op:
+        batch_op.create_index('uq_jobs_kind_key_active', ['kind', 'key'], unique=True,
+                              sqlite_where=sa.text(ACTIVE), postgresql_where=sa.text(ACTIVE))
+
+
+def downgrade():
+    with op.batch_alter_table('jobs', schema=None) as batch_op:
+        batch_op.drop_index('uq_jobs_kind_key_active')